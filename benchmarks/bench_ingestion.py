@@ -0,0 +1,59 @@
+"""
+Checks the ClinicalTrials.gov API parser against the saved fixtures and benchmarks concurrent ingestion against the
+local stand-in server, which adds latency and transient 503 errors like the real service.
+
+Run from the repository root:
+    python -m benchmarks.bench_ingestion --trials 200 --latency 0.2 --workers 1 8 16
+"""
+import argparse
+import json
+import os
+import time
+
+from benchmarks.ctgov_stub_server import FIXTURE_DIR, StubApi, start_server
+from patient_matching.trial_ingestion import ingest_clinical_trials
+
+
+def check_fixtures():
+    # Parsing the fixtures through the stand-in server must give the saved expected trial dicts
+    server, base_url = start_server(StubApi())
+    try:
+        trials = ingest_clinical_trials(page_limit=10, base_url=base_url, requests_per_second=1000)
+    finally:
+        server.shutdown()
+    with open(os.path.join(FIXTURE_DIR, "expected_trials.json")) as f:
+        expected = json.load(f)
+    return trials == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds added to every stub response")
+    parser.add_argument("--fail-every", type=int, default=25, help="Answer every Nth request with a 503 (0 disables)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--rate", type=float, default=100.0, help="Requests per second allowed by the rate limiter")
+    args = parser.parse_args()
+
+    fixtures_ok = check_fixtures()
+    print(f"Fixture parsing matches expected_trials.json: {fixtures_ok}")
+
+    page_limit = -(-args.trials // 10)
+    print(f"{args.trials} trials, {args.latency}s latency, 503 every {args.fail_every} requests")
+    for workers in args.workers:
+        api = StubApi(args.trials, args.latency, args.fail_every)
+        server, base_url = start_server(api)
+        try:
+            start = time.perf_counter()
+            trials = ingest_clinical_trials(page_limit, max_workers=workers, requests_per_second=args.rate, base_url=base_url)
+            seconds = time.perf_counter() - start
+        finally:
+            server.shutdown()
+        print(f"  workers={workers:<3} {seconds:8.2f} s  {len(trials)} trials  {api.requests} requests")
+
+    if not fixtures_ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
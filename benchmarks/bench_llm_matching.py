@@ -0,0 +1,68 @@
+"""
+Benchmarks match_patients_to_trials_ai against the local mock LLM server: serial vs concurrent requests, packing
+several trials per prompt, a second run served from the response cache, and the rule-based prefilter stage.
+
+Run from the repository root:
+    python -m benchmarks.bench_llm_matching --patients 10 --trials 30 --latency 0.3
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+
+from benchmarks.mock_llm_server import MockLLM, start_server
+from benchmarks.synthetic import write_synthetic_inputs
+from patient_matching.match_algorithm_ai import match_patients_to_trials_ai
+
+
+def run(label, patient_csv, trial_csv, output, args, **kwargs):
+    start = time.perf_counter()
+    # The matcher prints every answer, keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        stats = match_patients_to_trials_ai(
+            patient_csv, trial_csv, output, patient_limit=args.patients, patient_offset=0,
+            trial_limit=args.trials, trial_offset=0, requests_per_second=args.rate, **kwargs
+        )
+    seconds = time.perf_counter() - start
+    print(f"  {label:<34} {seconds:8.2f} s  calls={stats['calls']:<5} cache_hits={stats['cache_hits']:<5} retries={stats['retries']:<3} "
+          f"pruned={stats['pruned_age_gender'] + stats['pruned_no_overlap'] + stats['pruned_top_k']}/{stats['pairs']}")
+    return open(output).read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=10)
+    parser.add_argument("--trials", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds the mock takes per request")
+    parser.add_argument("--throttle-every", type=int, default=50, help="Mock answers every Nth request with a 429")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--pack", type=int, default=10, help="Trials per prompt for the packed run")
+    parser.add_argument("--rate", type=float, default=50.0)
+    parser.add_argument("--top-k", type=int, default=5, help="Candidate trials per patient for the top-k run")
+    args = parser.parse_args()
+
+    server, api_base = start_server(MockLLM(args.latency, args.throttle_every))
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            patient_csv, trial_csv = write_synthetic_inputs(tmp, args.patients, args.trials)
+            cache_path = os.path.join(tmp, "llm_cache.sqlite")
+            output = os.path.join(tmp, "matched_patients_ai.json")
+
+            print(f"{args.patients} patients x {args.trials} trials, mock latency {args.latency}s")
+            run("no prefilter", patient_csv, trial_csv, output, args, max_concurrency=args.concurrency, prefilter=False, api_base=api_base)
+            run(f"prefilter, top {args.top_k}", patient_csv, trial_csv, output, args, max_concurrency=args.concurrency, top_k=args.top_k, api_base=api_base)
+            serial = run("serial (concurrency 1)", patient_csv, trial_csv, output, args, max_concurrency=1, api_base=api_base)
+            concurrent = run(f"concurrency {args.concurrency}", patient_csv, trial_csv, output, args, max_concurrency=args.concurrency, api_base=api_base)
+            run(f"concurrency {args.concurrency}, {args.pack} trials/prompt", patient_csv, trial_csv, output, args,
+                max_concurrency=args.concurrency, trials_per_prompt=args.pack, api_base=api_base)
+            run("cold cache", patient_csv, trial_csv, output, args, max_concurrency=args.concurrency, cache_path=cache_path, api_base=api_base)
+            cached = run("warm cache", patient_csv, trial_csv, output, args, max_concurrency=args.concurrency, cache_path=cache_path, api_base=api_base)
+            print(f"  identical output serial / concurrent / cached: {serial == concurrent == cached}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares the 'loop' and 'vectorized' engines of match_patients_to_trials on synthetic data and checks that both
+write the same matched_patients.json content.
+
+Run from the repository root:
+    python -m benchmarks.bench_match_engines --patients 1000 --trials 200
+"""
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import write_synthetic_inputs
+from patient_matching.match_algorithm import match_patients_to_trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-loop", action="store_true", help="Only time the vectorized engine (for large sizes)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        patient_csv, trial_csv = write_synthetic_inputs(tmp, args.patients, args.trials, args.seed)
+        engines = ["vectorized"] if args.skip_loop else ["loop", "vectorized"]
+
+        timings = {}
+        for engine in engines:
+            output = os.path.join(tmp, f"matched_{engine}.json")
+            start = time.perf_counter()
+            match_patients_to_trials(patient_csv, trial_csv, output, engine=engine)
+            timings[engine] = time.perf_counter() - start
+
+        print(f"{args.patients} patients x {args.trials} trials")
+        for engine, seconds in timings.items():
+            print(f"  {engine:<10} {seconds:9.3f} s")
+
+        if not args.skip_loop:
+            identical = filecmp.cmp(os.path.join(tmp, "matched_loop.json"), os.path.join(tmp, "matched_vectorized.json"), shallow=False)
+            print(f"  speedup    {timings['loop'] / timings['vectorized']:9.1f} x")
+            print(f"  identical output: {identical}")
+            if not identical:
+                raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures how match_patients_to_trials scales with the number of worker processes on synthetic data, both matching
+deduplicated patient profiles (the default) and patient by patient, with the same inputs and settings. Speedups are
+relative to one process of the same mode, and every run must write the same matched_patients.json.
+
+Run from the repository root:
+    python -m benchmarks.bench_parallel_scaling --patients 100000 --trials 500 --max-workers 32
+"""
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import write_synthetic_inputs
+from patient_matching.match_algorithm import match_patients_to_trials
+
+
+def worker_counts(max_workers):
+    # 1, 2, 4, ... up to max_workers, always including max_workers itself
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--trials", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        patient_csv, trial_csv = write_synthetic_inputs(tmp, args.patients, args.trials, args.seed)
+        # Build the compiled trials and patient store up front so every run starts from the same state
+        reference = os.path.join(tmp, "warmup.json")
+        match_patients_to_trials(patient_csv, trial_csv, reference)
+
+        print(f"{args.patients} patients x {args.trials} trials")
+        print(f"  {'mode':<13} {'workers':>7} {'seconds':>9} {'speedup':>8} {'identical':>9}")
+        all_identical = True
+        for deduplicate in (True, False):
+            mode = "deduplicated" if deduplicate else "per patient"
+            baseline = None
+            for workers in worker_counts(args.max_workers):
+                output = os.path.join(tmp, f"matched_{mode.replace(' ', '_')}_{workers}.json")
+                start = time.perf_counter()
+                match_patients_to_trials(patient_csv, trial_csv, output, workers=workers, deduplicate=deduplicate)
+                seconds = time.perf_counter() - start
+
+                if baseline is None:
+                    baseline = seconds
+                identical = filecmp.cmp(reference, output, shallow=False)
+                all_identical = all_identical and identical
+                print(f"  {mode:<13} {workers:>7} {seconds:>9.3f} {baseline / seconds:>7.2f}x {str(identical):>9}")
+
+        if not all_identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Measures the compact patient store on Synthea style data: its size against the processed patient dataframe, the
+number of distinct (age, gender, condition set) profiles, and the vectorized engine with and without profile
+deduplication. Checks that both write the same output.
+
+Run from the repository root:
+    python -m benchmarks.bench_patient_store --patients 100000 --trials 500
+"""
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_trials, write_synthea_csvs
+from patient_matching.data_preparation import process_patient_data_chunked
+from patient_matching.match_algorithm import match_patients_to_trials
+from patient_matching.patient_store import PatientStore
+from patient_matching.storage import file_hash, read_table, write_table
+
+
+def store_bytes(store):
+    arrays = (store.ages, store.genders, store.patient_profiles, store.profile_ages, store.profile_genders, store.profile_indptr, store.profile_terms)
+    return sum(array.nbytes for array in arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=50000)
+    parser.add_argument("--trials", type=int, default=500)
+    parser.add_argument("--max-conditions", type=int, default=8, help="Most conditions per generated patient, fewer give more shared profiles")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_synthea_csvs(os.path.join(tmp, "raw"), args.patients, args.seed, args.max_conditions)
+        patient_path = os.path.join(tmp, "patient_processed.parquet")
+        trial_path = os.path.join(tmp, "scraped_trials.parquet")
+        process_patient_data_chunked(os.path.join(tmp, "raw") + os.sep, patient_path)
+        write_table(generate_trials(args.trials, args.seed), trial_path)
+
+        patients = read_table(patient_path)
+        start = time.perf_counter()
+        store = PatientStore.build(patients, file_hash(patient_path))
+        build_seconds = time.perf_counter() - start
+        print(f"{len(store)} patients, {store.n_profiles} distinct profiles, {len(store.terms)} condition terms, built in {build_seconds:.2f} s")
+        print(f"  dataframe {patients.memory_usage(deep=True).sum() / 2**20:8.1f} MB   store arrays {store_bytes(store) / 2**20:8.1f} MB (plus ids and terms)")
+
+        outputs = []
+        for deduplicate in (False, True):
+            output = os.path.join(tmp, f"matched_{deduplicate}.json")
+            start = time.perf_counter()
+            match_patients_to_trials(patient_path, trial_path, output, deduplicate=deduplicate)
+            print(f"  {'deduplicated' if deduplicate else 'per patient':<14} {time.perf_counter() - start:8.2f} s")
+            outputs.append(output)
+
+        identical = filecmp.cmp(*outputs, shallow=False)
+        print(f"  identical output: {identical}")
+        if not identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
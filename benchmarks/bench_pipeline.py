@@ -0,0 +1,87 @@
+"""
+Compares the sequential steps of main.py with the pipelined runner on synthetic Synthea CSVs and trials served by
+the local ClinicalTrials.gov stand-in (with latency), and checks that both write the same output.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline --patients 100000 --trials 200 --latency 0.2
+"""
+import argparse
+import filecmp
+import os
+import tempfile
+import time
+
+from benchmarks.ctgov_stub_server import StubApi, start_server
+from benchmarks.synthetic import write_synthea_csvs
+from patient_matching.data_preparation import process_patient_data_chunked
+from patient_matching.match_algorithm import match_patients_to_trials
+from patient_matching.metrics import METRICS, timer
+from patient_matching.pipeline import run_pipelined
+from patient_matching.scraping import write_trials_table
+from patient_matching.trial_ingestion import ingest_clinical_trials, iter_trial_pages
+
+
+def run_sequential(raw_dir, out_dir, base_url, page_limit, workers, rate):
+    # The steps of main.py, one after the other
+    with timer('scrape'):
+        trials = ingest_clinical_trials(page_limit, max_workers=workers, requests_per_second=rate, base_url=base_url)
+    with timer('write'):
+        write_trials_table(os.path.join(out_dir, "scraped_trials.parquet"), trials)
+    with timer('prepare'):
+        process_patient_data_chunked(raw_dir, os.path.join(out_dir, "patient_processed.parquet"))
+    with timer('match'):
+        match_patients_to_trials(os.path.join(out_dir, "patient_processed.parquet"), os.path.join(out_dir, "scraped_trials.parquet"),
+                                 os.path.join(out_dir, "matched_patients.json"))
+
+def run_pipeline(raw_dir, out_dir, base_url, page_limit, workers, rate):
+    run_pipelined(
+        raw_dir, os.path.join(out_dir, "patient_processed.parquet"), os.path.join(out_dir, "scraped_trials.parquet"),
+        os.path.join(out_dir, "matched_patients.json"),
+        trial_pages=iter_trial_pages(page_limit, max_workers=workers, requests_per_second=rate, base_url=base_url),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--trials", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds added to every stub response")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent detail requests")
+    parser.add_argument("--rate", type=float, default=100.0, help="Requests per second allowed by the rate limiter")
+    args = parser.parse_args()
+
+    page_limit = -(-args.trials // 10)
+    with tempfile.TemporaryDirectory() as tmp:
+        raw_dir = os.path.join(tmp, "raw")
+        write_synthea_csvs(raw_dir, args.patients)
+        raw_dir += os.sep
+        print(f"{args.patients} patients, {args.trials} trials, {args.latency}s latency, {args.workers} request workers")
+
+        outputs = []
+        for label, run in (("sequential", run_sequential), ("pipelined", run_pipeline)):
+            out_dir = os.path.join(tmp, label)
+            os.makedirs(out_dir)
+            server, base_url = start_server(StubApi(args.trials, args.latency))
+            METRICS.reset()
+            try:
+                start = time.perf_counter()
+                run(raw_dir, out_dir, base_url, page_limit, args.workers, args.rate)
+                seconds = time.perf_counter() - start
+            finally:
+                server.shutdown()
+            steps = {name: timer["seconds"] for name, timer in METRICS.to_dict()["timers"].items()}
+            step_text = "  ".join(f"{name} {steps[name]:.2f}s" for name in ("scrape", "pipeline.scrape", "prepare", "match", "pipeline.match_batch") if name in steps)
+            print(f"  {label:<12} {seconds:8.2f} s   {step_text}")
+            outputs.append(out_dir)
+
+        same = all(
+            filecmp.cmp(os.path.join(outputs[0], name), os.path.join(outputs[1], name), shallow=False)
+            for name in ("matched_patients.json", "patient_processed.parquet", "scraped_trials.parquet")
+        )
+        print(f"  identical output: {same}")
+        if not same:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,53 @@
+"""
+Compares CSV, Parquet and Arrow IPC for the intermediate pipeline tables (patient_processed / scraped_trials):
+file size, write time and load time through storage.read_table.
+
+Run from the repository root:
+    python -m benchmarks.bench_storage_formats --patients 200000 --trials 5000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.synthetic import generate_processed_patients, generate_trials
+from patient_matching.storage import read_table, write_table
+
+FORMATS = ("csv", "parquet", "arrow")
+
+
+def time_call(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, default=100000)
+    parser.add_argument("--trials", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Loads are repeated and the best time is reported")
+    args = parser.parse_args()
+
+    tables = {
+        "patient_processed": generate_processed_patients(args.patients, args.seed),
+        "scraped_trials": generate_trials(args.trials, args.seed),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'table':<18} {'format':<8} {'size MB':>9} {'write s':>9} {'load s':>9}")
+        for name, df in tables.items():
+            for fmt in FORMATS:
+                path = os.path.join(tmp, f"{name}.{fmt}")
+                write_seconds = time_call(lambda: write_table(df, path), 1)
+                load_seconds = time_call(lambda: read_table(path), args.repeat)
+                size_mb = os.path.getsize(path) / 1e6
+                print(f"{name:<18} {fmt:<8} {size_mb:>9.2f} {write_seconds:>9.3f} {load_seconds:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
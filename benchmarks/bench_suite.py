@@ -0,0 +1,197 @@
+"""
+Reproducible benchmark harness for the pipeline stages at configurable scales. Every measurement runs in a fresh
+process so its peak memory is not inflated by earlier runs; inputs are generated once per scale (seeded) and reused.
+
+Stages:
+    prepare          load_and_process_patient_data on raw Synthea style patients.csv / conditions.csv
+    prepare_chunked  process_patient_data_chunked on the same files, written as Parquet
+    match            match_patients_to_trials on processed patients x trials (Parquet inputs), cold: every run starts
+                     from a fresh copy of the inputs, without the patient store and compiled trials a previous run
+                     saved next to them
+    write_trials     write_trials_to_csv of scraped trial dicts
+
+Results (time, peak RSS, rows or output size) are written as JSON together with the git commit and library versions, and can be
+compared with the results of another version.
+
+Run from the repository root:
+    python -m benchmarks.bench_suite --patients 1000 10000 100000 --trials 100 1000 --output bench_results.json
+    python -m benchmarks.bench_suite --patients 1000 10000 --trials 100 --compare bench_results.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import generate_scraped_trials, generate_trials, write_processed_patients, write_synthea_csvs
+from patient_matching.data_preparation import load_and_process_patient_data, process_patient_data_chunked
+from patient_matching.match_algorithm import match_patients_to_trials
+from patient_matching.metrics import peak_rss_mb
+from patient_matching.scraping import write_trials_to_csv
+from patient_matching.storage import write_table
+
+STAGES = ("prepare", "prepare_chunked", "match", "write_trials")
+
+
+def _prepare_inputs(data_dir, n_patients, n_trials, stage, seed):
+    """ Generates the inputs of one measurement unless they already exist, returns their paths """
+    paths = {}
+    if stage in ("prepare", "prepare_chunked"):
+        raw_dir = os.path.join(data_dir, f"raw_{n_patients}")
+        if not os.path.exists(os.path.join(raw_dir, "conditions.csv")):
+            write_synthea_csvs(raw_dir, n_patients, seed)
+        paths["raw_dir"] = raw_dir + os.sep
+    if stage == "match":
+        paths["patients"] = os.path.join(data_dir, f"patient_processed_{n_patients}.parquet")
+        paths["trials"] = os.path.join(data_dir, f"scraped_trials_{n_trials}.parquet")
+        if not os.path.exists(paths["patients"]):
+            write_processed_patients(paths["patients"], n_patients, seed)
+        if not os.path.exists(paths["trials"]):
+            write_table(generate_trials(n_trials, seed), paths["trials"])
+    return paths
+
+def _copy_inputs(paths, work_dir):
+    # The matcher saves its store, compiled trials and index next to its inputs, fresh copies keep every run cold
+    copies = dict(paths)
+    for key in ("patients", "trials"):
+        if key in paths:
+            copies[key] = shutil.copy(paths[key], work_dir)
+    return copies
+
+def _run_stage(stage, paths, n_trials, seed, work_dir, options, queue):
+    # Runs in a fresh process, the baseline is the memory of the interpreter and the imports
+    baseline = peak_rss_mb()
+    if stage == "write_trials":
+        trial_dicts = generate_scraped_trials(n_trials, seed)
+        baseline = peak_rss_mb()
+    if options["tracemalloc"]:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    rows = output_bytes = None
+    if stage == "prepare":
+        rows = len(load_and_process_patient_data(paths["raw_dir"]))
+    elif stage == "prepare_chunked":
+        rows = process_patient_data_chunked(paths["raw_dir"], os.path.join(work_dir, "patient_processed.parquet"))
+    elif stage == "match":
+        output_path = os.path.join(work_dir, "matched_patients.json")
+        match_patients_to_trials(paths["patients"], paths["trials"], output_path, engine=options["engine"], workers=options["workers"])
+        output_bytes = os.path.getsize(output_path)
+    elif stage == "write_trials":
+        write_trials_to_csv(os.path.join(work_dir, "scraped_trials.csv"), trial_dicts)
+        rows = n_trials
+    seconds = time.perf_counter() - start
+
+    result = {"seconds": seconds, "peak_rss_mb": peak_rss_mb(), "baseline_rss_mb": baseline, "rows": rows, "output_bytes": output_bytes}
+    if options["tracemalloc"]:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+    queue.put(result)
+
+def measure(stage, n_patients, n_trials, data_dir, seed, options):
+    """ Times one stage at one scale in a fresh process, best of options['repeat'] runs """
+    paths = _prepare_inputs(data_dir, n_patients, n_trials, stage, seed)
+    context = multiprocessing.get_context("spawn")
+    best = None
+    for _ in range(options["repeat"]):
+        with tempfile.TemporaryDirectory() as work_dir:
+            queue = context.Queue()
+            process = context.Process(target=_run_stage, args=(stage, _copy_inputs(paths, work_dir), n_trials, seed, work_dir, options, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                # Typically the OOM killer at the largest scales
+                return {"error": f"exit code {process.exitcode}"}
+            result = queue.get()
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+def scales(stage, patient_scales, trial_scales, max_pairs):
+    if stage in ("prepare", "prepare_chunked"):
+        return [(n, None) for n in patient_scales]
+    if stage == "write_trials":
+        return [(None, n) for n in trial_scales]
+    return [(p, t) for p in patient_scales for t in trial_scales if p * t <= max_pairs]
+
+def compare(results, baseline_path):
+    """ Prints the time and memory ratios against the results of another run, ratios above 1 are slower / larger """
+    with open(baseline_path) as f:
+        baseline = {(r["stage"], r["patients"], r["trials"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        previous = baseline.get((result["stage"], result["patients"], result["trials"]))
+        if previous is None or "seconds" not in previous or "seconds" not in result:
+            continue
+        memory = ""
+        if result.get("peak_rss_mb") and previous.get("peak_rss_mb"):
+            memory = f"  peak RSS x{result['peak_rss_mb'] / previous['peak_rss_mb']:.2f}"
+        print(f"  {result['stage']:<16} patients={result['patients']!s:<9} trials={result['trials']!s:<7} time x{result['seconds'] / previous['seconds']:.2f}{memory}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--patients", type=int, nargs="+", default=[1000, 10000], help="Patient scales (up to 10^7)")
+    parser.add_argument("--trials", type=int, nargs="+", default=[100, 1000], help="Trial scales (up to 10^5)")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--max-pairs", type=float, default=1e9, help="Match scales with more patient x trial pairs are skipped")
+    parser.add_argument("--engine", choices=("vectorized", "loop"), default="vectorized")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per measurement, the fastest is reported")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the peak of Python allocations (slower)")
+    parser.add_argument("--data-dir", help="Where generated inputs are kept between runs, a temporary folder by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Results JSON of another run to compare against")
+    args = parser.parse_args()
+
+    options = {"engine": args.engine, "workers": args.workers, "repeat": args.repeat, "tracemalloc": args.tracemalloc}
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or tmp
+        os.makedirs(data_dir, exist_ok=True)
+        for stage in args.stages:
+            for n_patients, n_trials in scales(stage, args.patients, args.trials, args.max_pairs):
+                result = {"stage": stage, "patients": n_patients, "trials": n_trials, **measure(stage, n_patients, n_trials, data_dir, args.seed, options)}
+                results.append(result)
+                if "error" in result:
+                    print(f"  {stage:<16} patients={n_patients!s:<9} trials={n_trials!s:<7} failed: {result['error']}")
+                else:
+                    rss = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MB"
+                    print(f"  {stage:<16} patients={n_patients!s:<9} trials={n_trials!s:<7} {result['seconds']:9.3f} s  peak RSS {rss}")
+
+    with open(args.output, "w") as f:
+        json.dump({"environment": environment(), "options": options, "results": results}, f, indent=4)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
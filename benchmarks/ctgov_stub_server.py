@@ -0,0 +1,113 @@
+"""
+Local stand-in for the ClinicalTrials.gov API used by trial_ingestion. Serves the saved study documents in
+benchmarks/fixtures/ctgov, optionally replicated to many NCT ids, with configurable latency and transient 503 errors
+so ingestion can be exercised and benchmarked offline.
+
+Run from the repository root:
+    python -m benchmarks.ctgov_stub_server --port 8765 --trials 200 --latency 0.2
+and point the ingestion at it with base_url="http://127.0.0.1:8765/api/v2".
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "ctgov")
+
+
+def load_fixture_documents():
+    """ The saved study documents, in NCT id order """
+    return [json.load(open(path)) for path in sorted(glob.glob(os.path.join(FIXTURE_DIR, "NCT*.json")))]
+
+
+class StubApi:
+    def __init__(self, n_trials=None, latency=0.0, fail_every=0):
+        fixtures = load_fixture_documents()
+        self.documents = {}
+        if n_trials is None:
+            # The fixtures as they are
+            for document in fixtures:
+                self.documents[document["protocolSection"]["identificationModule"]["nctId"]] = document
+        else:
+            # Copies of the fixtures under synthetic ids
+            for i in range(n_trials):
+                document = copy.deepcopy(fixtures[i % len(fixtures)])
+                nct_id = f"NCT9{i:07d}"
+                document["protocolSection"]["identificationModule"]["nctId"] = nct_id
+                self.documents[nct_id] = document
+        self.ids = list(self.documents)
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handle(self, path, query):
+        with self.lock:
+            self.requests += 1
+            request_number = self.requests
+        time.sleep(self.latency)
+        if self.fail_every and request_number % self.fail_every == 0:
+            return 503, {"message": "transient failure"}
+
+        if path.rstrip("/").endswith("/studies"):
+            page_size = int(query.get("pageSize", ["10"])[0])
+            start = int(query.get("pageToken", ["0"])[0])
+            page_ids = self.ids[start:start + page_size]
+            body = {"studies": [{"protocolSection": {"identificationModule": {"nctId": nct_id}}} for nct_id in page_ids]}
+            if start + page_size < len(self.ids):
+                body["nextPageToken"] = str(start + page_size)
+            return 200, body
+
+        nct_id = path.rstrip("/").rsplit("/", 1)[-1]
+        if nct_id in self.documents:
+            return 200, self.documents[nct_id]
+        return 404, {"message": f"{nct_id} not found"}
+
+
+def start_server(api, port=0):
+    """ Starts the stub in a background thread and returns (server, base_url) """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            status, body = api.handle(url.path, parse_qs(url.query))
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/api/v2"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--trials", type=int, default=None, help="Replicate the fixtures to this many trials")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--fail-every", type=int, default=0, help="Answer every Nth request with a 503")
+    args = parser.parse_args()
+
+    server, base_url = start_server(StubApi(args.trials, args.latency, args.fail_every), args.port)
+    print(f"Serving {base_url}, press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
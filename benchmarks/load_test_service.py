@@ -0,0 +1,128 @@
+"""
+Load test of the matching service. Starts the service on a synthetic trial table, sends single-patient and batch
+queries from concurrent clients, hot-reloads a changed trial table in the middle of the run, and reports client and
+server side p50 / p99 latencies. Checks that the answers match the batch matcher and that no request failed.
+
+Run from the repository root:
+    python -m benchmarks.load_test_service --trials 2000 --requests 2000 --clients 8
+or against an already running service:
+    python -m benchmarks.load_test_service --url http://127.0.0.1:8000 --requests 2000
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import generate_processed_patients, generate_trials
+from patient_matching.match_algorithm import iter_dataframe_matches
+from patient_matching.service import MatchingService, start_service
+from patient_matching.storage import write_table
+
+
+def post(url, body):
+    request = urllib.request.Request(url, json.dumps(body).encode('utf-8'), {"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.loads(response.read())
+
+def patient_payload(row):
+    return {"Id": row["Id"], "AGE": None if np.isnan(row["AGE"]) else float(row["AGE"]), "GENDER": row["GENDER"], "CONDITIONS": row["CONDITIONS"]}
+
+
+def run_load(base_url, payloads, clients, batch_size):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def send(i):
+        start = time.perf_counter()
+        try:
+            if batch_size > 1:
+                result = post(f"{base_url}/match/batch", {"patients": payloads[i:i + batch_size]})["results"]
+            else:
+                result = [post(f"{base_url}/match", payloads[i])]
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return []
+        with lock:
+            latencies.append(time.perf_counter() - start)
+        return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        results = [record for records in pool.map(send, range(0, len(payloads), batch_size)) for record in records]
+    seconds = time.perf_counter() - start
+    return results, np.array(latencies) * 1000, errors, seconds
+
+def report(label, latencies, errors, seconds):
+    print(f"  {label:<22} {len(latencies) / seconds:8.0f} req/s  p50 {np.percentile(latencies, 50):7.2f} ms  "
+          f"p99 {np.percentile(latencies, 99):7.2f} ms  errors {len(errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Base URL of a running service, a local one on synthetic trials is started otherwise")
+    parser.add_argument("--trials", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    patients = generate_processed_patients(args.requests, seed=1)
+    payloads = [patient_payload(row) for row in patients.to_dict('records')]
+
+    if args.url:
+        base_url = args.url.rstrip('/')
+        _, latencies, errors, seconds = run_load(base_url, payloads, args.clients, 1)
+        report("single", latencies, errors, seconds)
+        _, latencies, errors, seconds = run_load(base_url, payloads, args.clients, args.batch_size)
+        report(f"batch of {args.batch_size}", latencies, errors, seconds)
+        print(f"  server: {get(f'{base_url}/stats')}")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        trial_path = os.path.join(tmp, "scraped_trials.parquet")
+        trials = generate_trials(args.trials, seed=0)
+        write_table(trials, trial_path)
+
+        load_start = time.perf_counter()
+        service = MatchingService(trial_path)
+        print(f"{args.trials} trials loaded in {time.perf_counter() - load_start:.2f} s, {args.requests} patients, {args.clients} clients")
+        server, base_url = start_service(service, port=0)
+        try:
+            results, latencies, errors, seconds = run_load(base_url, payloads, args.clients, 1)
+            report("single", latencies, errors, seconds)
+
+            expected = {record["patientId"]: record["eligibleTrials"] for record in iter_dataframe_matches(patients, trials)}
+            same = all(record["eligibleTrials"] == expected.get(record["patientId"], []) for record in results)
+            print(f"  identical to the batch matcher: {same}")
+
+            # Hot reload with a different trial table while batch queries are running
+            reloaded_trials = generate_trials(args.trials, seed=1)
+            def swap():
+                time.sleep(0.2)
+                write_table(reloaded_trials, trial_path)
+                service.reload()
+            swapper = threading.Thread(target=swap)
+            swapper.start()
+            _, latencies, errors, seconds = run_load(base_url, payloads, args.clients, args.batch_size)
+            swapper.join()
+            report(f"batch of {args.batch_size} + reload", latencies, errors, seconds)
+
+            print(f"  server: {get(f'{base_url}/stats')}")
+        finally:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,106 @@
+"""
+Local mock of the OpenAI chat completions endpoint for benchmarking the AI matcher without network access or cost.
+Answers are deterministic: a patient-trial pair is eligible when a hash of the trial id and the patient line is
+divisible by 3. Packed prompts get one '<trial ID>: yes/no' line per trial. Latency, throttling (429) and server
+errors (503) can be added.
+
+Run from the repository root:
+    python -m benchmarks.mock_llm_server --port 8766 --latency 0.5
+and pass api_base="http://127.0.0.1:8766/v1" to match_patients_to_trials_ai.
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TRIAL_ID_PATTERN = re.compile(r'ID (\S+),')
+PATIENT_PATTERN = re.compile(r'Patient: (.*)')
+
+
+def answer_for(patient_line, trial_id):
+    digest = hashlib.md5(f"{trial_id}|{patient_line}".encode("utf-8")).hexdigest()
+    return "yes - Age criteria met, Gender criteria met" if int(digest, 16) % 3 == 0 else "no"
+
+
+class MockLLM:
+    def __init__(self, latency=0.0, throttle_every=0, error_every=0):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.error_every = error_every
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def handle(self, body):
+        with self.lock:
+            self.requests += 1
+            request_number = self.requests
+        time.sleep(self.latency)
+        if self.throttle_every and request_number % self.throttle_every == 0:
+            return 429, {"error": {"message": "Rate limit reached", "type": "requests"}}
+        if self.error_every and request_number % self.error_every == 0:
+            return 503, {"error": {"message": "The server is overloaded", "type": "server_error"}}
+
+        prompt = body["messages"][-1]["content"]
+        patient = PATIENT_PATTERN.search(prompt)
+        patient_line = patient.group(1).strip() if patient else ""
+        trial_ids = TRIAL_ID_PATTERN.findall(prompt)
+        if len(trial_ids) == 1:
+            content = answer_for(patient_line, trial_ids[0])
+        else:
+            content = "\n".join(f"{trial_id}: {answer_for(patient_line, trial_id)}" for trial_id in trial_ids)
+
+        return 200, {
+            "id": f"chatcmpl-mock-{request_number}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4, "total_tokens": (len(prompt) + len(content)) // 4},
+        }
+
+
+def start_server(mock, port=0):
+    """ Starts the mock in a background thread and returns (server, api_base) """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            status, body = mock.handle(json.loads(self.rfile.read(length)))
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--throttle-every", type=int, default=0, help="Answer every Nth request with a 429")
+    parser.add_argument("--error-every", type=int, default=0, help="Answer every Nth request with a 503")
+    args = parser.parse_args()
+
+    server, api_base = start_server(MockLLM(args.latency, args.throttle_every, args.error_every), args.port)
+    print(f"Serving {api_base}, press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
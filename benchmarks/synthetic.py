@@ -0,0 +1,224 @@
+"""
+Synthetic data generator for the benchmarks. Produces raw Synthea style patients.csv / conditions.csv, processed patient
+tables and scraped trial tables with the same columns as patient_processed.csv and scraped_trials.csv, so the pipeline
+can be timed without the Synthea download or scraping.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from patient_matching.storage import TableWriter
+
+# A sample of condition descriptions as they appear in Synthea's conditions.csv
+CONDITION_VOCABULARY = [
+    "Hypertension", "Prediabetes", "Anemia (disorder)", "Chronic sinusitis (disorder)", "Body mass index 30+ - obesity (finding)",
+    "Diabetes", "Hyperlipidemia", "Osteoarthritis of knee", "Asthma", "Childhood asthma", "Chronic obstructive bronchitis (disorder)",
+    "Coronary Heart Disease", "Chronic kidney disease stage 1 (disorder)", "Chronic kidney disease stage 2 (disorder)",
+    "Atrial Fibrillation", "Alzheimer's disease (disorder)", "Migraine", "Sprain of ankle", "Acute bronchitis (disorder)",
+    "Viral sinusitis (disorder)", "Streptococcal sore throat (disorder)", "Otitis media", "Concussion with no loss of consciousness",
+    "Fracture of forearm", "Major depression disorder", "Generalized anxiety disorder", "Stress (finding)", "Chronic pain",
+    "Drug overdose", "Neoplasm of prostate", "Malignant neoplasm of breast (disorder)", "Non-small cell lung cancer (disorder)",
+    "Hypothyroidism", "Rheumatoid arthritis", "Osteoporosis (disorder)", "Seizure disorder", "Epilepsy", "Sepsis caused by virus (disorder)",
+    "COVID-19", "Suspected COVID-19", "Pneumonia (disorder)", "Chronic congestive heart failure (disorder)", "Ischemic heart disease (disorder)",
+    "Impacted molars", "Gingivitis (disorder)", "Miscarriage in first trimester", "Normal pregnancy", "Anemia", "Obesity", "Sleep apnea",
+]
+
+# Free text criteria that never equals a patient condition, mirroring real eligibility criteria sentences
+FREE_TEXT_CRITERIA = [
+    "Able to provide written informed consent", "Willing to comply with all study procedures",
+    "Participation in another interventional study within 30 days", "Known hypersensitivity to the study drug",
+    "Pregnant or breastfeeding", "ECOG performance status 0 or 1", "Adequate organ function",
+    "Life expectancy of less than 6 months", "Any condition that in the opinion of the investigator would interfere",
+]
+
+AGE_CRITERIA = [
+    "18 Years and older (Adult_ Older Adult)", "18 Years to 65 Years (Adult_ Older Adult)", "Child_ Adult_ Older Adult",
+    "65 Years and older (Older Adult)", "12 Years to 17 Years (Child)", "40 Years to 80 Years (Adult_ Older Adult)",
+    "6 Months to 17 Years (Child)", "up to 17 Years (Child)",
+]
+
+SEX_CRITERIA = ["All", "All", "All", "Female", "Male"]
+
+
+def _join_sample(rng, population, low, high):
+    size = rng.integers(low, high + 1)
+    if size == 0:
+        return ''
+    return ' - '.join(rng.choice(population, size=size, replace=False))
+
+
+def _processed_chunk(rng, first_index, n_patients):
+    return pd.DataFrame({
+        "Id": [f"patient-{first_index + i:08d}" for i in range(n_patients)],
+        "PREFIX": rng.choice(["Mr.", "Mrs.", "Ms.", ""], size=n_patients),
+        "FIRST": rng.choice(["Alex", "Sam", "Jordan", "Taylor", "Robin"], size=n_patients),
+        "LAST": rng.choice(["Smith", "Garcia", "Nguyen", "Miller", "Khan"], size=n_patients),
+        "GENDER": rng.choice(["M", "F"], size=n_patients),
+        "AGE": rng.integers(0, 100, size=n_patients),
+        "CONDITIONS": [_join_sample(rng, CONDITION_VOCABULARY, 1, 6) for _ in range(n_patients)],
+        "PREVIOUS_CONDITIONS": [_join_sample(rng, CONDITION_VOCABULARY, 0, 4) for _ in range(n_patients)],
+    })
+
+def generate_processed_patients(n_patients, seed=0):
+    """
+    Generates a table with the columns of patient_processed.csv.
+
+    Args:
+        n_patients (int): Number of patients to generate.
+        seed (int): Seed of the random generator, the same seed always gives the same table.
+
+    Returns:
+        dataframe: Synthetic processed patient data.
+
+    """
+    return _processed_chunk(np.random.default_rng(seed), 0, n_patients)
+
+def write_processed_patients(path, n_patients, seed=0, chunk_size=100_000):
+    """
+    Writes a processed patient table (.csv, .parquet or .arrow) generated chunk by chunk, so even 10^7 patients are
+    written with bounded memory. Up to chunk_size patients, the table is the same as generate_processed_patients.
+
+    Args:
+        path (str): Path of the table to write.
+        n_patients (int): Number of patients to generate.
+        seed (int): Seed of the random generator, the same seed always gives the same table.
+        chunk_size (int): Number of patients generated and written at a time.
+
+    Returns:
+        str: The path of the written table.
+
+    """
+    rng = np.random.default_rng(seed)
+    with TableWriter(path) as writer:
+        for start in range(0, n_patients, chunk_size):
+            writer.write(_processed_chunk(rng, start, min(chunk_size, n_patients - start)))
+    return path
+
+
+def generate_trials(n_trials, seed=0):
+    """
+    Generates a table with the columns of scraped_trials.csv.
+
+    Args:
+        n_trials (int): Number of trials to generate.
+        seed (int): Seed of the random generator, the same seed always gives the same table.
+
+    Returns:
+        dataframe: Synthetic clinical trial data.
+
+    """
+    rng = np.random.default_rng(seed + 1)
+    criteria_population = CONDITION_VOCABULARY + FREE_TEXT_CRITERIA
+    return pd.DataFrame({
+        "trialId": [f"NCT{i:08d}" for i in range(n_trials)],
+        "trialTitle": [f"Synthetic Study {i}" for i in range(n_trials)],
+        "inclusionCriteria": [_join_sample(rng, criteria_population, 1, 5) for _ in range(n_trials)],
+        "exclusionCriteria": [_join_sample(rng, criteria_population, 0, 5) for _ in range(n_trials)],
+        "age_criteria": rng.choice(AGE_CRITERIA, size=n_trials),
+        "sex_criteria": rng.choice(SEX_CRITERIA, size=n_trials),
+        "healthy_volunteers_allowed": rng.choice(["Yes", "No"], size=n_trials),
+        "conditions": [_join_sample(rng, CONDITION_VOCABULARY, 1, 3) for _ in range(n_trials)],
+    })
+
+
+def write_synthetic_inputs(directory, n_patients, n_trials, seed=0):
+    """
+    Writes a synthetic patient_processed.csv and scraped_trials.csv into a directory.
+
+    Returns:
+        tuple(str, str): Paths of the patient CSV and the trial CSV.
+
+    """
+    patient_csv_path = f"{directory}/patient_processed.csv"
+    trial_csv_path = f"{directory}/scraped_trials.csv"
+    generate_processed_patients(n_patients, seed).to_csv(patient_csv_path, index=False)
+    generate_trials(n_trials, seed).to_csv(trial_csv_path, index=False)
+    return patient_csv_path, trial_csv_path
+
+
+def generate_scraped_trials(n_trials, seed=0):
+    """ The trials of generate_trials as the trial dicts returned by scrape_clinical_trials / ingest_clinical_trials """
+    return [
+        {
+            "trialId": trial["trialId"],
+            "trialTitle": trial["trialTitle"],
+            "detailedInfo": {"inclusionCriteria": trial["inclusionCriteria"], "exclusionCriteria": trial["exclusionCriteria"]},
+            "age_criteria": trial["age_criteria"],
+            "sex_criteria": trial["sex_criteria"],
+            "healthy_volunteers_allowed": trial["healthy_volunteers_allowed"],
+            "conditions": trial["conditions"],
+        }
+        for trial in generate_trials(n_trials, seed).to_dict('records')
+    ]
+
+
+def _synthea_chunk(rng, first_index, n_patients, max_conditions):
+    ids = [f"{first_index + i:08x}-5e3a-4c1b-9f2d-{seed_suffix:012x}" for i, seed_suffix in enumerate(rng.integers(0, 2**48, size=n_patients))]
+    birthdates = pd.Timestamp("1925-01-01") + pd.to_timedelta(rng.integers(0, 100 * 365, size=n_patients), unit="D")
+    died = rng.random(n_patients) < 0.05
+    deathdates = np.where(died, (birthdates + pd.to_timedelta(rng.integers(365, 80 * 365, size=n_patients), unit="D")).strftime("%Y-%m-%d"), "")
+
+    patients = pd.DataFrame({
+        "Id": ids,
+        "BIRTHDATE": birthdates.strftime("%Y-%m-%d"),
+        "DEATHDATE": deathdates,
+        "SSN": [f"999-{a:02d}-{b:04d}" for a, b in zip(rng.integers(10, 100, size=n_patients), rng.integers(0, 10000, size=n_patients))],
+        "PREFIX": rng.choice(["Mr.", "Mrs.", "Ms.", ""], size=n_patients),
+        "FIRST": rng.choice(["Alex", "Sam", "Jordan", "Taylor", "Robin"], size=n_patients),
+        "LAST": rng.choice(["Smith", "Garcia", "Nguyen", "Miller", "Khan"], size=n_patients),
+        "MARITAL": rng.choice(["M", "S", ""], size=n_patients),
+        "RACE": rng.choice(["white", "black", "asian", "native", "other"], size=n_patients),
+        "ETHNICITY": rng.choice(["hispanic", "nonhispanic"], size=n_patients),
+        "GENDER": rng.choice(["M", "F"], size=n_patients),
+        "CITY": rng.choice(["Boston", "Worcester", "Springfield", "Lowell"], size=n_patients),
+        "STATE": "Massachusetts",
+    })
+
+    # Most patients have a few conditions, some none at all
+    counts = rng.integers(0, max_conditions + 1, size=n_patients)
+    rows = int(counts.sum())
+    starts = pd.Timestamp("2000-01-01") + pd.to_timedelta(rng.integers(0, 24 * 365, size=rows), unit="D")
+    resolved = rng.random(rows) < 0.5
+    stops = np.where(resolved, (starts + pd.to_timedelta(rng.integers(7, 365, size=rows), unit="D")).strftime("%Y-%m-%d"), "")
+    codes = rng.integers(0, len(CONDITION_VOCABULARY), size=rows)
+
+    conditions = pd.DataFrame({
+        "START": starts.strftime("%Y-%m-%d"),
+        "STOP": stops,
+        "PATIENT": np.repeat(ids, counts),
+        "ENCOUNTER": [f"enc-{first_index:08x}-{i:08x}" for i in range(rows)],
+        "CODE": 100000 + codes,
+        "DESCRIPTION": np.array(CONDITION_VOCABULARY, dtype=object)[codes],
+    })
+    return patients, conditions
+
+def write_synthea_csvs(directory, n_patients, seed=0, max_conditions=8, chunk_size=100_000):
+    """
+    Writes a raw Synthea style patients.csv and conditions.csv into a directory, generated chunk by chunk so even
+    10^7 patients are written with bounded memory. Dead patients, resolved (STOP) conditions and patients without
+    conditions are included, so every branch of the patient preparation is exercised.
+
+    Args:
+        directory (str): Folder the CSV files are written to, created when missing.
+        n_patients (int): Number of patients to generate.
+        seed (int): Seed of the random generator, the same seed always gives the same files.
+        max_conditions (int): Maximum number of condition rows per patient.
+        chunk_size (int): Number of patients generated and written at a time.
+
+    Returns:
+        tuple(str, str): Paths of patients.csv and conditions.csv.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    patients_path = os.path.join(directory, "patients.csv")
+    conditions_path = os.path.join(directory, "conditions.csv")
+    rng = np.random.default_rng(seed)
+
+    for start in range(0, n_patients, chunk_size):
+        patients, conditions = _synthea_chunk(rng, start, min(chunk_size, n_patients - start), max_conditions)
+        # Empty strings are written as empty fields, read back as NaN like Synthea's own exports
+        patients.to_csv(patients_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+        conditions.to_csv(conditions_path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+
+    return patients_path, conditions_path
\ No newline at end of file
@@ -1,24 +1,85 @@
-from patient_matching.data_preparation import load_and_process_patient_data
-from patient_matching.scraping import scrape_clinical_trials, write_trials_to_csv
+import argparse
+import cProfile
+import pstats
+
+from patient_matching.data_preparation import load_and_process_patient_data, process_patient_data_chunked
+from patient_matching.scraping import scrape_clinical_trials, write_trials_table
+from patient_matching.trial_ingestion import ingest_clinical_trials
+from patient_matching.storage import convert_table, write_table
 from patient_matching.match_algorithm import match_patients_to_trials
 from patient_matching.match_algorithm_ai import match_patients_to_trials_ai
+from patient_matching.incremental import match_patients_to_trials_incremental
+from patient_matching.metrics import METRICS, timer
+from patient_matching.pipeline import run_pipelined
 
-def main():
+def run_pipeline():
+
+    # Step 1: Fetch active clinical trials concurrently from the ClinicalTrials.gov API
+    # Trials fetched within the last day come from the on-disk cache
+    with timer('scrape'):
+        clinical_trials = ingest_clinical_trials(20, cache_path='output/trial_cache.sqlite')
+
+    # OR Step 1 (Selenium): Scrape active clinical trials from the search website
+    # with timer('scrape'):
+    #     clinical_trials = scrape_clinical_trials(20, cache_path='output/trial_cache.sqlite')
 
-    # Step 1: Scrape active clinical trials
-    clinical_trials = scrape_clinical_trials(20)
-    write_trials_to_csv('./output/scraped_trials.csv', clinical_trials)
+    with timer('write'):
+        write_trials_table('./output/scraped_trials.parquet', clinical_trials)
 
-    # Step 2: Load patient data
-    patient_processed_data = load_and_process_patient_data('data/csv/')
-    patient_processed_data.to_csv('output/patient_processed.csv', index=False)
+    # Step 2: Load patient data, streamed in chunks so the full Synthea export fits in memory
+    with timer('prepare'):
+        process_patient_data_chunked('data/csv/', 'output/patient_processed.parquet')
+
+    # OR Step 2 (in memory): Load all patient data at once, writes the same table
+    # patient_processed_data = load_and_process_patient_data('data/csv/')
+    # write_table(patient_processed_data, 'output/patient_processed.parquet')
+
+    # Optionally export the intermediate tables as CSV
+    # convert_table('output/patient_processed.parquet', 'output/patient_processed.csv')
+    # convert_table('./output/scraped_trials.parquet', './output/scraped_trials.csv')
 
     # Step 3: Run matching algorithm and generate output
-    match_patients_to_trials('output/patient_processed.csv', './output/scraped_trials.csv', 'output/matched_patients.json')
+    with timer('match'):
+        match_patients_to_trials('output/patient_processed.parquet', './output/scraped_trials.parquet', 'output/matched_patients.json')
+
+    # OR Step 3 (incremental): Only re-evaluate patients / trials that changed since the last run and patch the output
+    # match_patients_to_trials_incremental('output/patient_processed.parquet', './output/scraped_trials.parquet', 'output/matched_patients.json')
 
     # OR Step 3 (AI): Run matching algorithm using AI and generate output
-    # match_patients_to_trials_ai('output/patient_processed.csv', './output/scraped_trials.csv', 'output/matched_patients_ai.json')
+    # match_patients_to_trials_ai('output/patient_processed.parquet', './output/scraped_trials.parquet', 'output/matched_patients_ai.json',
+    #                             max_concurrency=8, cache_path='output/llm_cache.sqlite')
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrapes trials, prepares the patient data and matches patients to trials.")
+    parser.add_argument("--metrics-json", help="Writes the step timings and counters to this JSON file")
+    parser.add_argument("--metrics-prometheus", help="Writes the step timings and counters to this file in the Prometheus text format")
+    parser.add_argument("--pipelined", action="store_true", help="Runs the steps as overlapping stages, trials stream into the matcher while the patients are prepared")
+    parser.add_argument("--profile", help="Runs the pipeline under cProfile and writes the stats to this file (view with snakeviz or pstats)")
+    args = parser.parse_args()
+
+    if args.pipelined:
+        # Same API ingestion, patient preparation and matching as run_pipeline, with the same output files
+        run = lambda: run_pipelined('data/csv/', 'output/patient_processed.parquet', './output/scraped_trials.parquet', 'output/matched_patients.json',
+                                    page_limit=20, cache_path='output/trial_cache.sqlite')
+    else:
+        run = run_pipeline
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+        profiler.dump_stats(args.profile)
+        # The hot spots by cumulative time, the full stats are in the file
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    else:
+        run()
 
+    print(METRICS.summary())
+    if args.metrics_json:
+        METRICS.write_json(args.metrics_json)
+    if args.metrics_prometheus:
+        METRICS.write_prometheus(args.metrics_prometheus)
 
     print("Execution Completed!")
 
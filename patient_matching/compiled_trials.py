@@ -0,0 +1,216 @@
+import re
+import sys
+
+import numpy as np
+
+from patient_matching.condition_index import ConditionIndex
+from patient_matching.storage import artifact_path, load_or_build_artifact, read_table_snapshot, split_terms
+
+COMPILED_VERSION = 1
+
+# Sex criteria and patient genders as bits, a trial accepts a patient when their bits intersect. 'All' (SEX_ALL)
+# also accepts patients whose gender has no bit (0), like the original string check did
+SEX_MALE = 1
+SEX_FEMALE = 2
+SEX_ALL = SEX_MALE | SEX_FEMALE
+GENDER_BITS = {'M': SEX_MALE, 'F': SEX_FEMALE}
+
+# Age limits are compared in years, other units are converted
+AGE_UNITS_IN_YEARS = {
+    "year": 1.0,
+    "month": 1 / 12,
+    "week": 7 / 365.25,
+    "day": 1 / 365.25,
+    "hour": 1 / (24 * 365.25),
+    "minute": 1 / (60 * 24 * 365.25),
+}
+AGE_LIMIT_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*(year|month|week|day|hour|minute)?s?', re.IGNORECASE)
+# A single limit is a minimum ('18 Years and older') unless one of these words makes it a maximum
+UPPER_LIMIT_PATTERN = re.compile(r'\b(up to|under|below|less than|younger than|and younger)\b', re.IGNORECASE)
+
+
+def parse_age_criteria(age_criteria):
+    """
+    Parses an age criteria string into inclusive limits in years.
+
+    '18 Years and older' gives (18, inf), '18 Years to 65 Years (Adult, Older Adult)' gives (18, 65),
+    '6 Months to 17 Years' gives (0.5, 17) and 'up to 17 Years' gives (0, 17). Numbers without a unit are years.
+
+    Args:
+        age_criteria (str): The age criteria of a trial.
+
+    Returns:
+        tuple(float, float): Minimum and maximum age, (inf, -inf) for a missing or unusable criteria so no age satisfies it.
+
+    """
+    if not isinstance(age_criteria, str):
+        return np.inf, -np.inf
+
+    limits = [float(number) * AGE_UNITS_IN_YEARS[(unit or "year").lower()] for number, unit in AGE_LIMIT_PATTERN.findall(age_criteria)]
+
+    if len(limits) == 1:
+        if UPPER_LIMIT_PATTERN.search(age_criteria):
+            return 0.0, limits[0]
+        return limits[0], np.inf
+    elif len(limits) == 2:
+        return limits[0], limits[1]
+    return np.inf, -np.inf
+
+def parse_sex_criteria(sex_criteria):
+    """ Parses a sex criteria ('All', 'Male', 'Female') into a bitmask of SEX_MALE / SEX_FEMALE, 0 when missing """
+    if not isinstance(sex_criteria, str):
+        return 0
+    if sex_criteria.strip() == "All":
+        return SEX_ALL
+    words = set(re.findall(r'[a-z]+', sex_criteria.lower()))
+    return (SEX_MALE if 'male' in words else 0) | (SEX_FEMALE if 'female' in words else 0)
+
+def gender_bits(genders):
+    """ Patient genders ('M' / 'F') as an array of SEX_MALE / SEX_FEMALE bits, 0 for anything else """
+    return np.array([GENDER_BITS.get(gender, 0) for gender in genders], dtype=np.uint8)
+
+def default_compiled_path(trial_csv_path):
+    """ The compiled trials are stored next to the trial table, e.g. output/scraped_trials_compiled.npz """
+    return artifact_path(trial_csv_path, '_compiled.npz')
+
+
+class CompiledTrials:
+    """
+    Array-backed form of a trial table holding everything the matchers need, parsed once: the age limits in years,
+    the sex bitmask and the interned condition term ids of the inclusion and exclusion criteria (as CSR arrays: the
+    term ids of trial i are terms[indptr[i]:indptr[i + 1]]).
+    """
+
+    def __init__(self, age_min, age_max, sex_mask, terms, inclusion_indptr, inclusion_terms, exclusion_indptr, exclusion_terms, source_hash=None):
+        self.age_min = age_min
+        self.age_max = age_max
+        self.sex_mask = sex_mask
+        self.terms = [sys.intern(term) for term in terms]
+        self.inclusion_indptr = inclusion_indptr
+        self.inclusion_terms = inclusion_terms
+        self.exclusion_indptr = exclusion_indptr
+        self.exclusion_terms = exclusion_terms
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.sex_mask)
+
+    @classmethod
+    def compile(cls, trials, source_hash=None):
+        """
+        Compiles a trial dataframe.
+
+        Args:
+            trials (dataframe): Clinical trial data as written by write_trials_to_csv / write_trials_table.
+            source_hash (str): Optional hash of the file the trials were loaded from, used to detect a stale file.
+
+        Returns:
+            CompiledTrials: The compiled trials.
+
+        """
+        limits = [parse_age_criteria(age_criteria) for age_criteria in trials['age_criteria'].tolist()]
+        age_min = np.array([limit[0] for limit in limits], dtype=float)
+        age_max = np.array([limit[1] for limit in limits], dtype=float)
+        sex_mask = np.array([parse_sex_criteria(s) for s in trials['sex_criteria'].tolist()], dtype=np.uint8)
+
+        term_ids = {}
+        csr = []
+        for column in ('inclusionCriteria', 'exclusionCriteria'):
+            indptr, ids = [0], []
+            for criteria in trials[column].tolist():
+                # Every term once per trial, in order of appearance
+                ids.extend(term_ids.setdefault(sys.intern(term), len(term_ids)) for term in dict.fromkeys(split_terms(criteria)))
+                indptr.append(len(ids))
+            csr.append((np.array(indptr, dtype=np.int64), np.array(ids, dtype=np.int32)))
+
+        return cls(age_min, age_max, sex_mask, list(term_ids), *csr[0], *csr[1], source_hash)
+
+    @property
+    def rules(self):
+        """ The age and sex arrays in the form compile_trial_rules returns """
+        return {"age_min": self.age_min, "age_max": self.age_max, "sex_mask": self.sex_mask}
+
+    def condition_index(self):
+        """ Builds the ConditionIndex of these trials by inverting the term id arrays, no criteria strings are split """
+        postings = []
+        for indptr, ids in ((self.inclusion_indptr, self.inclusion_terms), (self.exclusion_indptr, self.exclusion_terms)):
+            positions = np.repeat(np.arange(len(self), dtype=np.int32), np.diff(indptr))
+            # A stable sort keeps the positions of every term in trial order
+            order = np.argsort(ids, kind='stable')
+            bounds = np.searchsorted(ids[order], np.arange(len(self.terms) + 1))
+            sorted_positions = positions[order]
+            postings.append([sorted_positions[bounds[i]:bounds[i + 1]] for i in range(len(self.terms))])
+        return ConditionIndex(self.terms, postings[0], postings[1], len(self), self.source_hash)
+
+    def take(self, positions):
+        """
+        The compiled trials at the given positions, in that order, e.g. the rows of a slice of the trial table.
+        The term dictionary is shared, so no criteria strings are parsed again.
+
+        Args:
+            positions (array-like): Trial positions in this table.
+
+        Returns:
+            CompiledTrials: The selected trials.
+
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        csr = []
+        for indptr, ids in ((self.inclusion_indptr, self.inclusion_terms), (self.exclusion_indptr, self.exclusion_terms)):
+            lengths = indptr[positions + 1] - indptr[positions]
+            taken_indptr = np.zeros(len(positions) + 1, dtype=np.int64)
+            taken_indptr[1:] = np.cumsum(lengths)
+            # Index of every taken term id in ids: the start of its trial plus its offset inside the trial
+            offsets = np.arange(taken_indptr[-1]) - np.repeat(taken_indptr[:-1], lengths)
+            csr.append((taken_indptr, ids[np.repeat(indptr[positions], lengths) + offsets]))
+        return CompiledTrials(
+            self.age_min[positions], self.age_max[positions], self.sex_mask[positions], self.terms, *csr[0], *csr[1], self.source_hash
+        )
+
+    def save(self, path):
+        # Saved without pickling, the terms are stored as a unicode array
+        np.savez(
+            path,
+            version=np.array(COMPILED_VERSION),
+            source_hash=np.array(self.source_hash or ""),
+            age_min=self.age_min, age_max=self.age_max, sex_mask=self.sex_mask,
+            terms=np.array(self.terms, dtype=str),
+            inclusion_indptr=self.inclusion_indptr, inclusion_terms=self.inclusion_terms,
+            exclusion_indptr=self.exclusion_indptr, exclusion_terms=self.exclusion_terms,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != COMPILED_VERSION:
+                raise ValueError(f"Unsupported compiled trials version in {path}")
+            return cls(
+                data["age_min"], data["age_max"], data["sex_mask"], data["terms"].tolist(),
+                data["inclusion_indptr"], data["inclusion_terms"], data["exclusion_indptr"], data["exclusion_terms"],
+                str(data["source_hash"]) or None,
+            )
+
+
+def load_or_compile_trials(trial_csv_path, trials=None, compiled_path=None, save=True, source_hash=None):
+    """
+    Loads the compiled trials saved next to the trial table, or compiles (and saves) them when they are missing or
+    were compiled from a different version of the table.
+
+    Args:
+        trial_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing clinical trial data.
+        trials (dataframe): The already loaded trial data, read from trial_csv_path when not given.
+        compiled_path (str): Where the compiled trials are stored, defaults to default_compiled_path(trial_csv_path).
+        save (bool): Whether freshly compiled trials are written to compiled_path.
+        source_hash (str): The version of the table trials was read from, see read_table_snapshot.
+            The table is hashed again when not given.
+
+    Returns:
+        CompiledTrials: Compiled trials matching the current content (or the given version) of the trial table.
+
+    """
+    compiled_path = compiled_path or default_compiled_path(trial_csv_path)
+    # When the table is read here the compiled trials carry the hash of the bytes they were compiled from
+    compile_table = lambda source_hash: (
+        CompiledTrials.compile(*read_table_snapshot(trial_csv_path)) if trials is None else CompiledTrials.compile(trials, source_hash)
+    )
+    return load_or_build_artifact(trial_csv_path, compiled_path, CompiledTrials.load, compile_table, save, source_hash)
@@ -0,0 +1,40 @@
+import sys
+
+import numpy as np
+
+
+class ConditionIndex:
+    """
+    Inverted index from interned condition terms to the positions of the trials whose inclusion (or exclusion)
+    criteria contain that term. Terms are the ' - ' separated fragments of the criteria strings, which is
+    exactly what check_inclusion_exclusion compares against, so lookups give the same answers as the set checks.
+    The index is not stored on its own, CompiledTrials.condition_index() derives it from the compiled trial file.
+    """
+
+    def __init__(self, terms, inclusion_postings, exclusion_postings, n_trials, source_hash=None):
+        self.terms = [sys.intern(term) for term in terms]
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.inclusion_postings = inclusion_postings
+        self.exclusion_postings = exclusion_postings
+        self.n_trials = n_trials
+        self.source_hash = source_hash
+
+    def lookup(self, conditions):
+        """ Resolves patient condition terms to term ids, terms that no trial mentions are dropped """
+        return [self.term_ids[term] for term in conditions if term in self.term_ids]
+
+    def _union(self, postings, term_ids):
+        lists = [postings[i] for i in term_ids if len(postings[i])]
+        if not lists:
+            return np.empty(0, dtype=np.int32)
+        if len(lists) == 1:
+            return lists[0]
+        return np.unique(np.concatenate(lists))
+
+    def trials_including(self, term_ids):
+        """ Sorted positions of the trials whose inclusion criteria share at least one term with the patient """
+        return self._union(self.inclusion_postings, term_ids)
+
+    def trials_excluding(self, term_ids):
+        """ Sorted positions of the trials whose exclusion criteria share at least one term with the patient """
+        return self._union(self.exclusion_postings, term_ids)
@@ -1,6 +1,21 @@
+import os
+import pickle
+import tempfile
 import pandas as pd
 from datetime import datetime
 
+from patient_matching.metrics import increment, timer
+from patient_matching.storage import TableWriter
+
+# Rows of conditions.csv / patients.csv read at a time by process_patient_data_chunked
+DEFAULT_CHUNKSIZE = 500_000
+# Patient partitions of process_patient_data_chunked, each one is aggregated in memory on its own
+DEFAULT_PARTITIONS = 16
+
+# Columns of patients.csv used by the preparation, read as strings so every chunk gets the same dtypes
+PATIENT_COLUMNS = ['Id', 'BIRTHDATE', 'DEATHDATE', 'PREFIX', 'FIRST', 'LAST', 'GENDER']
+OUTPUT_COLUMNS = ['Id', 'PREFIX', 'FIRST', 'LAST', 'GENDER', 'AGE', 'CONDITIONS', 'PREVIOUS_CONDITIONS']
+
 def load_and_process_patient_data(file_path):
     """
     Works on the patient csvs loaded in data folder, this function processes the multiple csvs and returns a merged dataframe
@@ -14,7 +29,9 @@ def load_and_process_patient_data(file_path):
 
     """
     # Load patients.csv
-    patients = pd.read_csv(file_path + 'patients.csv')
+    with timer('prepare.read_patients'):
+        patients = pd.read_csv(file_path + 'patients.csv')
+    increment('prepare.patient_rows', len(patients))
 
     # Remove patients with a DEATHDATE
     if 'DEATHDATE' in patients.columns:
@@ -30,28 +47,29 @@ def load_and_process_patient_data(file_path):
     patients['AGE'] = today.year - patients['BIRTHDATE'].dt.year
 
     # Load conditions.csv
-    conditions = pd.read_csv(file_path + 'conditions.csv')
+    with timer('prepare.read_conditions'):
+        conditions = pd.read_csv(file_path + 'conditions.csv')
+    increment('prepare.condition_rows', len(conditions))
     
     # Create separate columns for current and previous conditions based on the STOP column
-    conditions['current_conditions'] = conditions.apply(
-        lambda x: x['DESCRIPTION'] if pd.isnull(x['STOP']) else '', axis=1
-    )
-    conditions['previous_conditions'] = conditions.apply(
-        lambda x: x['DESCRIPTION'] if not pd.isnull(x['STOP']) else '', axis=1
-    )
+    is_current = conditions['STOP'].isnull()
+    conditions['current_conditions'] = conditions['DESCRIPTION'].where(is_current, '')
+    conditions['previous_conditions'] = conditions['DESCRIPTION'].where(~is_current, '')
     
     # Group by PATIENT and concatenate current and previous conditions, filtering out empty strings
-    current_conditions_grouped = conditions.groupby('PATIENT')['current_conditions'].apply(
-        lambda x: ' - '.join(x[x != ''])  # Join non-empty strings
-    ).reset_index()
-    
-    previous_conditions_grouped = conditions.groupby('PATIENT')['previous_conditions'].apply(
-        lambda x: ' - '.join(x[x != ''])  # Join non-empty strings
-    ).reset_index()
+    with timer('prepare.group_conditions'):
+        current_conditions_grouped = conditions.groupby('PATIENT')['current_conditions'].apply(
+            lambda x: ' - '.join(x[x != ''])  # Join non-empty strings
+        ).reset_index()
+
+        previous_conditions_grouped = conditions.groupby('PATIENT')['previous_conditions'].apply(
+            lambda x: ' - '.join(x[x != ''])  # Join non-empty strings
+        ).reset_index()
 
     # Merge the patients with the grouped conditions
-    merged_data = pd.merge(patients, current_conditions_grouped, left_on='Id', right_on='PATIENT', how='left')
-    merged_data = pd.merge(merged_data, previous_conditions_grouped, left_on='Id', right_on='PATIENT', how='left', suffixes=('', '_previous'))
+    with timer('prepare.merge'):
+        merged_data = pd.merge(patients, current_conditions_grouped, left_on='Id', right_on='PATIENT', how='left')
+        merged_data = pd.merge(merged_data, previous_conditions_grouped, left_on='Id', right_on='PATIENT', how='left', suffixes=('', '_previous'))
     
     # Drop the redundant 'PATIENT' column from conditions after the merge
     merged_data = merged_data.drop(columns=['PATIENT'])
@@ -63,7 +81,168 @@ def load_and_process_patient_data(file_path):
     merged_data = merged_data[merged_data['CONDITIONS'].str.strip() != '']
 
     # Keep only the specified columns
-    merged_data = merged_data[['Id', 'PREFIX', 'FIRST', 'LAST', 'GENDER', 'AGE', 'CONDITIONS', 'PREVIOUS_CONDITIONS']]
+    merged_data = merged_data[OUTPUT_COLUMNS]
  
     # Return the merged data with combined descriptions
-    return merged_data
\ No newline at end of file
+    return merged_data
+
+
+def _partitions(ids, n_partitions):
+    # Stable across chunks and runs, every row of one patient lands in the same partition
+    return pd.util.hash_pandas_object(ids, index=False).to_numpy() % n_partitions
+
+def _spill(chunk, partitions, files):
+    # groupby keeps the row order inside each partition, so every spill file stays in file order
+    for partition, rows in chunk.groupby(partitions, sort=False):
+        pickle.dump(rows, files[partition], protocol=pickle.HIGHEST_PROTOCOL)
+
+def _read_spill(path):
+    # The frames dumped one after the other into a spill file
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def _partition_csv(path, columns, id_column, spill_paths, chunksize, counter, dtype=str):
+    """ Splits a CSV into spill files by patient, returns the number of rows; rows keep their file position in '_row' """
+    files = [open(spill_path, 'wb') for spill_path in spill_paths]
+    rows = 0
+    try:
+        for chunk in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunksize):
+            increment(counter, len(chunk))
+            chunk['_row'] = range(rows, rows + len(chunk))
+            rows += len(chunk)
+            _spill(chunk, _partitions(chunk[id_column], len(files)), files)
+    finally:
+        for f in files:
+            f.close()
+    return rows
+
+def _aggregate_conditions(conditions):
+    # Concatenated current / previous conditions per patient of one partition, built frame by frame in file order
+    current = {}
+    previous = {}
+    seen = set()
+
+    for chunk in conditions:
+        seen.update(chunk['PATIENT'].unique())
+        chunk = chunk[chunk['DESCRIPTION'].notna() & (chunk['DESCRIPTION'] != '')]
+        is_current = chunk['STOP'].isnull()
+
+        for grouped, mask in ((current, is_current), (previous, ~is_current)):
+            # groupby keeps the row order inside each patient, so joining the per chunk strings keeps file order
+            joined = chunk[mask].groupby('PATIENT', sort=False)['DESCRIPTION'].agg(' - '.join)
+            for patient, descriptions in joined.items():
+                grouped[patient] = grouped[patient] + ' - ' + descriptions if patient in grouped else descriptions
+
+    return current, previous, seen
+
+def _process_partition(patients, conditions, today):
+    # Yields the living patients of one partition with their conditions, in file order, with their '_row'
+    current, previous, seen = _aggregate_conditions(conditions)
+
+    for chunk in patients:
+        # Remove patients with a DEATHDATE
+        if 'DEATHDATE' in chunk.columns:
+            chunk = chunk[chunk['DEATHDATE'].isnull() | (chunk['DEATHDATE'].str.strip() == '')]
+
+        chunk = chunk.assign(
+            # Float in every chunk, the dtype of the whole column is only known once all partitions are processed
+            AGE=(today.year - pd.to_datetime(chunk['BIRTHDATE'], format='%Y-%m-%d', errors='coerce').dt.year).astype(float),
+            # Patients without any condition rows stay NaN like after the left merge, patients with rows get a (possibly empty) string
+            CONDITIONS=[current.get(patient, '' if patient in seen else None) for patient in chunk['Id']],
+            PREVIOUS_CONDITIONS=[previous.get(patient, '' if patient in seen else None) for patient in chunk['Id']],
+        )
+        yield chunk[OUTPUT_COLUMNS + ['_row']]
+
+def _has_conditions(conditions):
+    # Same rows as the blank CONDITIONS filter of load_and_process_patient_data: NaN (no condition rows at all) is kept
+    return conditions.isna() | (conditions.fillna('').astype(str).str.strip() != '')
+
+def _merge_partitions(spill_paths, total_rows, chunksize, age_dtype):
+    """ Yields the processed rows of all partitions in patients.csv order, about chunksize rows of the file at a time """
+    readers = [_read_spill(path) for path in spill_paths]
+    buffers = [None] * len(readers)
+    for stop in range(chunksize, total_rows + chunksize, chunksize):
+        taken = []
+        for i, reader in enumerate(readers):
+            # Every partition is in file order, so its rows before `stop` are a prefix of what is left of it
+            while buffers[i] is not None or reader is not None:
+                if buffers[i] is None:
+                    buffers[i] = next(reader, None)
+                    if buffers[i] is None:
+                        readers[i] = reader = None
+                        break
+                rows = buffers[i]['_row'].to_numpy()
+                end = int((rows < stop).sum())
+                taken.append(buffers[i].iloc[:end])
+                if end < len(rows):
+                    buffers[i] = buffers[i].iloc[end:]
+                    break
+                buffers[i] = None
+        if taken:
+            merged = pd.concat(taken).sort_values('_row', kind='stable')
+            if len(merged):
+                yield merged.drop(columns='_row').astype({'AGE': age_dtype})
+
+def process_patient_data_chunked(file_path, output_path, chunksize=DEFAULT_CHUNKSIZE, partitions=DEFAULT_PARTITIONS):
+    """
+    Out-of-core version of load_and_process_patient_data for datasets that do not fit in memory (e.g. the full Synthea export).
+    conditions.csv and patients.csv are streamed in chunks and split by a hash of the patient id into spill files
+    (next to the output file). Each partition's conditions are then aggregated and joined with its patients on
+    their own, and the processed partitions are merged back into patients.csv order while being appended to the
+    output file. Memory holds about one chunk of rows plus the joined condition strings of one partition, so it is
+    bounded by the number of partitions rather than by the size of the export; the spill files take about as much
+    disk space as the two CSVs.
+    The written table has the same rows and columns as write_table(load_and_process_patient_data(file_path), output_path).
+
+    Args:
+        file_path (string): Path to the folder containing the patient data CSV files.
+        output_path (string): Path of the processed patient table to write (.csv, .parquet or .arrow).
+        chunksize (int): Number of CSV rows read at a time.
+        partitions (int): Number of patient partitions, more partitions hold fewer condition strings in memory at a time.
+
+    Returns:
+        int: Number of patients written to the output table
+
+    """
+    # Calculate age based on today's date
+    today = pd.to_datetime(datetime.now().strftime('%Y-%m-%d'))
+
+    header = pd.read_csv(file_path + 'patients.csv', nrows=0).columns
+    usecols = [column for column in PATIENT_COLUMNS if column in header]
+
+    writer = TableWriter(output_path)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as spill_dir:
+        condition_paths = [os.path.join(spill_dir, f'conditions_{i}.pkl') for i in range(partitions)]
+        patient_paths = [os.path.join(spill_dir, f'patients_{i}.pkl') for i in range(partitions)]
+        processed_paths = [os.path.join(spill_dir, f'processed_{i}.pkl') for i in range(partitions)]
+
+        with timer('prepare.partition'):
+            _partition_csv(file_path + 'conditions.csv', ['STOP', 'PATIENT', 'DESCRIPTION'], 'PATIENT', condition_paths, chunksize, 'prepare.condition_rows')
+            total_rows = _partition_csv(file_path + 'patients.csv', usecols, 'Id', patient_paths, chunksize, 'prepare.patient_rows')
+
+        # Like the single AGE column of load_and_process_patient_data, ages are whole numbers unless a living patient has no valid birthdate
+        unknown_age = False
+        with timer('prepare.group_conditions'):
+            for i in range(partitions):
+                with open(processed_paths[i], 'wb') as f:
+                    for chunk in _process_partition(_read_spill(patient_paths[i]), _read_spill(condition_paths[i]), today):
+                        unknown_age = unknown_age or bool(chunk['AGE'].isna().any())
+                        # Filter out rows where CONDITIONS is blank
+                        pickle.dump(chunk[_has_conditions(chunk['CONDITIONS'])], f, protocol=pickle.HIGHEST_PROTOCOL)
+                # The raw rows of a processed partition are not needed any more
+                os.remove(condition_paths[i])
+                os.remove(patient_paths[i])
+
+        with timer('prepare.merge'):
+            for chunk in _merge_partitions(processed_paths, total_rows, chunksize, float if unknown_age else 'int64'):
+                writer.write(chunk)
+
+    if writer.rows == 0:
+        writer.write(pd.DataFrame(columns=OUTPUT_COLUMNS))
+    writer.close()
+
+    return writer.rows
@@ -0,0 +1,121 @@
+import math
+import re
+
+import numpy as np
+
+# Minimum share of a patient condition's weighted n-grams that must appear in a criteria fragment
+DEFAULT_FUZZY_THRESHOLD = 0.85
+NGRAM_SIZE = 3
+
+# Semantic tags Synthea appends to condition descriptions, e.g. 'Anemia (disorder)'
+SEMANTIC_TAG_PATTERN = re.compile(r'\((disorder|finding|situation|procedure|morphologic abnormality|event|person)\)', re.IGNORECASE)
+NON_ALPHANUMERIC_PATTERN = re.compile(r'[^a-z0-9]+')
+NUMBER_PATTERN = re.compile(r'\d+')
+
+
+def normalize_condition(text):
+    """ Lowercases a condition or criteria text, drops Synthea's semantic tags and collapses punctuation into single spaces """
+    text = SEMANTIC_TAG_PATTERN.sub(' ', text.lower())
+    return NON_ALPHANUMERIC_PATTERN.sub(' ', text).strip()
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """ The distinct character n-grams of a normalized text, padded with spaces so word boundaries count """
+    padded = f" {text} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+class NgramIndex:
+    """
+    Inverted index from character n-grams to the texts containing them, weighted by inverse document frequency.
+    A query only touches the posting lists of its own n-grams, so lookups do not scan the whole corpus.
+    """
+
+    def __init__(self, texts, n=NGRAM_SIZE):
+        self.n = n
+        self.n_texts = len(texts)
+        gram_ids = {}
+        pairs = []
+        for position, text in enumerate(texts):
+            for gram in char_ngrams(normalize_condition(text), n):
+                pairs.append((gram_ids.setdefault(gram, len(gram_ids)), position))
+
+        self.gram_ids = gram_ids
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        # Posting lists of all n-grams as CSR arrays, sorted by n-gram then by text
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        self.indptr = np.searchsorted(pairs[:, 0], np.arange(len(gram_ids) + 1))
+        self.postings = pairs[:, 1].astype(np.int32)
+
+        document_frequency = np.diff(self.indptr)
+        self.idf = np.log((1 + self.n_texts) / (1 + document_frequency)) + 1
+        # N-grams no text contains weigh like the rarest ones
+        self.unseen_idf = math.log(1 + self.n_texts) + 1
+
+    def containment(self, query):
+        """
+        Scores how completely the query is contained in every text sharing at least one n-gram with it: the idf
+        weighted share of the query's n-grams that occur in the text, 1.0 when all of them do.
+
+        Args:
+            query (str): Text to look up, e.g. a patient condition.
+
+        Returns:
+            tuple(np.ndarray, np.ndarray): Positions of the candidate texts and their scores.
+
+        """
+        grams = char_ngrams(normalize_condition(query), self.n)
+        known = np.array([self.gram_ids[gram] for gram in grams if gram in self.gram_ids], dtype=np.int64)
+        total = self.idf[known].sum() + (len(grams) - len(known)) * self.unseen_idf
+        if not len(known) or total == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0)
+
+        lengths = self.indptr[known + 1] - self.indptr[known]
+        texts = np.concatenate([self.postings[self.indptr[g]:self.indptr[g + 1]] for g in known])
+        weights = np.repeat(self.idf[known], lengths)
+        candidates, inverse = np.unique(texts, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=weights) / total
+
+
+class FuzzyConditionIndex:
+    """
+    Approximate counterpart of a ConditionIndex: a patient condition matches every criteria fragment that contains
+    it with a character n-gram containment score of at least threshold, so 'Hypertension' matches the fragment
+    'Uncontrolled hypertension'. Numbers must match exactly, so 'stage 1' does not match 'stage 3'. The matching fragments of each distinct condition string are computed once and cached.
+    It has the lookup / trials_including / trials_excluding interface of ConditionIndex and can be used in its place.
+    """
+
+    def __init__(self, condition_index, threshold=DEFAULT_FUZZY_THRESHOLD, n=NGRAM_SIZE):
+        self.condition_index = condition_index
+        self.threshold = threshold
+        self.terms = condition_index.terms
+        self.inclusion_postings = condition_index.inclusion_postings
+        self.exclusion_postings = condition_index.exclusion_postings
+        self.n_trials = condition_index.n_trials
+        self.ngram_index = NgramIndex(condition_index.terms, n)
+        self._cache = {}
+
+    def matching_terms(self, condition):
+        """ Term ids of the criteria fragments matching one patient condition, cached per condition string """
+        term_ids = self._cache.get(condition)
+        if term_ids is None:
+            candidates, scores = self.ngram_index.containment(condition)
+            # The tolerance keeps a threshold of 1.0 usable despite float summation
+            term_ids = candidates[scores >= self.threshold - 1e-9].tolist()
+            numbers = set(NUMBER_PATTERN.findall(normalize_condition(condition)))
+            if numbers:
+                term_ids = [i for i in term_ids if numbers <= set(NUMBER_PATTERN.findall(normalize_condition(self.terms[i])))]
+            self._cache[condition] = term_ids
+        return term_ids
+
+    def lookup(self, conditions):
+        """ Resolves patient condition terms to the ids of all fragments they match """
+        term_ids = set()
+        for condition in conditions:
+            term_ids.update(self.matching_terms(condition))
+        return sorted(term_ids)
+
+    def trials_including(self, term_ids):
+        return self.condition_index.trials_including(term_ids)
+
+    def trials_excluding(self, term_ids):
+        return self.condition_index.trials_excluding(term_ids)
\ No newline at end of file
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from patient_matching.compiled_trials import load_or_compile_trials
+from patient_matching.match_algorithm import DEFAULT_BLOCK_SIZE, iter_dataframe_matches, match_patients_to_trials
+from patient_matching.metrics import METRICS
+from patient_matching.output_writer import MatchResultWriter, infer_output_format
+from patient_matching.storage import file_hash, read_table, split_terms
+
+STATE_VERSION = 2
+
+# Only these columns influence the rule-based match of a patient / trial, so only they go into the fingerprints
+PATIENT_FINGERPRINT_COLUMNS = ('AGE', 'GENDER', 'CONDITIONS')
+TRIAL_FINGERPRINT_COLUMNS = ('trialTitle', 'age_criteria', 'sex_criteria', 'inclusionCriteria', 'exclusionCriteria')
+
+
+def default_state_path(output_json_path):
+    """ The fingerprints are stored next to the match output, e.g. output/matched_patients_state.json """
+    return os.path.splitext(output_json_path)[0] + '_state.json'
+
+def _normalize(value):
+    # CSV and columnar files hold the same row with different types (int vs float ages, strings vs lists of terms)
+    if isinstance(value, (str, list, tuple, np.ndarray)):
+        return '\x1f'.join(split_terms(value))
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    return repr(float(value)) if isinstance(value, (int, float, np.number)) else str(value)
+
+def row_fingerprints(df, key_column, columns):
+    """
+    Computes a content fingerprint per row.
+
+    Args:
+        df (dataframe): Patient or trial table.
+        key_column (str): Column holding the row id ('Id' / 'trialId').
+        columns (tuple): Columns the fingerprint covers.
+
+    Returns:
+        dict: row id -> sha1 hex digest of the row's values.
+
+    """
+    values = [df[column].tolist() for column in columns]
+    fingerprints = {}
+    for key, row in zip(df[key_column].tolist(), zip(*values)):
+        fingerprints[key] = hashlib.sha1('\x1e'.join(_normalize(v) for v in row).encode('utf-8')).hexdigest()
+    return fingerprints
+
+def _load_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as f:
+        state = json.load(f)
+    return state if state.get("version") == STATE_VERSION else None
+
+def _save_state(state_path, output_json_path, patient_fingerprints, trial_fingerprints):
+    # The hash of the output ties the fingerprints to the file they describe
+    state = {"version": STATE_VERSION, "output": file_hash(output_json_path), "patients": patient_fingerprints, "trials": trial_fingerprints}
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+def _load_results(output_json_path):
+    # Previous results as patientId -> {trialId: eligible trial entry}
+    with open(output_json_path) as f:
+        if infer_output_format(output_json_path) == 'jsonl':
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = json.load(f)
+    return {record["patientId"]: {entry["trialId"]: entry for entry in record["eligibleTrials"]} for record in records}
+
+
+def match_patients_to_trials_incremental(patient_csv_path, trial_csv_path, output_json_path='matched_patients.json', state_path=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Rule-based matching that only re-evaluates what changed since the previous run and patches the previous output.
+    A fingerprint of every patient row and trial row is stored next to the output. On the next run, new or changed
+    patients are matched against all trials, unchanged patients only against new or changed trials, results of removed
+    trials are dropped, and everything else is taken from the previous output file. The patched file is the same as
+    the one a full match_patients_to_trials run would write.
+    The output is written to a temporary file that replaces the previous one only once it is complete, and the state
+    is saved after that together with a hash of the output. Without a previous output or state, when the output no
+    longer matches the hash in the state (it was edited, or a run stopped before saving its state), or with
+    duplicated ids this falls back to a full run.
+
+    Args:
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        trial_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing clinical trial data.
+        output_json_path (str): The output JSON (or JSON Lines) file, read as the previous results and rewritten.
+        state_path (str): Where the fingerprints are stored, defaults to default_state_path(output_json_path).
+        block_size (int): Number of patients evaluated per broadcast step.
+
+    Returns:
+        dict: Counts of the 'changed_patients', 'changed_trials' and 'removed_trials' of this run, None after a full run.
+
+    """
+    state_path = state_path or default_state_path(output_json_path)
+    patients = read_table(patient_csv_path)
+    trials = read_table(trial_csv_path)
+
+    patient_fingerprints = row_fingerprints(patients, 'Id', PATIENT_FINGERPRINT_COLUMNS)
+    trial_fingerprints = row_fingerprints(trials, 'trialId', TRIAL_FINGERPRINT_COLUMNS)
+
+    state = _load_state(state_path)
+    unique_ids = len(patient_fingerprints) == len(patients) and len(trial_fingerprints) == len(trials)
+    if state is None or not os.path.exists(output_json_path) or state.get("output") != file_hash(output_json_path) or not unique_ids:
+        match_patients_to_trials(patient_csv_path, trial_csv_path, output_json_path, block_size=block_size)
+        _save_state(state_path, output_json_path, patient_fingerprints, trial_fingerprints)
+        return None
+
+    changed_patients = {pid for pid, fp in patient_fingerprints.items() if state["patients"].get(pid) != fp}
+    changed_trials = {tid for tid, fp in trial_fingerprints.items() if state["trials"].get(tid) != fp}
+    removed_trials = set(state["trials"]) - set(trial_fingerprints)
+
+    previous = _load_results(output_json_path)
+    # Rules and condition postings come from the compiled trial table, no criteria strings are parsed
+    compiled = load_or_compile_trials(trial_csv_path, trials)
+
+    # New or changed patients against every trial
+    patient_changed = patients['Id'].isin(changed_patients)
+    fresh = {record["patientId"]: {e["trialId"]: e for e in record["eligibleTrials"]}
+             for record in iter_dataframe_matches(patients[patient_changed], trials, compiled.condition_index(), block_size, compiled.rules)}
+
+    # Unchanged patients only against new or changed trials
+    updates = {}
+    trial_changed = trials['trialId'].isin(changed_trials)
+    if trial_changed.any():
+        changed = compiled.take(np.flatnonzero(trial_changed.to_numpy()))
+        updates = {record["patientId"]: {e["trialId"]: e for e in record["eligibleTrials"]}
+                   for record in iter_dataframe_matches(patients[~patient_changed], trials[trial_changed], changed.condition_index(), block_size, changed.rules)}
+
+    stale_trials = changed_trials | removed_trials
+    trial_position = {tid: i for i, tid in enumerate(trials['trialId'].tolist())}
+
+    with MatchResultWriter(output_json_path) as writer:
+        for pid in patients['Id'].tolist():
+            if pid in changed_patients:
+                entries = fresh.get(pid, {})
+            else:
+                entries = {tid: e for tid, e in previous.get(pid, {}).items() if tid not in stale_trials}
+                entries.update(updates.get(pid, {}))
+            if entries:
+                writer.write({
+                    "patientId": pid,
+                    "eligibleTrials": [entries[tid] for tid in sorted(entries, key=trial_position.get)]
+                })
+
+    _save_state(state_path, output_json_path, patient_fingerprints, trial_fingerprints)
+    print(f"Incremental matching completed. {len(changed_patients)} patients and {len(changed_trials)} trials re-evaluated, "
+          f"{len(removed_trials)} trials removed. Results saved to {output_json_path}")
+
+    result = {"changed_patients": len(changed_patients), "changed_trials": len(changed_trials), "removed_trials": len(removed_trials)}
+    METRICS.merge_counters(result, 'incremental')
+    return result
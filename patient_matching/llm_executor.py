@@ -0,0 +1,210 @@
+import aiohttp
+import asyncio
+import hashlib
+import random
+import re
+import sqlite3
+import time
+
+import openai
+
+from patient_matching.metrics import METRICS
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+# Errors worth retrying: throttling, transient server errors and network problems
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    asyncio.TimeoutError,
+)
+
+
+class AsyncTokenBucket:
+    """ Token bucket for coroutines allowing `rate` requests per second with bursts of up to `burst` requests """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of LLM responses keyed by a hash of the model and the prompt, so an identical
+    patient-trial prompt is only ever billed once.
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses (prompt_hash TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._connection.commit()
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f"{model}\n{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self._connection.execute("SELECT response FROM responses WHERE prompt_hash = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, response):
+        self._connection.execute("INSERT OR REPLACE INTO responses (prompt_hash, response, created_at) VALUES (?, ?, ?)", (key, response, time.time()))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+class LLMExecutor:
+    """
+    Runs chat completion requests concurrently: at most max_concurrency requests are in flight, a token bucket keeps
+    the request rate under requests_per_second, retryable errors are retried with exponential backoff and jitter,
+    and responses are served from / stored in an optional persistent ResponseCache.
+    The counters in self.stats report calls, cache hits, retries and failures.
+    Use it as an async context manager so all requests share one pooled HTTP session.
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, max_concurrency=8, requests_per_second=5.0, max_retries=5,
+                 backoff_seconds=1.0, max_backoff_seconds=30.0, request_timeout=60, cache_path=None, api_base=None, api_key=None):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.request_timeout = request_timeout
+        self.api_base = api_base
+        self.api_key = api_key
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        self.stats = {"calls": 0, "cache_hits": 0, "retries": 0, "failures": 0}
+        # Created lazily so they bind to the running event loop
+        self._semaphore = None
+        self._bucket = None
+
+    async def __aenter__(self):
+        # openai reads its aiohttp session from a context variable, tasks created afterwards inherit it
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+        self._session_token = openai.aiosession.set(self._session)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        openai.aiosession.reset(self._session_token)
+        await self._session.close()
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+    async def _request(self, prompt):
+        kwargs = {}
+        if self.api_base:
+            kwargs["api_base"] = self.api_base
+        if self.api_key:
+            kwargs["api_key"] = self.api_key
+        response = await openai.ChatCompletion.acreate(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            request_timeout=self.request_timeout,
+            **kwargs
+        )
+        return response['choices'][0]['message']['content']
+
+    async def complete(self, prompt):
+        """
+        Returns the model's answer to one prompt.
+
+        Args:
+            prompt (str): The user message.
+
+        Returns:
+            str: The response content, None if the request still failed after all retries.
+
+        """
+        key = ResponseCache.key(self.model, prompt) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                return cached
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._bucket = AsyncTokenBucket(self.requests_per_second, burst=self.max_concurrency)
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    await self._bucket.acquire()
+                    self.stats["calls"] += 1
+                    start = time.perf_counter()
+                    try:
+                        content = await self._request(prompt)
+                    finally:
+                        METRICS.add_time('llm.request', time.perf_counter() - start)
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    self.stats["failures"] += 1
+                    print(f"LLM request failed after {attempt + 1} attempts: {e}")
+                    return None
+                self.stats["retries"] += 1
+                delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+        if key is not None:
+            self.cache.put(key, content)
+        return content
+
+
+def build_packed_prompt(patient_text, trial_texts):
+    """
+    Builds one prompt that asks about several trials for the same patient.
+
+    Args:
+        patient_text (str): Description of the patient.
+        trial_texts (list(tuple(str, str))): (trialId, trial description) pairs.
+
+    Returns:
+        str: The prompt, asking for one '<trialId>: yes/no ...' line per trial.
+
+    """
+    trials = "\n".join(f"        Trial {i}: ID {trial_id}, {text}" for i, (trial_id, text) in enumerate(trial_texts, start=1))
+    return f"""
+        Patient: {patient_text}
+{trials}
+        For each trial, is the patient eligible? Answer with exactly one line per trial in the form '<trial ID>: yes' or '<trial ID>: no'. If 'yes' then only add criteria met after it on the same line.
+        """
+
+def parse_packed_response(response, trial_ids):
+    """
+    Splits the answer to a packed prompt into the answer line of every trial.
+
+    Returns:
+        dict: trialId -> the answer text after '<trialId>:', missing trials are left out.
+
+    """
+    answers = {}
+    for line in (response or "").splitlines():
+        for trial_id in trial_ids:
+            match = re.search(re.escape(trial_id) + r'\**\s*[:\-]\s*(.*)', line)
+            if match and trial_id not in answers:
+                answers[trial_id] = match.group(1).strip()
+                break
+    return answers
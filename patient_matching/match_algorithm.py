@@ -1,74 +1,111 @@
-import pandas as pd
-import json
-import re
+import numpy as np
+import multiprocessing
+import os
+import tempfile
 
-def match_patients_to_trials(patient_csv_path, trial_csv_path, output_json_path='matched_patients.json'):
+from patient_matching.compiled_trials import GENDER_BITS, SEX_ALL, CompiledTrials, default_compiled_path, gender_bits, load_or_compile_trials, parse_age_criteria, parse_sex_criteria
+from patient_matching.fuzzy_conditions import DEFAULT_FUZZY_THRESHOLD, FuzzyConditionIndex
+from patient_matching.metrics import METRICS, increment, timer
+from patient_matching.output_writer import MatchResultWriter, format_patient_record, format_trial_entry, infer_output_format
+from patient_matching.patient_store import PatientStore, decode_ages, default_patient_store_path, load_or_build_patient_store
+from patient_matching.storage import read_table, split_terms
+
+# Number of patients evaluated against the full trial table in one broadcast step
+DEFAULT_BLOCK_SIZE = 512
+
+# Patients handled per step of the deduplicated engine, the distinct profiles among them are matched once
+DEFAULT_PROFILE_CHUNK = 65536
+
+# Order of the rows when compiled trial rules are stored as one matrix
+RULE_COLUMNS = ("age_min", "age_max", "sex_mask")
+
+
+# Function to check age eligibility
+def is_age_eligible(age, age_criteria):
+    # Limits are in years, '6 Months to 17 Years' and 'up to 17 Years' included
+    age_min, age_max = parse_age_criteria(age_criteria)
+    # NaN ages compare False
+    return age_min <= age <= age_max
+
+# Function to check gender eligibility
+def is_gender_eligible(gender, sex_criteria):
+    # Check if gender is allowed based on criteria, 'All' accepts any gender (including unknown or missing ones)
+    sex_mask = parse_sex_criteria(sex_criteria)
+    return sex_mask == SEX_ALL or bool(sex_mask & GENDER_BITS.get(gender, 0))
+
+def split_conditions(conditions):
+    """ Splits a ' - ' joined condition string (or a list of terms from a columnar file) into a set of terms, NaN gives an empty set """
+    return set(split_terms(conditions))
+
+# Function to check inclusion and exclusion criteria
+def check_inclusion_exclusion(patient_conditions, inclusion_criteria, exclusion_criteria):
+    patient_conditions = split_conditions(patient_conditions)
+    included_conditions = split_conditions(inclusion_criteria)
+    excluded_conditions = split_conditions(exclusion_criteria)
+
+    return _criteria_met(patient_conditions, included_conditions, excluded_conditions)
+
+def _criteria_met(patient_conditions, included_conditions, excluded_conditions):
+    met_criteria = []
+
+    # Check inclusion criteria
+    if not included_conditions.isdisjoint(patient_conditions):
+        met_criteria.append("Inclusion criteria met")
+
+    # Check exclusion criteria
+    if excluded_conditions.isdisjoint(patient_conditions):
+        met_criteria.append("No exclusion criteria matched")
+
+    return met_criteria
+
+
+def compile_trial_rules(trials):
     """
-    Matches patients to clinical trials based on eligibility criteria. This function uses traditional rule-based matching.
-    It has very simple implementation to demonstrate the concept of matching patients to clinical trials. You can run these rules for large data (Millions of records) as well.
-    it writes the output to a JSON file.
+    Parses the age and sex criteria of every trial once into numeric columns, so eligibility can be evaluated for
+    many patients at once without touching the criteria strings again.
+    The parsed limits follow exactly the same interpretation as is_age_eligible and is_gender_eligible.
 
     Args:
-        patient_csv_path (str): The file path to the CSV containing processed patient data.
-        trial_csv_path (str): The file path to the CSV containing clinical trial data.
-        output_json_path (str): The file path where the output JSON file will be saved.
+        trials (dataframe): Clinical trial data as written by write_trials_to_csv.
 
     Returns:
-        None
+        dict: numpy arrays 'age_min', 'age_max' (float, in years) and 'sex_mask' (uint8 bitmask), one entry per trial.
 
     """
-    # Load patient data
-    patients = pd.read_csv(patient_csv_path)
-    # Load clinical trial data
-    trials = pd.read_csv(trial_csv_path)
-
-    # Function to check age eligibility
-    def is_age_eligible(age, age_criteria):
-        # Find all integers in the age criteria string
-        age_matches = re.findall(r'\d+', age_criteria)
-        
-        if not age_matches:
-            return False
-        
-        ages = list(map(int, age_matches))
-        
-        # Determine eligibility based on the number of ages found
-        if len(ages) == 1:
-            # Only one age found, interpret as "age >= x"
-            return age >= ages[0]
-        elif len(ages) == 2:
-            # Two ages found, interpret as a range "x <= age <= y"
-            return ages[0] <= age <= ages[1]
-        return False
-
-    # Function to check gender eligibility
-    def is_gender_eligible(gender, sex_criteria):
-        # Check if gender is allowed based on criteria
-        if sex_criteria == "All":
-            return True
-        return (gender == 'M' and 'Male' in sex_criteria) or (gender == 'F' and 'Female' in sex_criteria)
-
-    # Function to check inclusion and exclusion criteria
-    def check_inclusion_exclusion(patient_conditions, inclusion_criteria, exclusion_criteria):
-        patient_conditions = set(patient_conditions.split(' - ')) if pd.notna(patient_conditions) else set()
-        included_conditions = set(inclusion_criteria.split(' - ')) if pd.notna(inclusion_criteria) else set()
-        excluded_conditions = set(exclusion_criteria.split(' - ')) if pd.notna(exclusion_criteria) else set()
-
-        met_criteria = []
-
-        # Check inclusion criteria
-        if not included_conditions.isdisjoint(patient_conditions):
-            met_criteria.append("Inclusion criteria met")
-        
-        # Check exclusion criteria
-        if excluded_conditions.isdisjoint(patient_conditions):
-            met_criteria.append("No exclusion criteria matched")
-
-        return met_criteria
-
-    # Create a list to hold patient matches
-    patient_matches = []
+    return CompiledTrials.compile(trials).rules
 
+def eligibility_mask(ages, genders, rules):
+    """
+    Computes the age and gender eligibility of a block of patients against all trials with numpy broadcasting.
+
+    Args:
+        ages (np.ndarray): Patient ages, NaN for unknown ages.
+        genders (np.ndarray): Patient genders ('M' / 'F'), or their SEX_MALE / SEX_FEMALE bits as a uint8 array.
+        rules (dict): Trial rules as returned by compile_trial_rules.
+
+    Returns:
+        np.ndarray: Boolean matrix of shape (patients, trials).
+
+    """
+    ages = np.asarray(ages, dtype=float)[:, None]
+    genders = np.asarray(genders)
+    bits = (genders if genders.dtype == np.uint8 else gender_bits(genders))[:, None]
+
+    # NaN ages compare False on both sides, same as in the row-wise check
+    age_ok = (ages >= rules["age_min"]) & (ages <= rules["age_max"])
+    # 'All' trials accept any gender, also patients whose gender has no bit
+    gender_ok = (rules["sex_mask"] == SEX_ALL) | ((bits & rules["sex_mask"]) != 0)
+
+    return age_ok & gender_ok
+
+
+def _count_pairs(evaluated, eligible):
+    # Every pair failing the age or sex criteria is pruned before the conditions are looked at
+    increment('match.pairs_evaluated', evaluated)
+    increment('match.pairs_eligible', eligible)
+    increment('match.pairs_pruned_age_gender', evaluated - eligible)
+
+def _iter_loop_matches(patients, trials):
     # Iterate over each patient and trial to find matches
     for _, patient in patients.iterrows():
         eligible_trials = []
@@ -81,11 +118,11 @@ def match_patients_to_trials(patient_csv_path, trial_csv_path, output_json_path=
             if age_eligible and gender_eligible:
                 criteria_met.append("Age criteria met")
                 criteria_met.append("Gender criteria met")
-                
+
                 # Get the criteria met for conditions
                 condition_met = check_inclusion_exclusion(patient['CONDITIONS'], trial['inclusionCriteria'], trial['exclusionCriteria'])
                 criteria_met.extend(condition_met)
-                
+
                 # Add the trial if any criteria are met
                 if criteria_met:
                     eligible_trials.append({
@@ -93,16 +130,362 @@ def match_patients_to_trials(patient_csv_path, trial_csv_path, output_json_path=
                         "trialName": trial['trialTitle'],
                         "eligibilityCriteriaMet": criteria_met
                     })
-        
-        # Append patient info if they have eligible trials
+
+        _count_pairs(len(trials), len(eligible_trials))
+
+        # Yield patient info if they have eligible trials
         if eligible_trials:
-            patient_matches.append({
+            yield {
                 "patientId": patient['Id'],
                 "eligibleTrials": eligible_trials
-            })
+            }
+
+def iter_vectorized_matches(patient_ids, ages, genders, patient_conditions, rules, condition_index, trial_ids, trial_names, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yields the match record of every patient with at least one eligible trial, in patient order.
+
+    Args:
+        patient_ids (list): Patient ids.
+        ages (np.ndarray): Patient ages as floats, NaN for unknown ages.
+        genders (np.ndarray): Patient genders ('M' / 'F').
+        patient_conditions (list): ' - ' joined current conditions per patient.
+        rules (dict): Trial rules as returned by compile_trial_rules.
+        condition_index (ConditionIndex): Condition index built from the same trial table.
+        trial_ids (list): Trial ids, in trial table order.
+        trial_names (list): Trial titles, in trial table order.
+        block_size (int): Number of patients evaluated per broadcast step.
+
+    Returns:
+        generator(dict): Records of the form {"patientId", "eligibleTrials"}.
+
+    """
+    for start in range(0, len(patient_ids), block_size):
+        stop = min(start + block_size, len(patient_ids))
+        mask = eligibility_mask(ages[start:stop], genders[start:stop], rules)
+
+        # Resolve each patient's conditions to the trials they include / are excluded from via the posting lists
+        included = np.zeros_like(mask)
+        excluded = np.zeros_like(mask)
+        for offset in range(stop - start):
+            term_ids = condition_index.lookup(split_conditions(patient_conditions[start + offset]))
+            if term_ids:
+                included[offset, condition_index.trials_including(term_ids)] = True
+                excluded[offset, condition_index.trials_excluding(term_ids)] = True
+
+        # np.nonzero walks the mask row by row, so trials stay in table order for every patient
+        rows, cols = np.nonzero(mask)
+        _count_pairs(mask.size, len(rows))
+        inclusion_met = included[rows, cols].tolist()
+        exclusion_clear = (~excluded[rows, cols]).tolist()
+        bounds = np.searchsorted(rows, np.arange(stop - start + 1)).tolist()
+        cols = cols.tolist()
+
+        for offset in range(stop - start):
+            if bounds[offset] == bounds[offset + 1]:
+                continue
+
+            eligible_trials = []
+            for k in range(bounds[offset], bounds[offset + 1]):
+                criteria_met = ["Age criteria met", "Gender criteria met"]
+                if inclusion_met[k]:
+                    criteria_met.append("Inclusion criteria met")
+                if exclusion_clear[k]:
+                    criteria_met.append("No exclusion criteria matched")
+                eligible_trials.append({
+                    "trialId": trial_ids[cols[k]],
+                    "trialName": trial_names[cols[k]],
+                    "eligibilityCriteriaMet": criteria_met
+                })
+
+            yield {
+                "patientId": patient_ids[start + offset],
+                "eligibleTrials": eligible_trials
+            }
+
+def _patient_columns(patients):
+    return (
+        patients['Id'].tolist(),
+        patients['AGE'].to_numpy(dtype=float),
+        patients['GENDER'].to_numpy(dtype=object),
+        patients['CONDITIONS'].tolist(),
+    )
+
+def iter_dataframe_matches(patients, trials, condition_index=None, block_size=DEFAULT_BLOCK_SIZE, rules=None):
+    """
+    Yields the vectorized engine's match records for a patient table against a trial table, in patient order.
+    Pass the rules and condition index of the compiled trials (CompiledTrials.rules / condition_index()), the trials
+    are only compiled here when they are missing.
+    """
+    if rules is None or condition_index is None:
+        compiled = CompiledTrials.compile(trials)
+        rules = compiled.rules if rules is None else rules
+        condition_index = compiled.condition_index() if condition_index is None else condition_index
+
+    return iter_vectorized_matches(
+        *_patient_columns(patients), rules, condition_index,
+        trials['trialId'].tolist(), trials['trialTitle'].tolist(), block_size
+    )
+
+
+def _format_trial_entries(entries, formatted, output_format):
+    # An entry only depends on the trial and the criteria met, so every distinct entry is formatted once
+    texts = []
+    for entry in entries:
+        key = (entry["trialId"], entry["trialName"], tuple(entry["eligibilityCriteriaMet"]))
+        text = formatted.get(key)
+        if text is None:
+            text = formatted[key] = format_trial_entry(entry, output_format)
+        texts.append(text)
+    return texts
+
+def iter_formatted_records(records, output_format='json'):
+    """ Formats match records like format_record, formatting every distinct eligible trial entry once """
+    formatted = {}
+    for record in records:
+        yield format_patient_record(record["patientId"], _format_trial_entries(record["eligibleTrials"], formatted, output_format), output_format)
+
+def iter_profile_items(store, rules, condition_index, trial_ids, trial_names, block_size=DEFAULT_BLOCK_SIZE, output_format='json', chunk_size=DEFAULT_PROFILE_CHUNK,
+                       start=0, stop=None):
+    """
+    Yields the formatted match record of every patient with at least one eligible trial, in patient order. The text
+    is the same as format_record over iter_vectorized_matches, but patients sharing a profile (age, gender and
+    condition set) are matched once: each chunk of patients is reduced to its distinct profiles, the profiles are
+    matched, and the formatted trial entries are fanned back out to the patients.
+
+    Args:
+        store (PatientStore): The patients.
+        rules (dict): Trial rules as returned by compile_trial_rules.
+        condition_index (ConditionIndex): Condition index built from the same trial table.
+        trial_ids (list): Trial ids, in trial table order.
+        trial_names (list): Trial titles, in trial table order.
+        block_size (int): Number of profiles evaluated per broadcast step.
+        output_format (str): 'json' or 'jsonl'.
+        chunk_size (int): Number of patients deduplicated together.
+        start (int): Position of the first patient matched.
+        stop (int): Position after the last patient matched, the end of the store by default.
+
+    Returns:
+        generator(str): Records formatted for the output file.
+
+    """
+    stop = len(store) if stop is None else stop
+    formatted = {}
+    for chunk_start in range(start, stop, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, stop)
+        patient_profiles = store.patient_profiles[chunk_start:chunk_stop]
+        profiles, inverse = np.unique(patient_profiles, return_inverse=True)
+        increment('match.patients', len(patient_profiles))
+        increment('match.profiles', len(profiles))
+
+        records = iter_vectorized_matches(
+            range(len(profiles)), decode_ages(store.profile_ages[profiles]), store.profile_genders[profiles],
+            store.profile_conditions(profiles.tolist()), rules, condition_index, trial_ids, trial_names, block_size
+        )
+        profile_texts = [None] * len(profiles)
+        for record in records:
+            profile_texts[record["patientId"]] = _format_trial_entries(record["eligibleTrials"], formatted, output_format)
+
+        for patient_id, profile in zip(store.patient_ids[chunk_start:chunk_stop], inverse.tolist()):
+            texts = profile_texts[profile]
+            if texts is not None:
+                yield format_patient_record(patient_id, texts, output_format)
+
+
+def save_trial_rules(rules, path):
+    """ Saves compiled trial rules as one float matrix so worker processes can memory-map it instead of receiving a copy """
+    np.save(path, np.vstack([rules[name].astype(float) for name in RULE_COLUMNS]))
+
+def load_trial_rules(path):
+    """ Memory-maps trial rules written by save_trial_rules """
+    matrix = np.load(path, mmap_mode='r')
+    rules = {name: matrix[i] for i, name in enumerate(RULE_COLUMNS)}
+    rules["sex_mask"] = rules["sex_mask"].astype(np.uint8)
+    return rules
+
+def _condition_matcher(condition_index, condition_match, fuzzy_threshold):
+    # 'fuzzy' wraps the exact index, the matching code only uses the shared lookup interface
+    if condition_match == 'fuzzy':
+        return FuzzyConditionIndex(condition_index, fuzzy_threshold)
+    return condition_index
+
+# State of a matching worker process, filled once by _init_worker
+_worker_state = {}
+
+def _init_worker(rules_path, compiled_path, trial_csv_path, block_size, output_format, condition_match, fuzzy_threshold, store_path=None):
+    trial_names = read_table(trial_csv_path, columns=['trialId', 'trialTitle'])
+    _worker_state.update({
+        # Only the deduplicated mode matches from the patient store, the per patient mode receives the patient columns
+        "store": PatientStore.load(store_path) if store_path else None,
+        "rules": load_trial_rules(rules_path),
+        "condition_index": _condition_matcher(CompiledTrials.load(compiled_path).condition_index(), condition_match, fuzzy_threshold),
+        "trial_ids": trial_names['trialId'].tolist(),
+        "trial_names": trial_names['trialTitle'].tolist(),
+        "block_size": block_size,
+        "output_format": output_format,
+    })
+
+def _match_shard(shard):
+    # Counters of this shard are sent back with its records and merged by the parent
+    METRICS.reset()
+    records = iter_vectorized_matches(
+        *shard, _worker_state["rules"], _worker_state["condition_index"],
+        _worker_state["trial_ids"], _worker_state["trial_names"], _worker_state["block_size"]
+    )
+    items = list(iter_formatted_records(records, _worker_state["output_format"]))
+    return items, dict(METRICS.counters)
+
+def _match_store_shard(bounds):
+    # Same as _match_shard for a (start, stop) range of the patient store, whose distinct profiles are matched once
+    METRICS.reset()
+    items = list(iter_profile_items(
+        _worker_state["store"], _worker_state["rules"], _worker_state["condition_index"], _worker_state["trial_ids"],
+        _worker_state["trial_names"], _worker_state["block_size"], _worker_state["output_format"], start=bounds[0], stop=bounds[1]
+    ))
+    return items, dict(METRICS.counters)
+
+def _shard_bounds(n_patients, workers, block_size):
+    # A few shards per worker keeps the pool balanced when some shards match more trials than others
+    shard_size = max(block_size, -(-n_patients // (workers * 4)))
+    return [(start, min(start + shard_size, n_patients)) for start in range(0, n_patients, shard_size)]
+
+def _iter_parallel_items(patients, rules, trial_csv_path, compiled_path, workers, block_size, output_format, condition_match='exact', fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD,
+                         store=None, store_path=None):
+    """
+    Matches patient shards in a process pool. Workers memory-map the compiled trial rules and derive the condition
+    index from the compiled trials saved at compiled_path instead of receiving the trial table. Workers return records already formatted for the output file, and
+    pool.imap returns the shards in order so the merged output is the same for any number of workers.
+    With a patient store (saved at store_path) the shards are ranges of the store that every worker loads once, and
+    each worker matches the distinct profiles of its shards like iter_profile_items; otherwise the patient columns
+    of each shard are sent to the workers and matched patient by patient.
+    """
+    if store is not None:
+        shards = _shard_bounds(len(store), workers, block_size)
+        match_shard = _match_store_shard
+    else:
+        patient_ids, ages, genders, patient_conditions = _patient_columns(patients)
+        shards = [
+            (patient_ids[start:stop], ages[start:stop], genders[start:stop], patient_conditions[start:stop])
+            for start, stop in _shard_bounds(len(patients), workers, block_size)
+        ]
+        match_shard = _match_shard
+        store_path = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rules_path = os.path.join(tmp, 'trial_rules.npy')
+        save_trial_rules(rules, rules_path)
+
+        initargs = (rules_path, compiled_path, trial_csv_path, block_size, output_format, condition_match, fuzzy_threshold, store_path)
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+            for items, counters in pool.imap(match_shard, shards):
+                METRICS.merge_counters(counters)
+                yield from items
+
+
+def _load_patient_store(patient_csv_path):
+    # None when the patients cannot be stored compactly, they are then matched patient by patient
+    try:
+        return load_or_build_patient_store(patient_csv_path)
+    except ValueError as e:
+        print(f"Matching patient by patient, {e}")
+        return None
+
+def match_patients_to_trials(patient_csv_path, trial_csv_path, output_json_path='matched_patients.json', engine='vectorized', block_size=DEFAULT_BLOCK_SIZE, compiled_path=None, workers=1, output_format=None,
+                             condition_match='exact', fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD, deduplicate=True):
+    """
+    Matches patients to clinical trials based on eligibility criteria. This function uses traditional rule-based matching.
+    It has very simple implementation to demonstrate the concept of matching patients to clinical trials. You can run these rules for large data (Millions of records) as well.
+    it writes the output to a JSON file, streaming each patient's record as soon as it is computed.
+
+    Two engines produce the same output: 'loop' evaluates every patient-trial pair row by row, 'vectorized' parses
+    the trial criteria once and evaluates age and gender eligibility for blocks of patients with numpy broadcasting.
+    The vectorized engine takes the age and sex rules from the compiled trials, saved next to the trial CSV (at
+    ingestion time or by the first run) and reused as long as the CSV does not change, and resolves inclusion/exclusion
+    criteria through a condition index inverted from their interned term ids. With workers > 1 the patients are split
+    into shards that are matched in a process pool and merged back in order, giving the same output.
+
+    The vectorized engine reads the patients through a PatientStore saved next to the patient table (uint8 ages and
+    genders, interned condition ids) and matches every distinct (age, gender, condition set) profile once, fanning
+    the result out to the patients that share it; with workers > 1 every worker does so for its shards. Tables with
+    ages that are not whole years, or deduplicate=False, are matched patient by patient.
+
+    With condition_match='fuzzy' (vectorized engine only) a patient condition satisfies a criteria fragment that
+    contains it approximately, scored by character n-gram containment, instead of only an identical fragment.
+
+    Args:
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        trial_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing clinical trial data.
+        output_json_path (str): The file path where the output JSON file will be saved.
+        engine (str): Matching engine to use, 'vectorized' (default) or 'loop'.
+        block_size (int): Number of patients evaluated per broadcast step by the vectorized engine.
+        compiled_path (str): Where the compiled trials are loaded from / saved to, defaults to a file next to the trial CSV.
+        workers (int): Number of processes used by the vectorized engine, 1 matches in the current process.
+        output_format (str): 'json' for a JSON array or 'jsonl' for JSON Lines, inferred from the output file extension by default.
+        condition_match (str): 'exact' (default) or 'fuzzy' matching of patient conditions against the criteria.
+        fuzzy_threshold (float): Minimum containment score (0 to 1) of a fuzzy condition match.
+        deduplicate (bool): Whether the vectorized engine matches each distinct patient profile once.
+
+    Returns:
+        None
+
+    """
+    with timer('match.load'):
+        # Load clinical trial data
+        trials = read_table(trial_csv_path)
+
+    if engine not in ('loop', 'vectorized'):
+        raise ValueError(f"Unknown matching engine: {engine}")
+    if workers > 1 and engine != 'vectorized':
+        raise ValueError("Parallel matching (workers > 1) requires the vectorized engine")
+    if condition_match not in ('exact', 'fuzzy'):
+        raise ValueError(f"Unknown condition matching: {condition_match}")
+    if condition_match == 'fuzzy' and engine != 'vectorized':
+        raise ValueError("Fuzzy condition matching requires the vectorized engine")
+
+    output_format = output_format or infer_output_format(output_json_path)
+
+    # Records are written as soon as they are computed, nothing is accumulated in memory
+    with MatchResultWriter(output_json_path, output_format) as writer:
+        if workers > 1:
+            store = patients = None
+            with timer('match.load'):
+                if deduplicate:
+                    # Saved next to the patient table, where the workers load it from
+                    store = _load_patient_store(patient_csv_path)
+                if store is None:
+                    patients = read_table(patient_csv_path)
+            compiled_path = compiled_path or default_compiled_path(trial_csv_path)
+            with timer('match.compile'):
+                # Makes sure up to date compiled trials are on disk for the workers to load
+                rules = load_or_compile_trials(trial_csv_path, trials, compiled_path).rules
+            for item in _iter_parallel_items(patients, rules, trial_csv_path, compiled_path, workers, block_size, output_format,
+                                             condition_match, fuzzy_threshold, store, default_patient_store_path(patient_csv_path)):
+                writer.write_formatted(item)
+        elif engine == 'loop':
+            with timer('match.load'):
+                patients = read_table(patient_csv_path)
+            for record in _iter_loop_matches(patients, trials):
+                writer.write(record)
+        else:
+            with timer('match.compile'):
+                # No criteria strings are parsed when the trials were compiled at ingestion time, the condition
+                # index is inverted from their term ids
+                compiled = load_or_compile_trials(trial_csv_path, trials, compiled_path)
+                rules = compiled.rules
+                condition_index = _condition_matcher(compiled.condition_index(), condition_match, fuzzy_threshold)
+
+            store = None
+            with timer('match.load'):
+                if deduplicate:
+                    store = _load_patient_store(patient_csv_path)
+                if store is None:
+                    patients = read_table(patient_csv_path)
 
-    # Write to JSON file
-    with open(output_json_path, 'w') as json_file:
-        json.dump(patient_matches, json_file, indent=4)
+            if store is not None:
+                items = iter_profile_items(store, rules, condition_index, trials['trialId'].tolist(), trials['trialTitle'].tolist(), block_size, output_format)
+                for item in items:
+                    writer.write_formatted(item)
+            else:
+                for item in iter_formatted_records(iter_dataframe_matches(patients, trials, condition_index, block_size, rules), output_format):
+                    writer.write_formatted(item)
 
-    print(f"Matching completed. Results saved to {output_json_path}")
\ No newline at end of file
+    print(f"Matching completed. Results saved to {output_json_path}")
@@ -1,88 +1,176 @@
+import asyncio
 import openai
-import pandas as pd
-import json
 import re
+from collections import deque
 
+from patient_matching.compiled_trials import load_or_compile_trials
+from patient_matching.llm_executor import DEFAULT_MODEL, LLMExecutor, build_packed_prompt, parse_packed_response
+from patient_matching.metrics import METRICS, timer
+from patient_matching.output_writer import MatchResultWriter
+from patient_matching.prefilter import iter_candidate_trials, new_prefilter_stats
+from patient_matching.storage import read_table, split_terms
 
-def match_patients_to_trials_ai(patient_csv_path, trial_csv_path, output_json_path='../output/matched_patients_ai.json'):
+# Define limits and offsets as the solution is cost sensitive
+PATIENT_LIMIT = 10   # Set the limit for the number of patients to compare
+PATIENT_OFFSET = 20   # Set the start offset for patients
+TRIAL_LIMIT = 30     # Set the limit for the number of trials to compare
+TRIAL_OFFSET = 30     # Set the start offset for trials
+
+
+# Condition and criteria columns are lists when read from a columnar file
+def joined(value):
+    return ' - '.join(split_terms(value))
+
+def patient_prompt_text(patient):
+    return f"Age {patient['AGE']}, Gender {patient['GENDER']}, Conditions: {joined(patient['CONDITIONS'])}"
+
+def trial_prompt_text(trial):
+    return (f"Name: {trial['trialTitle']}, Inclusion: {joined(trial['inclusionCriteria'])}, Exclusion: {joined(trial['exclusionCriteria'])}, "
+            f"Age: {trial['age_criteria']}, Gender: {trial['sex_criteria']}")
+
+def eligibility_prompt(patient, trial):
+    """ The prompt asking about one patient-trial pair """
+    return f"""
+        Patient: {patient_prompt_text(patient)}
+        Trial: ID {trial['trialId']}, {trial_prompt_text(trial)}
+        Is the patient eligible? Respond with 'yes' or 'no'. If 'yes' then only add criteria met.
+        """
+
+def eligible_trial_entry(trial, eligibility_info):
+    """ Turns the model's answer for one trial into an eligibleTrials entry, None when the answer is not 'yes' """
+    if eligibility_info is None or 'yes' not in eligibility_info.lower():
+        return None
+    # Remove only the first instance of "yes" (case insensitive) and trim the remaining text
+    criteria_met = re.sub(r'(?i)\byes\b', '', eligibility_info, count=1).strip().lstrip('-:').strip()
+    return {
+        "trialId": trial['trialId'],
+        "trialName": trial['trialTitle'],
+        "criteria_met": criteria_met if criteria_met else []
+    }
+
+
+async def _match_patient(executor, patient, trials, trials_per_prompt):
+    if trials_per_prompt <= 1:
+        # One request per patient-trial pair
+        answers = await asyncio.gather(*(executor.complete(eligibility_prompt(patient, trial)) for trial in trials))
+    else:
+        # Several trials packed into one request, answered one line per trial
+        groups = [trials[i:i + trials_per_prompt] for i in range(0, len(trials), trials_per_prompt)]
+        responses = await asyncio.gather(*(
+            executor.complete(build_packed_prompt(patient_prompt_text(patient), [(trial['trialId'], trial_prompt_text(trial)) for trial in group]))
+            for group in groups
+        ))
+        answers = []
+        for group, response in zip(groups, responses):
+            per_trial = parse_packed_response(response, [trial['trialId'] for trial in group])
+            answers.extend(per_trial.get(trial['trialId']) for trial in group)
+
+    eligible_trials = []
+    for trial, eligibility_info in zip(trials, answers):
+        print(eligibility_info)
+        entry = eligible_trial_entry(trial, eligibility_info)
+        if entry is not None:
+            eligible_trials.append(entry)
+
+    return {
+        "patientId": patient['Id'],
+        "eligibleTrials": eligible_trials
+    }
+
+async def _match_all(executor, candidates, trials_per_prompt, writer):
+    # A bounded window of patients is in flight; results are written in patient order as soon as they are ready
+    async with executor:
+        window = deque()
+        for patient, trials in candidates:
+            window.append(asyncio.ensure_future(_match_patient(executor, patient, trials, trials_per_prompt)))
+            if len(window) >= 2 * executor.max_concurrency:
+                writer.write(await window.popleft())
+        while window:
+            writer.write(await window.popleft())
+
+
+def match_patients_to_trials_ai(patient_csv_path, trial_csv_path, output_json_path='../output/matched_patients_ai.json', output_format=None,
+                                patient_limit=PATIENT_LIMIT, patient_offset=PATIENT_OFFSET, trial_limit=TRIAL_LIMIT, trial_offset=TRIAL_OFFSET,
+                                trials_per_prompt=1, max_concurrency=8, requests_per_second=5.0, cache_path=None, api_base=None, model=DEFAULT_MODEL,
+                                prefilter=True, top_k=None, require_condition_overlap=False):
     """
     Matches patients to clinical trials based on eligibility criteria. This function uses ai based matching.
     It currently uses OpenAI gpt-40-mini model and because the tokens are cost sensitive, it uses limits and offsets to process
     the data to demonstrate its capability with small sample of data.
-    it writes the output to a JSON file.
+    it writes the output to a JSON file, streaming each patient's result as soon as it is computed.
+
+    Requests run concurrently through an LLMExecutor (bounded concurrency, rate limiting, retries with backoff) and can
+    pack several trials into one prompt per patient. With a cache_path, responses are cached by prompt hash so
+    identical prompts are never sent twice.
+
+    With prefilter, a rule-based candidate generation stage runs first: pairs that fail the age or gender rules are
+    never sent to the model, and only the top_k trials with the most condition overlap are asked about per patient.
 
     Args:
-        patient_csv_path (str): The file path to the CSV containing processed patient data.
-        trial_csv_path (str): The file path to the CSV containing clinical trial data.
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        trial_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing clinical trial data.
         output_json_path (str): The file path where the output JSON file will be saved.
+        output_format (str): 'json' for a JSON array or 'jsonl' for JSON Lines, inferred from the output file extension by default.
+        patient_limit (int): Number of patients to compare, None for all.
+        patient_offset (int): Start offset for patients.
+        trial_limit (int): Number of trials to compare, None for all.
+        trial_offset (int): Start offset for trials.
+        trials_per_prompt (int): Number of trials asked about in one request.
+        max_concurrency (int): Maximum number of requests in flight.
+        requests_per_second (float): Rate limit of the requests.
+        cache_path (str): Optional SQLite file caching the responses by prompt hash.
+        api_base (str): Optional API root, e.g. a local mock server.
+        model (str): The chat model to use.
+        prefilter (bool): Whether pairs are pruned by the rule-based stage before they reach the model.
+        top_k (int): Number of candidate trials per patient sent to the model, None for all that pass the rules.
+        require_condition_overlap (bool): Also prune trials whose inclusion criteria share no condition with the patient.
 
     Returns:
-        None
+        dict: Counters of both stages, the prefilter's (pairs, pruned_age_gender, pruned_no_overlap, pruned_top_k,
+        candidates) and the executor's (calls, cache_hits, retries, failures).
 
     """
     # Set your OpenAI API key
     openai.api_key = 'sk-XXXXXXXX'
 
     # Load the patient and clinical trial data
-    patients_df = pd.read_csv(patient_csv_path)
-    trials_df = pd.read_csv(trial_csv_path)
-
-    # Define limits and offsets as the solution is cost sensitive
-    PATIENT_LIMIT = 10   # Set the limit for the number of patients to compare
-    PATIENT_OFFSET = 20   # Set the start offset for patients
-    TRIAL_LIMIT = 30     # Set the limit for the number of trials to compare
-    TRIAL_OFFSET = 30     # Set the start offset for trials
+    patients_df = read_table(patient_csv_path)
+    trials_df = read_table(trial_csv_path)
 
     # Limit the dataframes to the specified limits with offsets
-    limited_patients = patients_df.iloc[PATIENT_OFFSET:PATIENT_OFFSET + PATIENT_LIMIT]
-    limited_trials = trials_df.iloc[TRIAL_OFFSET:TRIAL_OFFSET + TRIAL_LIMIT]
-
-    # Define the function to check eligibility
-    def check_eligibility(patient, trial):
-        prompt = f"""
-        Patient: Age {patient['AGE']}, Gender {patient['GENDER']}, Conditions: {patient['CONDITIONS']}
-        Trial: ID {trial['trialId']}, Name: {trial['trialTitle']}, Inclusion: {trial['inclusionCriteria']}, Exclusion: {trial['exclusionCriteria']}, Age: {trial['age_criteria']}, Gender: {trial['sex_criteria']}
-        Is the patient eligible? Respond with 'yes' or 'no'. If 'yes' then only add criteria met.
-        """
-        
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",  # Use appropriate model
-            messages=[{"role": "user", "content": prompt}]
+    limited_patients = patients_df.iloc[patient_offset:None if patient_limit is None else patient_offset + patient_limit]
+    trial_positions = range(len(trials_df))[trial_offset:None if trial_limit is None else trial_offset + trial_limit]
+    limited_trials = trials_df.iloc[trial_positions]
+
+    patient_records = limited_patients.to_dict('records')
+    trial_records = limited_trials.to_dict('records')
+
+    # Stage 1: rule-based candidate generation, lazily so it overlaps with the requests of earlier patients
+    prefilter_stats = new_prefilter_stats()
+    if prefilter:
+        # The rules of the selected trials come from the compiled trial table, no criteria strings are parsed
+        compiled = load_or_compile_trials(trial_csv_path, trials_df).take(trial_positions)
+        candidates = (
+            (patient_records[i], [trial_records[j] for j in positions])
+            for i, positions in iter_candidate_trials(limited_patients, limited_trials, top_k, require_condition_overlap, compiled, stats=prefilter_stats)
         )
-        
-        return response['choices'][0]['message']['content']
-
-    # Match patients to trials
-    def match_patients_to_trials(patients, trials):
-        results = []
-        
-        for _, patient in patients.iterrows():
-            eligible_trials = []
-
-            for _, trial in trials.iterrows():
-                eligibility_info = check_eligibility(patient, trial)
-                print(eligibility_info)
-                if 'yes' in eligibility_info.lower():
-                    # Remove only the first instance of "yes" (case insensitive) and trim the remaining text
-                    criteria_met = re.sub(r'(?i)\byes\b', '', eligibility_info, count=1).strip()
-                    
-                    eligible_trials.append({
-                        "trialId": trial['trialId'],
-                        "trialName": trial['trialTitle'],
-                        "criteria_met": criteria_met if criteria_met else []
-                    })
-
-            results.append({
-                "patientId": patient['Id'],
-                "eligibleTrials": eligible_trials
-            })
-        
-        return results
-
-    # Run the matching with limited datasets
-    matched_results = match_patients_to_trials(limited_patients, limited_trials)
-
-    with open(output_json_path, 'w') as json_file:
-        json.dump(matched_results, json_file, indent=2)
-
-    print(f"Output written to {output_json_path}")
\ No newline at end of file
+    else:
+        candidates = ((patient, trial_records) for patient in patient_records)
+
+    executor = LLMExecutor(model, max_concurrency, requests_per_second, cache_path=cache_path, api_base=api_base)
+
+    # Stage 2: the model on the surviving candidates, streaming the results to the output file
+    try:
+        with MatchResultWriter(output_json_path, output_format, indent=2) as writer:
+            with timer('match.llm'):
+                asyncio.run(_match_all(executor, candidates, trials_per_prompt, writer))
+    finally:
+        executor.close()
+        METRICS.merge_counters(prefilter_stats, 'prefilter')
+        METRICS.merge_counters(executor.stats, 'llm')
+
+    print(f"Output written to {output_json_path}")
+    if prefilter:
+        print(f"Prefilter: {prefilter_stats}")
+    print(f"LLM requests: {executor.stats}")
+    return {**prefilter_stats, **executor.stats}
@@ -0,0 +1,146 @@
+import json
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not reported
+    resource = None
+
+PROMETHEUS_PREFIX = "patient_matching"
+
+
+def peak_rss_mb():
+    """ Peak resident set size of the current process in MB, None where it cannot be read """
+    # On Linux ru_maxrss survives exec and would report the parent's peak, VmHWM starts fresh in every process
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class Metrics:
+    """
+    Registry of timers and counters shared by all pipeline steps. Timers keep the call count, total and maximum
+    seconds and the peak RSS seen when they finished; counters are plain sums. The registry is thread-safe, and
+    counters of worker processes can be merged in with merge_counters.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+            self.started_at = time.time()
+
+    @contextmanager
+    def timer(self, name):
+        """ Times the enclosed block as one call of the timer `name` """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, peak_rss_mb())
+
+    def add_time(self, name, seconds, rss_mb=None):
+        """ Records one call of the timer `name`, for hot loops that measure their own time """
+        with self._lock:
+            timer = self.timers.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "peak_rss_mb": None})
+            timer["count"] += 1
+            timer["seconds"] += seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+            if rss_mb is not None:
+                timer["peak_rss_mb"] = max(timer["peak_rss_mb"] or 0.0, rss_mb)
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge_counters(self, counters, prefix=None):
+        """ Adds a dict of counts, e.g. the stats of a cache or executor, optionally as '<prefix>.<name>' """
+        with self._lock:
+            for name, value in counters.items():
+                key = f"{prefix}.{name}" if prefix else name
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "elapsed_seconds": time.time() - self.started_at,
+                "peak_rss_mb": peak_rss_mb(),
+                "timers": {name: dict(timer) for name, timer in self.timers.items()},
+                "counters": dict(self.counters),
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def to_prometheus(self):
+        """ The metrics in the Prometheus text exposition format """
+        snapshot = self.to_dict()
+        lines = []
+
+        def metric(name, kind, samples, help_text):
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_{name} {kind}")
+            for labels, value in samples:
+                label_text = "{" + ",".join(f'{key}="{val}"' for key, val in labels.items()) + "}" if labels else ""
+                lines.append(f"{PROMETHEUS_PREFIX}_{name}{label_text} {value}")
+
+        timers = snapshot["timers"]
+        if timers:
+            metric("step_seconds_total", "counter", [({"step": name}, t["seconds"]) for name, t in timers.items()], "Total seconds spent in a step")
+            metric("step_calls_total", "counter", [({"step": name}, t["count"]) for name, t in timers.items()], "Number of times a step ran")
+            metric("step_max_seconds", "gauge", [({"step": name}, t["max_seconds"]) for name, t in timers.items()], "Longest single run of a step")
+        for name, value in snapshot["counters"].items():
+            metric(_prometheus_name(name) + "_total", "counter", [({}, value)], f"Counter {name}")
+        if snapshot["peak_rss_mb"] is not None:
+            metric("peak_rss_bytes", "gauge", [({}, int(snapshot["peak_rss_mb"] * 1024 * 1024))], "Peak resident set size of the process")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus())
+
+    def summary(self):
+        """ A short human readable report, slowest steps first """
+        snapshot = self.to_dict()
+        lines = ["Step timings:"]
+        for name, timer in sorted(snapshot["timers"].items(), key=lambda item: -item[1]["seconds"]):
+            rss = "" if timer["peak_rss_mb"] is None else f"  peak RSS {timer['peak_rss_mb']:.0f} MB"
+            lines.append(f"  {name:<32} {timer['seconds']:10.3f} s  x{timer['count']}{rss}")
+        if snapshot["counters"]:
+            lines.append("Counters:")
+            lines.extend(f"  {name:<32} {value}" for name, value in sorted(snapshot["counters"].items()))
+        return "\n".join(lines)
+
+
+def _prometheus_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+# Process wide registry used by the pipeline steps
+METRICS = Metrics()
+
+def timer(name):
+    return METRICS.timer(name)
+
+def increment(name, value=1):
+    METRICS.increment(name, value)
\ No newline at end of file
@@ -0,0 +1,136 @@
+import json
+import os
+import time
+
+from patient_matching.metrics import METRICS, increment
+
+OUTPUT_FORMATS = ('json', 'jsonl')
+
+
+def infer_output_format(output_path):
+    """ '.jsonl' files are written as JSON Lines, everything else as a JSON array """
+    return 'jsonl' if str(output_path).endswith('.jsonl') else 'json'
+
+def format_record(record, output_format='json', indent=4):
+    """
+    Formats one match record as it appears in the output file.
+    In 'json' mode the text is laid out exactly as json.dump(list, indent=indent) lays out a list element, so records
+    formatted one at a time (or in other processes) join with ',\n' into the same document as one json.dump call.
+    In 'jsonl' mode the record is one compact line without the trailing newline.
+
+    Args:
+        record (dict): The record to format.
+        output_format (str): 'json' or 'jsonl'.
+        indent (int): Indentation of the JSON array layout, ignored for 'jsonl'.
+
+    Returns:
+        str: The formatted record.
+
+    """
+    if output_format == 'jsonl':
+        return json.dumps(record)
+    pad = ' ' * indent
+    return pad + json.dumps(record, indent=indent).replace('\n', '\n' + pad)
+
+def format_trial_entry(entry, output_format='json', indent=4):
+    """ Formats one eligible trial entry as it appears inside a record, to be joined by format_patient_record """
+    if output_format == 'jsonl':
+        return json.dumps(entry)
+    # Entries sit two levels inside a record, which is itself one level inside the array
+    return json.dumps(entry, indent=indent).replace('\n', '\n' + ' ' * (3 * indent))
+
+def format_patient_record(patient_id, entry_texts, output_format='json', indent=4):
+    """
+    Formats a {"patientId", "eligibleTrials"} record from trial entries formatted with format_trial_entry, giving
+    the same text as format_record. Lets the entries of one patient be formatted at different times.
+
+    Args:
+        patient_id (str): The patient id.
+        entry_texts (list(str)): The formatted eligible trial entries, at least one.
+        output_format (str): 'json' or 'jsonl'.
+        indent (int): Indentation of the JSON array layout, ignored for 'jsonl'.
+
+    Returns:
+        str: The formatted record.
+
+    """
+    if output_format == 'jsonl':
+        return '{"patientId": ' + json.dumps(patient_id) + ', "eligibleTrials": [' + ', '.join(entry_texts) + ']}'
+    pad = ' ' * indent
+    entry_pad = ' ' * (3 * indent)
+    return (
+        pad + '{\n' + pad * 2 + '"patientId": ' + json.dumps(patient_id) + ',\n' + pad * 2 + '"eligibleTrials": [\n'
+        + ',\n'.join(entry_pad + text for text in entry_texts) + '\n' + pad * 2 + ']\n' + pad + '}'
+    )
+
+
+class MatchResultWriter:
+    """
+    Streams match records to a file as they are computed, so memory does not grow with the number of matches.
+    Use it as a context manager. Records go to '<output_path>.tmp', which replaces output_path only when the block
+    exits without an exception; a failed run deletes it and leaves the previous output untouched.
+
+        with MatchResultWriter('output/matched_patients.json') as writer:
+            for record in records:
+                writer.write(record)
+    """
+
+    def __init__(self, output_path, output_format=None, indent=4):
+        self.output_path = output_path
+        self.output_format = output_format or infer_output_format(output_path)
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {self.output_format}")
+        self.indent = indent
+        self.count = 0
+        # Time spent formatting and writing, reported as the 'write.results' step when the writer is closed
+        self.seconds = 0.0
+        self.temp_path = str(output_path) + '.tmp'
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.temp_path, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record):
+        """ Writes one record """
+        start = time.perf_counter()
+        text = format_record(record, self.output_format, self.indent)
+        self.seconds += time.perf_counter() - start
+        self.write_formatted(text)
+
+    def write_formatted(self, text):
+        """ Writes one record that was already formatted with format_record using this writer's format and indent """
+        start = time.perf_counter()
+        if self.output_format == 'jsonl':
+            self._file.write(text + '\n')
+        else:
+            self._file.write(('[\n' if self.count == 0 else ',\n') + text)
+        self.count += 1
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        """ Completes the file and moves it onto output_path """
+        if self._file is None:
+            return
+        if self.output_format == 'json':
+            # Same as json.dump for an empty list / a non-empty list
+            self._file.write('[]' if self.count == 0 else '\n]')
+        self._file.close()
+        self._file = None
+        os.replace(self.temp_path, self.output_path)
+        METRICS.add_time('write.results', self.seconds)
+        increment('write.records', self.count)
+
+    def abort(self):
+        """ Discards the records written so far, output_path is not touched """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self.temp_path)
@@ -0,0 +1,215 @@
+import sys
+
+import numpy as np
+
+from patient_matching.compiled_trials import GENDER_BITS, SEX_ALL, gender_bits, parse_age_criteria, parse_sex_criteria
+from patient_matching.storage import artifact_path, id_array, load_or_build_artifact, read_table, split_terms
+
+PATIENT_INDEX_VERSION = 2
+
+# Keys of PatientIndex.gender_positions, 0 holds the patients whose gender is not M / F (only 'All' trials accept them)
+GENDER_KEYS = (0, *GENDER_BITS.values())
+
+
+def default_patient_index_path(patient_csv_path):
+    """ The index is stored next to the patient table, e.g. output/patient_processed_patient_index.npz """
+    return artifact_path(patient_csv_path, '_patient_index.npz')
+
+
+class PatientIndex:
+    """
+    Trial-centric index of the patient table: per gender, the patient positions sorted by age (so an age range is a
+    searchsorted slice), and posting lists from every current condition term to the positions of the patients who
+    have it (as CSR arrays). A trial is answered without looking at the patients it cannot match.
+    """
+
+    def __init__(self, patient_ids, ages, gender_positions, terms, term_indptr, term_patients, source_hash=None):
+        self.patient_ids = patient_ids
+        self.ages = ages
+        # gender bit (0 for other genders) -> (positions sorted by age, their ages)
+        self.gender_positions = gender_positions
+        self.terms = [sys.intern(term) for term in terms]
+        self.term_ids = {term: i for i, term in enumerate(self.terms)}
+        self.term_indptr = term_indptr
+        self.term_patients = term_patients
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    @classmethod
+    def build(cls, patients, source_hash=None):
+        """
+        Builds the index from a processed patient dataframe.
+
+        Args:
+            patients (dataframe): Processed patient data with 'Id', 'AGE', 'GENDER' and 'CONDITIONS'.
+            source_hash (str): Optional hash of the file the patients were loaded from, used to detect a stale index.
+
+        Returns:
+            PatientIndex: The built index.
+
+        """
+        ages = patients['AGE'].to_numpy(dtype=float)
+        bits = gender_bits(patients['GENDER'].tolist())
+
+        gender_positions = {}
+        for bit in GENDER_KEYS:
+            # Unknown ages can never satisfy an age criteria, they are left out
+            positions = np.flatnonzero((bits == bit) & ~np.isnan(ages))
+            positions = positions[np.argsort(ages[positions], kind='stable')]
+            gender_positions[bit] = (positions, ages[positions])
+
+        term_ids = {}
+        pairs = []
+        for position, conditions in enumerate(patients['CONDITIONS'].tolist()):
+            for term in set(split_terms(conditions)):
+                pairs.append((term_ids.setdefault(sys.intern(term), len(term_ids)), position))
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+        term_indptr = np.searchsorted(pairs[:, 0], np.arange(len(term_ids) + 1))
+
+        return cls(patients['Id'].tolist(), ages, gender_positions, list(term_ids), term_indptr, pairs[:, 1].copy(), source_hash)
+
+    def _postings(self, terms):
+        term_ids = [self.term_ids[term] for term in set(terms) if term in self.term_ids]
+        return [self.term_patients[self.term_indptr[i]:self.term_indptr[i + 1]] for i in term_ids]
+
+    def eligible_positions(self, age_criteria, sex_criteria):
+        """ Positions of the patients passing the age and sex criteria of a trial, in patient table order """
+        age_min, age_max = parse_age_criteria(age_criteria)
+        sex_mask = parse_sex_criteria(sex_criteria)
+        slices = []
+        for bit, (positions, sorted_ages) in self.gender_positions.items():
+            if sex_mask == SEX_ALL or sex_mask & bit:
+                start = np.searchsorted(sorted_ages, age_min, side='left')
+                stop = np.searchsorted(sorted_ages, age_max, side='right')
+                slices.append(positions[start:stop])
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(slices))
+
+    def rank(self, trial, top_n=None):
+        """
+        Ranks the patients eligible for one trial, with the rules of match_patients_to_trials: every patient passing
+        the age and sex criteria is eligible, and the inclusion / exclusion criteria add 'Inclusion criteria met' and
+        'No exclusion criteria matched'. Patients come first when no exclusion criteria matched, then by the number
+        of their conditions found in the inclusion criteria, then in patient table order.
+
+        Args:
+            trial (dict): Trial row with 'trialId', 'trialTitle', 'age_criteria', 'sex_criteria', 'inclusionCriteria' and 'exclusionCriteria'.
+            top_n (int): Number of patients returned, None for all eligible patients.
+
+        Returns:
+            dict: {"trialId", "trialName", "eligiblePatientCount", "eligiblePatients": [{"patientId", "matchedConditions", "eligibilityCriteriaMet"}]}.
+
+        """
+        candidates = self.eligible_positions(trial['age_criteria'], trial['sex_criteria'])
+
+        overlap = np.zeros(len(self), dtype=np.int32)
+        for postings in self._postings(split_terms(trial['inclusionCriteria'])):
+            overlap[postings] += 1
+        excluded = np.zeros(len(self), dtype=bool)
+        for postings in self._postings(split_terms(trial['exclusionCriteria'])):
+            excluded[postings] = True
+
+        ranking = candidates[np.lexsort((candidates, -overlap[candidates], excluded[candidates]))]
+        if top_n is not None:
+            ranking = ranking[:top_n]
+
+        eligible_patients = []
+        for position, matched, is_excluded in zip(ranking.tolist(), overlap[ranking].tolist(), excluded[ranking].tolist()):
+            criteria_met = ["Age criteria met", "Gender criteria met"]
+            if matched:
+                criteria_met.append("Inclusion criteria met")
+            if not is_excluded:
+                criteria_met.append("No exclusion criteria matched")
+            eligible_patients.append({
+                "patientId": self.patient_ids[position],
+                "matchedConditions": matched,
+                "eligibilityCriteriaMet": criteria_met
+            })
+
+        return {
+            "trialId": trial['trialId'],
+            "trialName": trial['trialTitle'],
+            "eligiblePatientCount": len(candidates),
+            "eligiblePatients": eligible_patients
+        }
+
+    def save(self, path):
+        arrays = {}
+        for bit, (positions, _) in self.gender_positions.items():
+            arrays[f"gender_{bit}"] = positions
+        np.savez(
+            path,
+            version=np.array(PATIENT_INDEX_VERSION),
+            source_hash=np.array(self.source_hash or ""),
+            patient_ids=id_array(self.patient_ids),
+            ages=self.ages,
+            terms=np.array(self.terms, dtype=str),
+            term_indptr=self.term_indptr,
+            term_patients=self.term_patients,
+            **arrays
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != PATIENT_INDEX_VERSION:
+                raise ValueError(f"Unsupported patient index version in {path}")
+            ages = data["ages"]
+            gender_positions = {}
+            for bit in GENDER_KEYS:
+                positions = data[f"gender_{bit}"]
+                gender_positions[bit] = (positions, ages[positions])
+            return cls(
+                data["patient_ids"].tolist(), ages, gender_positions, data["terms"].tolist(),
+                data["term_indptr"], data["term_patients"], str(data["source_hash"]) or None,
+            )
+
+
+def load_or_build_patient_index(patient_csv_path, patients=None, index_path=None, save=True):
+    """
+    Loads the patient index saved next to the patient table, or builds (and saves) it when it is missing or was
+    built from a different version of the table.
+
+    Args:
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        patients (dataframe): The already loaded patient data, read from patient_csv_path when not given.
+        index_path (str): Where the index is stored, defaults to default_patient_index_path(patient_csv_path).
+        save (bool): Whether a freshly built index is written to index_path.
+
+    Returns:
+        PatientIndex: An index that matches the current content of the patient table.
+
+    """
+    index_path = index_path or default_patient_index_path(patient_csv_path)
+    build = lambda source_hash: PatientIndex.build(
+        read_table(patient_csv_path, columns=['Id', 'AGE', 'GENDER', 'CONDITIONS']) if patients is None else patients, source_hash
+    )
+    return load_or_build_artifact(patient_csv_path, index_path, PatientIndex.load, build, save)
+
+
+def rank_patients_for_trial(patient_csv_path, trial_csv_path, trial_id, top_n=None):
+    """
+    Returns the ranked eligible patients of one trial, using the patient index saved next to the patient table
+    (built on the first call).
+
+    Args:
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        trial_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing clinical trial data.
+        trial_id (str): The trialId to rank patients for.
+        top_n (int): Number of patients returned, None for all eligible patients.
+
+    Returns:
+        dict: The ranking as returned by PatientIndex.rank.
+
+    """
+    trials = read_table(trial_csv_path)
+    matching = trials[trials['trialId'] == trial_id]
+    if matching.empty:
+        raise KeyError(f"Unknown trial {trial_id}")
+
+    index = load_or_build_patient_index(patient_csv_path)
+    return index.rank(matching.iloc[0].to_dict(), top_n)
\ No newline at end of file
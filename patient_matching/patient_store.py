@@ -0,0 +1,170 @@
+import sys
+
+import numpy as np
+
+from patient_matching.compiled_trials import gender_bits
+from patient_matching.storage import artifact_path, id_array, load_or_build_artifact, read_table, split_terms
+
+PATIENT_STORE_VERSION = 1
+
+# uint8 code of a missing age, whole ages 0 to 254 are stored as they are
+AGE_UNKNOWN = 255
+
+
+def default_patient_store_path(patient_csv_path):
+    """ The store is saved next to the patient table, e.g. output/patient_processed_store.npz """
+    return artifact_path(patient_csv_path, '_store.npz')
+
+def encode_ages(ages):
+    """
+    Encodes patient ages as uint8, AGE_UNKNOWN for a missing age.
+
+    Args:
+        ages (np.ndarray): Ages in years as floats, NaN for unknown ages.
+
+    Returns:
+        np.ndarray: uint8 age codes.
+
+    Raises:
+        ValueError: When an age is not a whole number of years between 0 and 254.
+
+    """
+    ages = np.asarray(ages, dtype=float)
+    known = ~np.isnan(ages)
+    if not np.all((ages[known] >= 0) & (ages[known] < AGE_UNKNOWN) & (ages[known] == np.round(ages[known]))):
+        raise ValueError(f"Ages must be whole years between 0 and {AGE_UNKNOWN - 1} to be stored as uint8")
+    codes = np.full(len(ages), AGE_UNKNOWN, dtype=np.uint8)
+    codes[known] = ages[known]
+    return codes
+
+def decode_ages(codes):
+    """ The float ages of uint8 age codes, NaN for AGE_UNKNOWN """
+    ages = codes.astype(float)
+    ages[codes == AGE_UNKNOWN] = np.nan
+    return ages
+
+
+class PatientStore:
+    """
+    Compact form of the processed patient table holding only what the matchers need. Ages are uint8 codes, genders
+    SEX_MALE / SEX_FEMALE bits, and conditions interned term ids. Patients with the same age, gender and set of
+    current conditions share one profile: the matchers evaluate every profile once and fan the result out to its
+    patients. The condition ids of profile p are profile_terms[profile_indptr[p]:profile_indptr[p + 1]], sorted.
+    """
+
+    def __init__(self, patient_ids, ages, genders, patient_profiles, profile_ages, profile_genders, terms, profile_indptr, profile_terms, source_hash=None):
+        self.patient_ids = patient_ids
+        self.ages = ages
+        self.genders = genders
+        # patient position -> profile
+        self.patient_profiles = patient_profiles
+        self.profile_ages = profile_ages
+        self.profile_genders = profile_genders
+        self.terms = [sys.intern(term) for term in terms]
+        self.profile_indptr = profile_indptr
+        self.profile_terms = profile_terms
+        self.source_hash = source_hash
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    @property
+    def n_profiles(self):
+        return len(self.profile_ages)
+
+    @classmethod
+    def build(cls, patients, source_hash=None):
+        """
+        Builds the store from a processed patient dataframe.
+
+        Args:
+            patients (dataframe): Processed patient data with 'Id', 'AGE', 'GENDER' and 'CONDITIONS'.
+            source_hash (str): Optional hash of the file the patients were loaded from, used to detect a stale store.
+
+        Returns:
+            PatientStore: The built store.
+
+        Raises:
+            ValueError: When an age cannot be stored as uint8, see encode_ages.
+
+        """
+        ages = encode_ages(patients['AGE'].to_numpy(dtype=float))
+        genders = gender_bits(patients['GENDER'].tolist())
+
+        term_ids = {}
+        profiles = {}
+        patient_profiles = np.empty(len(patients), dtype=np.int32)
+        for position, (age, gender, conditions) in enumerate(zip(ages.tolist(), genders.tolist(), patients['CONDITIONS'].tolist())):
+            # The matchers treat the conditions as a set, so order and repeats do not make a different profile
+            condition_ids = tuple(sorted({term_ids.setdefault(sys.intern(term), len(term_ids)) for term in split_terms(conditions)}))
+            patient_profiles[position] = profiles.setdefault((age, gender, condition_ids), len(profiles))
+
+        profile_ages = np.array([key[0] for key in profiles], dtype=np.uint8)
+        profile_genders = np.array([key[1] for key in profiles], dtype=np.uint8)
+        profile_indptr = np.zeros(len(profiles) + 1, dtype=np.int64)
+        profile_indptr[1:] = np.cumsum([len(key[2]) for key in profiles])
+        profile_terms = np.fromiter((term for key in profiles for term in key[2]), dtype=np.int32, count=profile_indptr[-1])
+
+        return cls(
+            patients['Id'].tolist(), ages, genders, patient_profiles, profile_ages, profile_genders,
+            list(term_ids), profile_indptr, profile_terms, source_hash
+        )
+
+    def profile_conditions(self, profiles):
+        """ The condition terms of each of the given profiles, as lists of strings """
+        terms = self.terms
+        indptr = self.profile_indptr
+        return [[terms[i] for i in self.profile_terms[indptr[p]:indptr[p + 1]].tolist()] for p in profiles]
+
+    def save(self, path):
+        np.savez(
+            path,
+            version=np.array(PATIENT_STORE_VERSION),
+            source_hash=np.array(self.source_hash or ""),
+            patient_ids=id_array(self.patient_ids),
+            ages=self.ages,
+            genders=self.genders,
+            patient_profiles=self.patient_profiles,
+            profile_ages=self.profile_ages,
+            profile_genders=self.profile_genders,
+            terms=np.array(self.terms, dtype=str),
+            profile_indptr=self.profile_indptr,
+            profile_terms=self.profile_terms,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data["version"]) != PATIENT_STORE_VERSION:
+                raise ValueError(f"Unsupported patient store version in {path}")
+            return cls(
+                data["patient_ids"].tolist(), data["ages"], data["genders"], data["patient_profiles"],
+                data["profile_ages"], data["profile_genders"], data["terms"].tolist(),
+                data["profile_indptr"], data["profile_terms"], str(data["source_hash"]) or None,
+            )
+
+
+def load_or_build_patient_store(patient_csv_path, patients=None, store_path=None, save=True):
+    """
+    Loads the patient store saved next to the patient table, or builds (and saves) it when it is missing or was
+    built from a different version of the table.
+
+    Args:
+        patient_csv_path (str): The file path to the CSV (or Parquet / Arrow file) containing processed patient data.
+        patients (dataframe): The already loaded patient data, read from patient_csv_path when not given.
+        store_path (str): Where the store is saved, defaults to default_patient_store_path(patient_csv_path).
+        save (bool): Whether a freshly built store is written to store_path.
+
+    Returns:
+        PatientStore: A store that matches the current content of the patient table.
+
+    Raises:
+        ValueError: When an age cannot be stored as uint8, see encode_ages.
+
+    """
+    store_path = store_path or default_patient_store_path(patient_csv_path)
+    # Names and previous conditions are not needed by the matchers and are never loaded
+    build = lambda source_hash: PatientStore.build(
+        read_table(patient_csv_path, columns=['Id', 'AGE', 'GENDER', 'CONDITIONS']) if patients is None else patients, source_hash
+    )
+    return load_or_build_artifact(patient_csv_path, store_path, PatientStore.load, build, save)
@@ -0,0 +1,221 @@
+"""
+Pipelined runner of the scrape -> prepare -> match steps of main.py. The steps run as concurrent stages connected by a
+bounded queue instead of one after the other:
+
+    trial pages  --(bounded queue)-->  matcher  -->  matched_patients.json
+    patient preparation  -------------^
+
+The trial stage fetches search pages and hands each page to the matcher as soon as it is parsed, then writes the
+trial table. The patient stage prepares the Synthea CSVs at the same time, it does not depend on the trials at all.
+The matcher buffers pages until the patients are ready and then matches the trials batch by batch while later pages
+are still being fetched, so the wall time approaches the slowest stage instead of the sum of the stages.
+The output is the same as running the steps one after the other.
+
+Conditions are matched exactly. Fuzzy matching weighs criteria n-grams by their idf over the whole trial table, which
+is only known after the last page, so a batch cannot be matched fuzzily on its own; use match_patients_to_trials with
+condition_match='fuzzy' on the written tables instead.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from patient_matching.compiled_trials import CompiledTrials
+from patient_matching.data_preparation import DEFAULT_CHUNKSIZE, process_patient_data_chunked
+from patient_matching.match_algorithm import DEFAULT_BLOCK_SIZE, _format_trial_entries, iter_vectorized_matches
+from patient_matching.metrics import METRICS, increment, timer
+from patient_matching.output_writer import MatchResultWriter, format_patient_record, infer_output_format
+from patient_matching.patient_store import decode_ages, load_or_build_patient_store
+from patient_matching.scraping import flatten_trials, write_trials_table
+from patient_matching.storage import table_format
+from patient_matching.trial_cache import DEFAULT_TTL_SECONDS, TrialCache
+from patient_matching.trial_ingestion import iter_trial_pages
+
+# Trial pages buffered between the trial stage and the matcher before the trial stage waits
+DEFAULT_QUEUE_SIZE = 8
+# Trials matched together at least, every batch is one pass over all patient profiles
+DEFAULT_MIN_BATCH_TRIALS = 50
+
+# Put on the trial queue after the last page, or instead of it when the trial stage failed
+_DONE = object()
+_FAILED = object()
+
+
+def _put(channel, item, stop):
+    # Waits for room in the queue, gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            channel.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _trial_stage(trial_pages, trial_queue, trial_output_path, stop):
+    trials = []
+    try:
+        with timer('pipeline.scrape'):
+            for page in trial_pages:
+                trials.extend(page)
+                if not _put(trial_queue, page, stop):
+                    return len(trials)
+    except BaseException:
+        # Releases the matcher, which raises the error from this stage's future
+        _put(trial_queue, _FAILED, stop)
+        raise
+    _put(trial_queue, _DONE, stop)
+
+    # The matcher already has every trial, the table is written for the next runs and the other matchers
+    with timer('write'):
+        write_trials_table(trial_output_path, trials)
+    return len(trials)
+
+def _patient_stage(patient_data_path, patient_output_path, chunksize):
+    with timer('prepare'):
+        process_patient_data_chunked(patient_data_path, patient_output_path, chunksize)
+        # Every trial batch is one pass over the distinct patient profiles, their conditions are resolved to terms once
+        store = load_or_build_patient_store(patient_output_path)
+        profile_ages = decode_ages(store.profile_ages)
+        profile_conditions = store.profile_conditions(range(store.n_profiles))
+    return store, profile_ages, profile_conditions
+
+
+class _BatchMatcher:
+    """
+    Matches the patient profiles against one batch of trials after the other, keeping every profile's trials in
+    table order. The eligible trial entries are formatted right away, formatting is most of the output cost and this
+    way it overlaps with the fetching of later pages; only the records of the patients are assembled after the last batch.
+    The entries are kept for every profile until the end, so memory grows with the number of profiles times their
+    matched trials.
+    """
+
+    def __init__(self, trial_output_path, output_format, block_size):
+        # CSV trial tables replace commas, the batches are matched as the table is written
+        self.replace_commas = table_format(trial_output_path) == 'csv'
+        self.output_format = output_format
+        self.block_size = block_size
+        # profile -> formatted eligible trial entries of all batches so far
+        self.eligible = {}
+        self.batches = 0
+
+    def match(self, patients, trials):
+        with timer('pipeline.match_batch'):
+            table = flatten_trials(trials)
+            if self.replace_commas:
+                table = table.replace(',', '_', regex=True)
+            compiled = CompiledTrials.compile(table)
+            # Exact matching only depends on the trials of the batch, unlike the idf weights of fuzzy matching
+            condition_index = compiled.condition_index()
+
+            store, profile_ages, profile_conditions = patients
+            records = iter_vectorized_matches(
+                range(store.n_profiles), profile_ages, store.profile_genders, profile_conditions, compiled.rules, condition_index,
+                table['trialId'].tolist(), table['trialTitle'].tolist(), self.block_size
+            )
+            formatted = {}
+            for record in records:
+                self.eligible.setdefault(record["patientId"], []).extend(
+                    _format_trial_entries(record["eligibleTrials"], formatted, self.output_format)
+                )
+        self.batches += 1
+        increment('pipeline.batches')
+
+    def write(self, patients, output_json_path):
+        store = patients[0]
+        with MatchResultWriter(output_json_path, self.output_format) as writer:
+            # Fans the profile results out to the patients, in patient order
+            for patient_id, profile in zip(store.patient_ids, store.patient_profiles.tolist()):
+                texts = self.eligible.get(profile)
+                if texts:
+                    writer.write_formatted(format_patient_record(patient_id, texts, self.output_format))
+        return writer.count
+
+
+def _match_stage(trial_queue, trials_future, patients_future, matcher, min_batch_trials):
+    batch = []
+    done = False
+    while not done:
+        # Everything that arrived since the last batch is matched together, waiting briefly so a batch starts as soon as the patients are ready
+        try:
+            items = [trial_queue.get(timeout=0.1)]
+        except queue.Empty:
+            items = []
+        while True:
+            try:
+                items.append(trial_queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in items:
+            if item is _FAILED:
+                trials_future.result()
+            elif item is _DONE:
+                done = True
+            else:
+                batch.extend(item)
+
+        # Pages are buffered until the patients are prepared
+        if batch and patients_future.done() and (done or len(batch) >= min_batch_trials):
+            matcher.match(patients_future.result(), batch)
+            batch = []
+
+    patients = patients_future.result()
+    if batch:
+        matcher.match(patients, batch)
+    return patients
+
+
+def run_pipelined(patient_data_path, patient_output_path, trial_output_path, output_json_path, trial_pages=None, page_limit=20,
+                  cache_path=None, cache_ttl=DEFAULT_TTL_SECONDS, queue_size=DEFAULT_QUEUE_SIZE, min_batch_trials=DEFAULT_MIN_BATCH_TRIALS,
+                  block_size=DEFAULT_BLOCK_SIZE, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Runs trial ingestion, patient preparation and matching as overlapping stages. Writes the same trial table,
+    processed patient table and match output as ingest_clinical_trials + write_trials_table,
+    process_patient_data_chunked and match_patients_to_trials (with exact condition matching) run one after the other.
+
+    Args:
+        patient_data_path (str): Path to the folder containing the patient data CSV files.
+        patient_output_path (str): Path of the processed patient table to write (.csv, .parquet or .arrow).
+        trial_output_path (str): Path of the trial table to write (.csv, .parquet or .arrow).
+        output_json_path (str): The file path where the output JSON file will be saved.
+        trial_pages (iterable(list(dict))): Pages of trial dicts, fetched from the ClinicalTrials.gov API with iter_trial_pages by default.
+            The Selenium scraper can be used with [scrape_clinical_trials(page_limit)], as one page.
+        page_limit (int): Limit on how many search pages are read when trial_pages is not given.
+        cache_path (str): Optional SQLite file of a TrialCache used when trial_pages is not given.
+        cache_ttl (float): Seconds a cached trial is used without fetching it again.
+        queue_size (int): Trial pages buffered between the trial stage and the matcher.
+        min_batch_trials (int): Trials collected before a batch is matched, the last batch can be smaller.
+        block_size (int): Number of patients evaluated per broadcast step.
+        chunksize (int): Number of CSV rows read at a time by the patient preparation.
+
+    Returns:
+        dict: Number of trials, matched patients and trial batches.
+
+    """
+    cache = None
+    if trial_pages is None:
+        cache = TrialCache(cache_path, cache_ttl) if cache_path else None
+        trial_pages = iter_trial_pages(page_limit, cache=cache)
+
+    trial_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    matcher = _BatchMatcher(trial_output_path, infer_output_format(output_json_path), block_size)
+    try:
+        with timer('pipeline'), ThreadPoolExecutor(2, thread_name_prefix='pipeline') as executor:
+            trials_future = executor.submit(_trial_stage, trial_pages, trial_queue, trial_output_path, stop)
+            patients_future = executor.submit(_patient_stage, patient_data_path, patient_output_path, chunksize)
+            try:
+                patients = _match_stage(trial_queue, trials_future, patients_future, matcher, min_batch_trials)
+                with timer('match.write'):
+                    patients_matched = matcher.write(patients, output_json_path)
+                n_trials = trials_future.result()
+            except BaseException:
+                # Lets the trial stage stop at its next page instead of waiting for the matcher
+                stop.set()
+                raise
+    finally:
+        if cache is not None:
+            print(f"Trial cache: {cache.stats}")
+            METRICS.merge_counters(cache.stats, 'trial_cache')
+            cache.close()
+
+    print(f"Pipelined run completed. {n_trials} trials, {patients_matched} patients matched, results saved to {output_json_path}")
+    return {"trials": n_trials, "patients_matched": patients_matched, "batches": matcher.batches}
\ No newline at end of file
@@ -0,0 +1,71 @@
+import numpy as np
+
+from patient_matching.compiled_trials import CompiledTrials
+from patient_matching.match_algorithm import DEFAULT_BLOCK_SIZE, _patient_columns, eligibility_mask, split_conditions
+
+# Counters of the candidate generation stage, one pair is one patient-trial combination
+PREFILTER_COUNTERS = ("pairs", "pruned_age_gender", "pruned_no_overlap", "pruned_top_k", "candidates")
+
+
+def new_prefilter_stats():
+    return {name: 0 for name in PREFILTER_COUNTERS}
+
+def iter_candidate_trials(patients, trials, top_k=None, require_condition_overlap=False, compiled=None, block_size=DEFAULT_BLOCK_SIZE, stats=None):
+    """
+    Cheap deterministic candidate generation in front of an expensive matcher. Pairs failing the rule engine's age
+    or gender check are dropped, the remaining trials are ranked by how many of the patient's conditions appear in
+    their inclusion criteria (trials whose exclusion criteria mention one of the conditions rank last), and only the
+    top_k trials of every patient are kept.
+
+    Args:
+        patients (dataframe): Processed patient data.
+        trials (dataframe): Clinical trial data.
+        top_k (int): Number of candidate trials kept per patient, None keeps all trials passing the checks.
+        require_condition_overlap (bool): Also drop trials whose inclusion criteria share no condition with the patient.
+        compiled (CompiledTrials): The compiled trials of the same rows (e.g. from load_or_compile_trials), compiled when not given.
+        block_size (int): Number of patients evaluated per broadcast step.
+        stats (dict): Optional counters (see new_prefilter_stats) updated in place.
+
+    Returns:
+        generator(tuple(int, list)): (patient position, positions of the candidate trials in trial table order) for every patient.
+
+    """
+    stats = stats if stats is not None else new_prefilter_stats()
+    if compiled is None:
+        compiled = CompiledTrials.compile(trials)
+    rules = compiled.rules
+    condition_index = compiled.condition_index()
+
+    _, ages, genders, patient_conditions = _patient_columns(patients)
+    n_trials = len(trials)
+    positions = np.arange(n_trials)
+
+    for start in range(0, len(patients), block_size):
+        stop = min(start + block_size, len(patients))
+        mask = eligibility_mask(ages[start:stop], genders[start:stop], rules)
+
+        for offset in range(stop - start):
+            eligible = mask[offset]
+            stats["pairs"] += n_trials
+            stats["pruned_age_gender"] += n_trials - int(eligible.sum())
+
+            # Number of the patient's distinct conditions found in each trial's inclusion criteria
+            overlap = np.zeros(n_trials, dtype=np.int32)
+            excluded = np.zeros(n_trials, dtype=bool)
+            for term_id in condition_index.lookup(split_conditions(patient_conditions[start + offset])):
+                overlap[condition_index.inclusion_postings[term_id]] += 1
+                excluded[condition_index.exclusion_postings[term_id]] = True
+
+            if require_condition_overlap:
+                stats["pruned_no_overlap"] += int((eligible & (overlap == 0)).sum())
+                eligible = eligible & (overlap > 0)
+
+            candidates = positions[eligible]
+            if top_k is not None and len(candidates) > top_k:
+                # Best overlap first, ties broken by trial order; the kept trials go back to trial order
+                ranking = np.lexsort((candidates, -overlap[candidates], excluded[candidates]))
+                stats["pruned_top_k"] += len(candidates) - top_k
+                candidates = np.sort(candidates[ranking[:top_k]])
+
+            stats["candidates"] += len(candidates)
+            yield start + offset, candidates.tolist()
\ No newline at end of file
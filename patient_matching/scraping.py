@@ -6,6 +6,15 @@ from selenium.webdriver.support import expected_conditions as EC
 from bs4 import BeautifulSoup
 import pandas as pd
 import re
+import time
+
+from patient_matching.compiled_trials import load_or_compile_trials
+from patient_matching.metrics import METRICS, increment, peak_rss_mb
+from patient_matching.storage import table_format, write_table
+from patient_matching.trial_cache import DEFAULT_TTL_SECONDS, TrialCache
+
+# Columns of scraped_trials.csv, in order
+TRIAL_COLUMNS = ["trialId", "trialTitle", "inclusionCriteria", "exclusionCriteria", "age_criteria", "sex_criteria", "healthy_volunteers_allowed", "conditions"]
 
 def setup_driver():
     # Set up headless Chrome for faster execution
@@ -18,12 +27,94 @@ def safe_get_text(soup_element, default_value="NA"):
     """ Safely extracts text from a BeautifulSoup element, returns default_value if None """
     return soup_element.get_text().strip() if soup_element else default_value
 
-def extract_trial_info(driver, page_limit = 10):
+def parse_trial_detail_page(page_source, trial_id, trial_title):
+    """
+    Parses the detail page of a trial into the trial dict written by write_trials_to_csv.
+
+    Args:
+        page_source (str): HTML of the trial's detail page.
+        trial_id (str): NCT id read from the search result card.
+        trial_title (str): Title read from the search result card.
+
+    Returns:
+        dict: Trial data, None when the eligibility criteria could not be extracted.
+
+    """
+    soup_detail = BeautifulSoup(page_source, "html.parser")
+
+    # Extract inclusion/exclusion criteria and other details
+    age_criteria = safe_get_text(soup_detail.select_one("ctg-standard-age"))
+    sex_criteria = safe_get_text(soup_detail.select_one('[path="protocolSection.eligibilityModule.sex"]'))
+    healthy_volunteers_allowed = safe_get_text(soup_detail.select_one('[path="protocolSection.eligibilityModule.healthyVolunteers"]'))
+
+    # Select the ctg-conditions element
+    conditions_element = soup_detail.select_one("ctg-conditions")
+
+    if conditions_element:
+        # Find the parent div that contains the list of divs
+        parent_div = conditions_element.find("div")
+
+        if parent_div:
+            # Find all divs inside this parent div
+            condition_divs = parent_div.find_all("div")
+
+            # Extract the text from each div and strip any extra whitespace
+            conditions_list = [div.get_text().strip() for div in condition_divs]
+
+            # Join the extracted text into a dash-separated string
+            conditions = " - ".join(conditions_list)
+
+    # Initialize variables
+    inclusion_criteria = ""
+    exclusion_criteria = ""
+
+    try:
+        # Find the eligibility criteria container
+        eligibility_criteria_element = soup_detail.select_one("#eligibility-criteria-description")
+
+        if eligibility_criteria_element:
+            # Extract the p tag for Inclusion Criteria
+            inclusion_p = eligibility_criteria_element.find("p", string=re.compile("Inclusion Criteria"))
+            if inclusion_p:
+                # Find the <ul> following the Inclusion Criteria <p> tag
+                inclusion_ul = inclusion_p.find_next("ul")
+                if inclusion_ul:
+                    inclusion_list = [li.get_text().strip() for li in inclusion_ul.find_all("li")]  # Extract all <li> items
+                    inclusion_criteria = " - ".join(inclusion_list)  # Join them as a dash string
+
+            # Extract the p tag for Exclusion Criteria
+            exclusion_p = eligibility_criteria_element.find("p", string=re.compile("Exclusion Criteria"))
+            if exclusion_p:
+                # Find the <ul> following the Exclusion Criteria <p> tag
+                exclusion_ul = exclusion_p.find_next("ul")
+                if exclusion_ul:
+                    exclusion_list = [li.get_text().strip() for li in exclusion_ul.find_all("li")]  # Extract all <li> items
+                    exclusion_criteria = " - ".join(exclusion_list)  # Join them as a dash string
+    except Exception as e:
+        print(f"Error extracting criteria for this trial: {e}")
+        return None
+
+    return {
+        "trialId": trial_id,
+        "trialTitle": trial_title,
+        "detailedInfo": {
+            "inclusionCriteria": inclusion_criteria,
+            "exclusionCriteria": exclusion_criteria
+        },
+        "age_criteria": age_criteria,
+        "sex_criteria": sex_criteria,
+        "healthy_volunteers_allowed": healthy_volunteers_allowed,
+        "conditions": conditions
+    }
+
+def extract_trial_info(driver, page_limit = 10, cache=None):
     trial_data = []
     
     curr_page = 0
 
     while True:
+        page_start = time.perf_counter()
+
         # Wait for the trial elements to load
         WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//ctg-search-results-page//ctg-search-results-list")))
 
@@ -41,88 +132,40 @@ def extract_trial_info(driver, page_limit = 10):
                 trial_title_element = trial.select_one(".hit-card-title.usa-card__heading")
                 trial_title = safe_get_text(trial_title_element)
 
+                # Trials cached within the TTL are taken from the cache without opening the detail page
+                if cache is not None:
+                    cached_trial = cache.get_fresh(trial_id)
+                    if cached_trial is not None:
+                        trial_data.append(cached_trial)
+                        continue
+
                 # Simulate click to navigate to detailed page
                 trial_element = driver.find_element(By.CSS_SELECTOR, ".hit-card-title.usa-card__heading")
                 trial_element.click()
 
-                # Wait for detailed page to load and parse
+                # Wait for detailed page to load and parse, unchanged pages are not parsed again when cached
                 WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.TAG_NAME, "ctg-long-text")))
-                soup_detail = BeautifulSoup(driver.page_source, "html.parser")
-
-                # Extract inclusion/exclusion criteria and other details
-                age_criteria = safe_get_text(soup_detail.select_one("ctg-standard-age"))
-                sex_criteria = safe_get_text(soup_detail.select_one('[path="protocolSection.eligibilityModule.sex"]'))
-                healthy_volunteers_allowed = safe_get_text(soup_detail.select_one('[path="protocolSection.eligibilityModule.healthyVolunteers"]'))
-
-                # Select the ctg-conditions element
-                conditions_element = soup_detail.select_one("ctg-conditions")
-                
-                if conditions_element:
-                    # Find the parent div that contains the list of divs
-                    parent_div = conditions_element.find("div")
-                    
-                    if parent_div:
-                        # Find all divs inside this parent div
-                        condition_divs = parent_div.find_all("div")
-                        
-                        # Extract the text from each div and strip any extra whitespace
-                        conditions_list = [div.get_text().strip() for div in condition_divs]
-                        
-                        # Join the extracted text into a dash-separated string
-                        conditions = " - ".join(conditions_list)
-
-                # Initialize variables
-                inclusion_criteria = ""
-                exclusion_criteria = ""
-
-                try:
-                    # Find the eligibility criteria container
-                    eligibility_criteria_element = soup_detail.select_one("#eligibility-criteria-description")
-                    
-                    if eligibility_criteria_element:
-                        # Extract the p tag for Inclusion Criteria
-                        inclusion_p = eligibility_criteria_element.find("p", string=re.compile("Inclusion Criteria"))
-                        if inclusion_p:
-                            # Find the <ul> following the Inclusion Criteria <p> tag
-                            inclusion_ul = inclusion_p.find_next("ul")
-                            if inclusion_ul:
-                                inclusion_list = [li.get_text().strip() for li in inclusion_ul.find_all("li")]  # Extract all <li> items
-                                inclusion_criteria = " - ".join(inclusion_list)  # Join them as a dash string
-
-                        # Extract the p tag for Exclusion Criteria
-                        exclusion_p = eligibility_criteria_element.find("p", string=re.compile("Exclusion Criteria"))
-                        if exclusion_p:
-                            # Find the <ul> following the Exclusion Criteria <p> tag
-                            exclusion_ul = exclusion_p.find_next("ul")
-                            if exclusion_ul:
-                                exclusion_list = [li.get_text().strip() for li in exclusion_ul.find_all("li")]  # Extract all <li> items
-                                exclusion_criteria = " - ".join(exclusion_list)  # Join them as a dash string
-                except Exception as e:
-                    print(f"Error extracting criteria for this trial: {e}")
+                page_source = driver.page_source
+                parse = lambda raw: parse_trial_detail_page(raw, trial_id, trial_title)
+                trial_detail = cache.parse_cached(trial_id, page_source, parse) if cache is not None else parse(page_source)
+                if trial_detail is None:
                     continue
 
                 # Add the trial data to the list
-                trial_data.append({
-                    "trialId": trial_id.replace(',','_'),
-                    "trialTitle": trial_title.replace(',','_'),
-                    "detailedInfo": {
-                        "inclusionCriteria": inclusion_criteria.replace(',','_'),
-                        "exclusionCriteria": exclusion_criteria.replace(',','_')
-                    },
-                    "age_criteria": age_criteria.replace(',','_'),
-                    "sex_criteria": sex_criteria.replace(',','_'),
-                    "healthy_volunteers_allowed": healthy_volunteers_allowed.replace(',','_'),
-                    "conditions": conditions.replace(',','_')
-                })
+                trial_data.append(trial_detail)
+                increment('scrape.trials')
 
                 # Go back to the previous page
                 driver.back()
                 WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//ctg-search-results-page//ctg-search-results-list")))
 
             except Exception as e:
+                increment('scrape.failed_trials')
                 print(f"Error processing trial: {e}")
                 continue  # Skip trial if an error occurs
 
+        METRICS.add_time('scrape.page', time.perf_counter() - page_start, peak_rss_mb())
+        increment('scrape.pages')
         curr_page += 1
         print("Page ", str(curr_page), ": Completed!")
         if curr_page == page_limit:
@@ -137,13 +180,14 @@ def extract_trial_info(driver, page_limit = 10):
 
     return trial_data
 
-def scrape_clinical_trials(page_limit):
+def scrape_clinical_trials(page_limit, cache_path=None, cache_ttl=DEFAULT_TTL_SECONDS):
     """
     Scrapes clinical trial data from ClinicalTrials.gov using Selenium and BeautifulSoup.
 
     Args:
         page_limit (int): Limit on how many pages to scrape on the clinicaltrials.gov website
-        
+        cache_path (str): Optional SQLite file of a TrialCache that persists the scraped trials between runs
+        cache_ttl (float): Seconds a cached trial is used without opening its detail page again
 
     Returns:
         trial_data(list(dict)): A list of dictionary with trial data
@@ -152,18 +196,24 @@ def scrape_clinical_trials(page_limit):
     url = "https://clinicaltrials.gov/search?aggFilters=status:rec"
     driver = setup_driver()
     driver.get(url)
+    cache = TrialCache(cache_path, cache_ttl) if cache_path else None
 
     # Extract all trial information across multiple pages
-    trial_data = extract_trial_info(driver, page_limit)
-
-    # Close the driver
-    driver.quit()
+    try:
+        trial_data = extract_trial_info(driver, page_limit, cache)
+    finally:
+        # Close the driver
+        driver.quit()
+        if cache is not None:
+            print(f"Trial cache: {cache.stats}")
+            METRICS.merge_counters(cache.stats, 'trial_cache')
+            cache.close()
 
     return trial_data
 
 
-# Function to write trial data to a CSV file using pandas
-def write_trials_to_csv(filename, data):
+def flatten_trials(data):
+    """ Flattens scraped trial dicts into a dataframe with the columns of scraped_trials.csv """
     # Create a list to hold flattened data for DataFrame
     flattened_data = []
     
@@ -180,10 +230,33 @@ def write_trials_to_csv(filename, data):
         })
 
     # Create a DataFrame from the flattened data
-    df = pd.DataFrame(flattened_data)
+    return pd.DataFrame(flattened_data, columns=TRIAL_COLUMNS)
+
+# Function to write trial data to a CSV file using pandas
+def write_trials_to_csv(filename, data):
+    # Commas are replaced with '_' in every field, the CSV layout the matchers have always read
+    df = flatten_trials(data).replace(',', '_', regex=True)
 
     # Write the DataFrame to a CSV file, overwriting if it exists
     df.to_csv(filename, index=False)
 
-    
-   
\ No newline at end of file
+def write_trials_table(filename, data):
+    """
+    Writes scraped trials as CSV, Parquet or Arrow IPC depending on the file extension. The columnar formats keep the
+    original text (no comma replacement) and store the criteria and conditions as lists of terms.
+    The trials are also compiled (parsed age limits, sex bitmask, condition term ids) into a file next to the table,
+    so the matchers do not parse any criteria strings.
+
+    Args:
+        filename (str): Destination path ending in .csv, .parquet or .arrow / .feather.
+        data (list(dict)): Trial data as returned by scrape_clinical_trials.
+
+    Returns:
+        None
+
+    """
+    if table_format(filename) == 'csv':
+        write_trials_to_csv(filename, data)
+    else:
+        write_table(flatten_trials(data), filename)
+    load_or_compile_trials(filename)
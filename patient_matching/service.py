@@ -0,0 +1,265 @@
+"""
+Long-running matching service. The trial table is loaded once into memory (compiled rules and condition index) and
+patients are matched against it over a local HTTP API with the rules of match_patients_to_trials.
+
+Run from the repository root:
+    python -m patient_matching.service --trials output/scraped_trials.parquet --port 8000
+
+Endpoints:
+    POST /match          one patient {"Id", "AGE", "GENDER", "CONDITIONS"} -> {"patientId", "eligibleTrials"}
+    POST /match/batch    {"patients": [...]} -> {"results": [...]}, in request order
+    GET  /trials/<trialId>/patients?top=N
+                         ranked eligible patients of one trial, when started with --patients
+    POST /reload         reloads the trial (and patient) table, requests keep being answered from the old one until the swap
+    GET  /stats          request count, p50 / p99 latency and the loaded trial set
+    GET  /metrics        step timers and counters (pairs evaluated, ...) in the Prometheus text format
+    GET  /health
+"""
+import argparse
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+
+from patient_matching.compiled_trials import load_or_compile_trials
+from patient_matching.fuzzy_conditions import DEFAULT_FUZZY_THRESHOLD
+from patient_matching.match_algorithm import DEFAULT_BLOCK_SIZE, _condition_matcher, iter_vectorized_matches
+from patient_matching.metrics import METRICS
+from patient_matching.patient_index import load_or_build_patient_index
+from patient_matching.storage import file_hash, read_table_snapshot
+
+# Latencies of the most recent requests kept for the percentiles
+LATENCY_WINDOW = 10000
+
+
+class TrialMatcher:
+    """ An immutable in-memory trial set: compiled age / sex rules, the condition index and the trial rows by id """
+
+    def __init__(self, trial_path, condition_match='exact', fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.trial_path = trial_path
+        # One snapshot of the file: the ids, rows, rules and condition index all come from the bytes that were hashed,
+        # a table rewritten during the reload cannot mix two versions
+        trials, self.source_hash = read_table_snapshot(trial_path)
+        self.trial_ids = trials['trialId'].tolist()
+        self.trial_names = trials['trialTitle'].tolist()
+        self.trial_rows = dict(zip(self.trial_ids, trials.to_dict('records')))
+        compiled = load_or_compile_trials(trial_path, trials, source_hash=self.source_hash)
+        self.rules = compiled.rules
+        self.condition_index = _condition_matcher(compiled.condition_index(), condition_match, fuzzy_threshold)
+        self.loaded_at = time.time()
+
+    def __len__(self):
+        return len(self.trial_ids)
+
+    def match(self, patients, block_size=DEFAULT_BLOCK_SIZE):
+        """
+        Matches patients against the trial set.
+
+        Args:
+            patients (list(dict)): Patients with 'Id', 'AGE', 'GENDER' and 'CONDITIONS' (' - ' joined string or list).
+
+        Returns:
+            list(dict): One {"patientId", "eligibleTrials"} record per patient, in input order, trials in table order.
+
+        """
+        patient_ids = [patient.get('Id') for patient in patients]
+        ages = np.array([np.nan if patient.get('AGE') is None else patient['AGE'] for patient in patients], dtype=float)
+        genders = np.array([patient.get('GENDER') for patient in patients], dtype=object)
+        conditions = [patient.get('CONDITIONS') for patient in patients]
+
+        records = iter_vectorized_matches(
+            list(range(len(patients))), ages, genders, conditions, self.rules, self.condition_index,
+            self.trial_ids, self.trial_names, block_size
+        )
+        # Records come back only for patients with eligible trials, keyed here by position
+        eligible = {record["patientId"]: record["eligibleTrials"] for record in records}
+        return [{"patientId": patient_ids[i], "eligibleTrials": eligible.get(i, [])} for i in range(len(patients))]
+
+
+class MatchingService:
+    """
+    Holds the current TrialMatcher and the latency statistics. A reload builds a new matcher next to the current
+    one and swaps the reference, so requests never wait for a reload and never see a half loaded trial set.
+    """
+
+    def __init__(self, trial_path, condition_match='exact', fuzzy_threshold=DEFAULT_FUZZY_THRESHOLD, patient_path=None):
+        self.trial_path = trial_path
+        self.condition_match = condition_match
+        self.fuzzy_threshold = fuzzy_threshold
+        self.patient_path = patient_path
+        self.matcher = TrialMatcher(trial_path, condition_match, fuzzy_threshold)
+        # Answers the reverse query, ranked patients for one trial
+        self.patient_index = load_or_build_patient_index(patient_path) if patient_path else None
+        self.reloads = 0
+        self.requests = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._reload_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def reload(self, force=True):
+        """ Loads the trial table again and swaps it in, unless force is False and the file did not change. Returns whether it swapped """
+        with self._reload_lock:
+            if self.patient_path and file_hash(self.patient_path) != self.patient_index.source_hash:
+                self.patient_index = load_or_build_patient_index(self.patient_path)
+                print(f"Reloaded {len(self.patient_index)} patients from {self.patient_path}")
+            if not force and file_hash(self.trial_path) == self.matcher.source_hash:
+                return False
+            self.matcher = TrialMatcher(self.trial_path, self.condition_match, self.fuzzy_threshold)
+            self.reloads += 1
+            print(f"Reloaded {len(self.matcher)} trials from {self.trial_path}")
+            return True
+
+    def watch(self, interval):
+        """ Starts a daemon thread that reloads the trial table whenever it changes on disk """
+        def poll():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.reload(force=False)
+                except Exception as e:
+                    # Keeps serving the previous trial set
+                    print(f"Reload of {self.trial_path} failed: {e}")
+
+        threading.Thread(target=poll, daemon=True).start()
+
+    def match(self, patients):
+        start = time.perf_counter()
+        # One reference read, a concurrent reload cannot change the trial set mid-request
+        results = self.matcher.match(patients)
+        self.record_latency(time.perf_counter() - start)
+        return results
+
+    def rank_patients(self, trial_id, top_n=None):
+        """ Ranked eligible patients of one trial, see PatientIndex.rank. Raises KeyError for an unknown trial """
+        if self.patient_index is None:
+            raise ValueError("The service was started without a patient table")
+        start = time.perf_counter()
+        ranking = self.patient_index.rank(self.matcher.trial_rows[trial_id], top_n)
+        self.record_latency(time.perf_counter() - start)
+        return ranking
+
+    def record_latency(self, seconds):
+        with self._stats_lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+
+    def stats(self):
+        with self._stats_lock:
+            latencies = np.array(self.latencies) * 1000
+            requests = self.requests
+        matcher = self.matcher
+        return {
+            "requests": requests,
+            "patients": None if self.patient_index is None else len(self.patient_index),
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "trials": len(matcher),
+            "trials_hash": matcher.source_hash,
+            "loaded_at": matcher.loaded_at,
+            "reloads": self.reloads,
+        }
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, status, body):
+            payload = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def _read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b'null')
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if url.path == "/health":
+                self._send(200, {"status": "ok"})
+            elif url.path == "/stats":
+                self._send(200, service.stats())
+            elif url.path == "/metrics":
+                payload = METRICS.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+            elif len(parts) == 3 and parts[0] == "trials" and parts[2] == "patients":
+                try:
+                    top = parse_qs(url.query).get("top")
+                    self._send(200, service.rank_patients(unquote(parts[1]), int(top[0]) if top else None))
+                except KeyError:
+                    self._send(404, {"error": f"Unknown trial {unquote(parts[1])}"})
+                except ValueError as e:
+                    self._send(400, {"error": str(e)})
+            else:
+                self._send(404, {"error": f"Unknown endpoint {self.path}"})
+
+        def do_POST(self):
+            try:
+                body = self._read_json()
+                if self.path == "/match":
+                    if not isinstance(body, dict):
+                        raise ValueError("Expected one patient object")
+                    self._send(200, service.match([body])[0])
+                elif self.path == "/match/batch":
+                    patients = body.get("patients") if isinstance(body, dict) else body
+                    if not isinstance(patients, list):
+                        raise ValueError("Expected {\"patients\": [...]}")
+                    self._send(200, {"results": service.match(patients)})
+                elif self.path == "/reload":
+                    service.reload()
+                    self._send(200, service.stats())
+                else:
+                    self._send(404, {"error": f"Unknown endpoint {self.path}"})
+            except (ValueError, TypeError, AttributeError) as e:
+                self._send(400, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def start_service(service, host="127.0.0.1", port=8000):
+    """ Serves a MatchingService in a background thread and returns (server, base_url) """
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", default="output/scraped_trials.parquet", help="Trial table (CSV, Parquet or Arrow)")
+    parser.add_argument("--patients", help="Processed patient table, enables the ranked patients per trial endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--watch", type=float, default=0, help="Seconds between checks for a changed trial table, 0 disables hot reload")
+    parser.add_argument("--condition-match", choices=("exact", "fuzzy"), default="exact")
+    parser.add_argument("--fuzzy-threshold", type=float, default=DEFAULT_FUZZY_THRESHOLD)
+    args = parser.parse_args()
+
+    service = MatchingService(args.trials, args.condition_match, args.fuzzy_threshold, args.patients)
+    if args.watch:
+        service.watch(args.watch)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    server.daemon_threads = True
+    print(f"Serving {len(service.matcher)} trials on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
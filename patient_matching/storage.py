@@ -0,0 +1,272 @@
+import hashlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+# Intermediate tables can be stored as CSV or in a columnar format, chosen by the file extension
+CSV_EXTENSIONS = ('.csv',)
+PARQUET_EXTENSIONS = ('.parquet', '.pq')
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+
+# Columns holding ' - ' joined terms in CSV files and list<string> in columnar files
+PATIENT_LIST_COLUMNS = ('CONDITIONS', 'PREVIOUS_CONDITIONS')
+TRIAL_LIST_COLUMNS = ('inclusionCriteria', 'exclusionCriteria', 'conditions')
+LIST_COLUMNS = PATIENT_LIST_COLUMNS + TRIAL_LIST_COLUMNS
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet/Arrow intermediate files require pyarrow, install it with 'pip install pyarrow'") from e
+    return pyarrow
+
+def table_format(path):
+    """ Returns 'csv', 'parquet' or 'arrow' for a table path """
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension in CSV_EXTENSIONS:
+        return 'csv'
+    if extension in PARQUET_EXTENSIONS:
+        return 'parquet'
+    if extension in ARROW_EXTENSIONS:
+        return 'arrow'
+    raise ValueError(f"Unsupported table format: {path}")
+
+def file_hash(path):
+    """ Returns the sha1 hex digest of a file, read in blocks so large CSVs are not loaded at once """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def artifact_path(table_path, suffix):
+    """ Path of a file derived from a table and stored next to it, e.g. artifact_path('output/scraped_trials.parquet', '_compiled.npz') """
+    return os.path.splitext(str(table_path))[0] + suffix
+
+def load_or_build_artifact(table_path, path, load, build, save=True, source_hash=None):
+    """
+    Loads a file derived from a table (compiled trials, patient store, patient index), or builds (and saves) it when
+    it is missing, cannot be read or was built from a different version of the table.
+
+    Args:
+        table_path (str): The table the artifact is derived from.
+        path (str): Where the artifact is stored.
+        load (callable): Reads the artifact from a path, raising ValueError, KeyError or OSError when it cannot be used.
+            The artifact has the source_hash it was built with.
+        build (callable): Builds the artifact from the table, called with the table's current source_hash.
+        save (bool): Whether a freshly built artifact is written to path with its save method.
+        source_hash (str): The version of the table the artifact has to match, e.g. from read_table_snapshot.
+            Hashed from table_path when not given.
+
+    Returns:
+        object: An artifact that matches the current content (or the given version) of the table.
+
+    """
+    source_hash = source_hash or file_hash(table_path)
+
+    if os.path.exists(path):
+        try:
+            artifact = load(path)
+            if artifact.source_hash == source_hash:
+                return artifact
+        except (ValueError, KeyError, OSError) as e:
+            print(f"Rebuilding {path}, could not load it: {e}")
+
+    artifact = build(source_hash)
+    if save:
+        artifact.save(path)
+    return artifact
+
+def id_array(ids):
+    """
+    Row ids as an array np.savez stores without pickling. Numeric ids keep their dtype, so .tolist() on the loaded
+    array gives back the same Python values the table reader returned; any other ids are stored as strings.
+    """
+    ids = np.asarray(ids)
+    return ids.astype(str) if ids.dtype == object else ids
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+def split_terms(value):
+    """
+    Returns the terms of a condition or criteria value, which is a ' - ' joined string in CSV files and a list of terms
+    in columnar files. Missing and empty values have no terms.
+    """
+    if isinstance(value, str):
+        return value.split(' - ') if value else []
+    if _is_missing(value):
+        return []
+    return list(value)
+
+def _schema(pa, df):
+    # Condition / criteria columns are list<string>, AGE a small integer, everything else a string
+    fields = []
+    for column in df.columns:
+        if column in LIST_COLUMNS:
+            fields.append(pa.field(column, pa.list_(pa.string())))
+        elif column == 'AGE':
+            fields.append(pa.field(column, pa.int16()))
+        else:
+            fields.append(pa.field(column, pa.string()))
+    return pa.schema(fields)
+
+def _to_arrow(pa, df, schema=None):
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if column in LIST_COLUMNS:
+            # Missing values stay null, everything else becomes the list of its terms
+            values = [None if _is_missing(v) else split_terms(v) for v in values.tolist()]
+        elif column == 'AGE':
+            # Float keeps missing ages as NaN, which the int16 schema stores as null
+            values = pd.to_numeric(values, errors='coerce').astype(float)
+        columns[column] = values
+    schema = schema or _schema(pa, df)
+    return pa.Table.from_pandas(pd.DataFrame(columns), schema=schema, preserve_index=False)
+
+def _to_csv_frame(df):
+    # CSV keeps the ' - ' joined representation the matchers have always read
+    df = df.copy()
+    for column in df.columns:
+        if column in LIST_COLUMNS and df[column].dtype == object:
+            df[column] = [' - '.join(v) if isinstance(v, (list, tuple, np.ndarray)) else v for v in df[column].tolist()]
+    return df
+
+
+def write_table(df, path):
+    """
+    Writes an intermediate table (processed patients or scraped trials) as CSV, Parquet or Arrow IPC depending on the extension.
+    In the columnar formats condition and criteria columns are stored as list<string> instead of ' - ' joined strings.
+
+    Args:
+        df (dataframe): The table to write.
+        path (str): Destination path ending in .csv, .parquet or .arrow / .feather.
+
+    Returns:
+        None
+
+    """
+    fmt = table_format(path)
+    if fmt == 'csv':
+        _to_csv_frame(df).to_csv(path, index=False)
+        return
+
+    pa = _import_pyarrow()
+    table = _to_arrow(pa, df)
+    if fmt == 'parquet':
+        pa.parquet.write_table(table, path)
+    else:
+        # Uncompressed IPC so readers can memory-map the columns without copying
+        with pa.OSFile(str(path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+def read_table(path, columns=None):
+    """
+    Reads an intermediate table written by write_table (or any CSV with the same columns).
+    Arrow IPC files are memory-mapped and Parquet files are read through a memory map, so the column buffers are
+    not copied through Python. List columns come back as arrays of terms; split_terms accepts both representations.
+
+    Args:
+        path (str): Path ending in .csv, .parquet or .arrow / .feather.
+        columns (list): Optional subset of columns to read.
+
+    Returns:
+        dataframe: The table.
+
+    """
+    fmt = table_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, usecols=columns)
+
+    pa = _import_pyarrow()
+    if fmt == 'parquet':
+        table = pa.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(str(path), 'r')).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return table.to_pandas()
+
+def read_table_snapshot(path, columns=None):
+    """
+    Reads a table like read_table and hashes the bytes it was parsed from, so the table and its hash always describe
+    the same version of the file, even when the file is rewritten while it is read.
+
+    Args:
+        path (str): Path ending in .csv, .parquet or .arrow / .feather.
+        columns (list): Optional subset of columns to read.
+
+    Returns:
+        tuple(dataframe, str): The table and the sha1 hex digest of the file content it was read from (see file_hash).
+
+    """
+    fmt = table_format(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    source_hash = hashlib.sha1(data).hexdigest()
+    if fmt == 'csv':
+        return pd.read_csv(io.BytesIO(data), usecols=columns), source_hash
+
+    pa = _import_pyarrow()
+    if fmt == 'parquet':
+        table = pa.parquet.read_table(pa.BufferReader(data), columns=columns)
+    else:
+        table = pa.ipc.open_file(pa.BufferReader(data)).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return table.to_pandas(), source_hash
+
+def convert_table(source_path, destination_path):
+    """ Converts an intermediate table between formats, e.g. to export a Parquet file as CSV """
+    write_table(read_table(source_path), destination_path)
+
+
+class TableWriter:
+    """
+    Appends dataframe chunks with the same columns to one CSV, Parquet or Arrow IPC file.
+    Used by the chunked patient preparation so processed rows go to disk as soon as a chunk is done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.format = table_format(path)
+        self.rows = 0
+        self._started = False
+        self._writer = None
+        self._sink = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, df):
+        if self.format == 'csv':
+            _to_csv_frame(df).to_csv(self.path, index=False, mode='a' if self._started else 'w', header=not self._started)
+        else:
+            pa = _import_pyarrow()
+            if self._writer is None:
+                self._schema = _schema(pa, df)
+                if self.format == 'parquet':
+                    self._writer = pa.parquet.ParquetWriter(self.path, self._schema)
+                else:
+                    self._sink = pa.OSFile(str(self.path), 'wb')
+                    self._writer = pa.ipc.new_file(self._sink, self._schema)
+            self._writer.write_table(_to_arrow(pa, df, self._schema))
+        self._started = True
+        self.rows += len(df)
+
+    def close(self):
+        if self.format != 'csv' and self._writer is not None:
+            self._writer.close()
+            if self._sink is not None:
+                self._sink.close()
+        self._writer = None
+        self._sink = None
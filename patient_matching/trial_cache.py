@@ -0,0 +1,154 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Cached trials older than this are refreshed from the source
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+# Least recently used entries are evicted once the raw documents exceed this size
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def content_hash(raw_document):
+    """ sha1 hex digest of a raw detail document (HTML page source or API JSON text) """
+    if isinstance(raw_document, str):
+        raw_document = raw_document.encode('utf-8')
+    return hashlib.sha1(raw_document).hexdigest()
+
+
+class TrialCache:
+    """
+    Persistent SQLite cache of scraped / fetched trials keyed by NCT id (trialId). Every entry keeps the parsed trial
+    dict, the raw detail document, the fetch timestamp and a hash of the raw document.
+
+    - get_fresh() returns entries younger than the TTL, so the detail page does not have to be fetched at all.
+    - parse_cached() skips parsing when a re-fetched document has the same hash as the cached one.
+    - Entries are evicted least recently used first when the stored documents exceed max_bytes.
+
+    The cache can be shared by the threads of one process.
+    """
+
+    def __init__(self, path, ttl_seconds=DEFAULT_TTL_SECONDS, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "unchanged": 0, "parsed": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS trials (
+                nct_id TEXT PRIMARY KEY,
+                trial_json TEXT NOT NULL,
+                raw_document TEXT,
+                content_hash TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS trials_accessed_at ON trials (accessed_at)")
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, nct_id):
+        """
+        Returns the cached entry of a trial as a dict with 'trial', 'raw_document', 'content_hash' and 'fetched_at',
+        or None when the trial is not cached.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT trial_json, raw_document, content_hash, fetched_at FROM trials WHERE nct_id = ?", (nct_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE trials SET accessed_at = ? WHERE nct_id = ?", (time.time(), nct_id))
+            self._connection.commit()
+        return {"trial": json.loads(row[0]), "raw_document": row[1], "content_hash": row[2], "fetched_at": row[3]}
+
+    def get_fresh(self, nct_id):
+        """ Returns the cached trial dict when it was fetched within the TTL, otherwise None """
+        entry = self.get(nct_id)
+        if entry is not None and time.time() - entry["fetched_at"] < self.ttl_seconds:
+            self._count("hits")
+            return entry["trial"]
+        self._count("misses")
+        return None
+
+    def put(self, nct_id, trial, raw_document=None, document_hash=None):
+        """ Stores (or replaces) a trial, then evicts least recently used entries if the cache is over its size bound """
+        if raw_document is not None and document_hash is None:
+            document_hash = content_hash(raw_document)
+        trial_json = json.dumps(trial)
+        size = len(trial_json) + len(raw_document or "")
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO trials (nct_id, trial_json, raw_document, content_hash, fetched_at, accessed_at, size) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (nct_id, trial_json, raw_document, document_hash, now, now, size)
+            )
+            self._evict()
+            self._connection.commit()
+
+    def parse_cached(self, nct_id, raw_document, parse):
+        """
+        Returns the parsed trial for a freshly fetched raw document. If the cached entry has the same content hash the
+        cached trial is reused without calling parse and only its fetch timestamp is refreshed, otherwise
+        parse(raw_document) is called and the result stored.
+
+        Args:
+            nct_id (str): The trial id.
+            raw_document (str): The fetched detail document.
+            parse (callable): Parses the raw document into a trial dict, may return None for unparseable documents.
+
+        Returns:
+            dict: The trial, None when parse returned None.
+
+        """
+        document_hash = content_hash(raw_document)
+        with self._lock:
+            row = self._connection.execute("SELECT trial_json FROM trials WHERE nct_id = ? AND content_hash = ?", (nct_id, document_hash)).fetchone()
+            if row is not None:
+                now = time.time()
+                self._connection.execute("UPDATE trials SET fetched_at = ?, accessed_at = ? WHERE nct_id = ?", (now, now, nct_id))
+                self._connection.commit()
+                self.stats["unchanged"] += 1
+                return json.loads(row[0])
+
+        trial = parse(raw_document)
+        self._count("parsed")
+        if trial is not None:
+            self.put(nct_id, trial, raw_document, document_hash)
+        return trial
+
+    def _evict(self):
+        # Called with the lock held
+        if self.max_bytes is None:
+            return
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM trials").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for nct_id, size in self._connection.execute("SELECT nct_id, size FROM trials ORDER BY accessed_at").fetchall():
+            self._connection.execute("DELETE FROM trials WHERE nct_id = ?", (nct_id,))
+            self.stats["evicted"] += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM trials").fetchone()[0]
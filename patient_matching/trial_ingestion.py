@@ -0,0 +1,242 @@
+import json
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from patient_matching.metrics import METRICS, increment
+from patient_matching.trial_cache import DEFAULT_TTL_SECONDS, TrialCache
+
+# ClinicalTrials.gov REST API, the same data the search pages render
+API_BASE_URL = "https://clinicaltrials.gov/api/v2"
+
+SEX_LABELS = {"ALL": "All", "FEMALE": "Female", "MALE": "Male"}
+STD_AGE_LABELS = {"CHILD": "Child", "ADULT": "Adult", "OLDER_ADULT": "Older Adult"}
+
+# Bullet markers used in the eligibilityCriteria markdown
+BULLET_PATTERN = re.compile(r'^\s*(?:[*\-•]|\d+[.)])\s+')
+
+
+class RateLimiter:
+    """ Thread-safe token bucket allowing `rate` requests per second with bursts of up to `burst` requests """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_session(max_connections=8, retries=3, backoff_factor=0.5):
+    """
+    Creates a requests session with a connection pool sized for the worker threads, retrying failed GETs
+    (connection errors, 429 and 5xx responses) with exponential backoff and honouring Retry-After.
+    """
+    retry = Retry(
+        total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",), respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _get_text(session, url, params=None, rate_limiter=None, timeout=30):
+    if rate_limiter is not None:
+        rate_limiter.acquire()
+    start = time.perf_counter()
+    try:
+        response = session.get(url, params=params, timeout=timeout)
+    finally:
+        METRICS.add_time('scrape.request', time.perf_counter() - start)
+    increment('scrape.requests')
+    response.raise_for_status()
+    return response.text
+
+def _get_json(session, url, params=None, rate_limiter=None, timeout=30):
+    return json.loads(_get_text(session, url, params, rate_limiter, timeout))
+
+
+def parse_eligibility_criteria(text):
+    """
+    Splits the eligibilityCriteria text of a study into its inclusion and exclusion bullet points.
+
+    Args:
+        text (str): Markdown-like criteria text with 'Inclusion Criteria:' / 'Exclusion Criteria:' headings and bullet lists.
+
+    Returns:
+        tuple(list, list): Inclusion and exclusion criteria items.
+
+    """
+    inclusion, exclusion = [], []
+    current = None
+    for line in (text or "").splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if BULLET_PATTERN.match(line):
+            if current is not None:
+                current.append(BULLET_PATTERN.sub("", line).strip())
+        # Headings such as 'Inclusion Criteria:' or 'Key Exclusion Criteria:'
+        elif "inclusion criteria" in stripped.lower():
+            current = inclusion
+        elif "exclusion criteria" in stripped.lower():
+            current = exclusion
+    return inclusion, exclusion
+
+def format_age_criteria(minimum_age, maximum_age, std_ages):
+    """ Formats the age limits like the study page does, e.g. '18 Years to 65 Years (Adult, Older Adult)' """
+    groups = ", ".join(STD_AGE_LABELS.get(age, age) for age in std_ages or [])
+    if minimum_age and maximum_age:
+        limits = f"{minimum_age} to {maximum_age}"
+    elif minimum_age:
+        limits = f"{minimum_age} and older"
+    elif maximum_age:
+        limits = f"up to {maximum_age}"
+    else:
+        return groups or "NA"
+    return f"{limits} ({groups})" if groups else limits
+
+def parse_trial_document(document):
+    """
+    Parses a study document of the ClinicalTrials.gov API into the trial dict produced by the Selenium scraper,
+    so it can be written with write_trials_to_csv / write_trials_table.
+
+    Args:
+        document (dict): The JSON document returned by /studies/{nctId}.
+
+    Returns:
+        dict: Trial data with the scraper's keys.
+
+    """
+    protocol = document.get("protocolSection", {})
+    identification = protocol.get("identificationModule", {})
+    eligibility = protocol.get("eligibilityModule", {})
+    conditions = protocol.get("conditionsModule", {}).get("conditions", [])
+
+    inclusion, exclusion = parse_eligibility_criteria(eligibility.get("eligibilityCriteria"))
+    healthy_volunteers = eligibility.get("healthyVolunteers")
+
+    return {
+        "trialId": identification.get("nctId", "NA"),
+        "trialTitle": identification.get("briefTitle", "NA"),
+        "detailedInfo": {
+            "inclusionCriteria": " - ".join(inclusion),
+            "exclusionCriteria": " - ".join(exclusion)
+        },
+        "age_criteria": format_age_criteria(eligibility.get("minimumAge"), eligibility.get("maximumAge"), eligibility.get("stdAges")),
+        "sex_criteria": SEX_LABELS.get(eligibility.get("sex"), "NA"),
+        "healthy_volunteers_allowed": "NA" if healthy_volunteers is None else ("Yes" if healthy_volunteers else "No"),
+        "conditions": " - ".join(conditions)
+    }
+
+
+def iter_recruiting_trial_ids(session, page_limit, page_size=10, base_url=API_BASE_URL, rate_limiter=None):
+    """ Yields the NCT ids of recruiting studies one search page at a time, following the API's page tokens """
+    params = {"filter.overallStatus": "RECRUITING", "pageSize": page_size, "fields": "NCTId"}
+    for _ in range(page_limit):
+        page = _get_json(session, f"{base_url}/studies", params, rate_limiter)
+        yield [study["protocolSection"]["identificationModule"]["nctId"] for study in page.get("studies", [])]
+
+        next_page_token = page.get("nextPageToken")
+        if not next_page_token:
+            break
+        params = dict(params, pageToken=next_page_token)
+
+def fetch_trial_document(session, nct_id, base_url=API_BASE_URL, rate_limiter=None):
+    """ Fetches the raw JSON text of the study document of one trial """
+    return _get_text(session, f"{base_url}/studies/{nct_id}", rate_limiter=rate_limiter)
+
+def _fetch_and_parse(session, nct_id, base_url, rate_limiter, cache=None):
+    try:
+        if cache is None:
+            return parse_trial_document(json.loads(fetch_trial_document(session, nct_id, base_url, rate_limiter)))
+
+        # Trials fetched within the cache TTL are not requested again
+        trial = cache.get_fresh(nct_id)
+        if trial is not None:
+            return trial
+        raw_document = fetch_trial_document(session, nct_id, base_url, rate_limiter)
+        return cache.parse_cached(nct_id, raw_document, lambda raw: parse_trial_document(json.loads(raw)))
+    except Exception as e:
+        increment('scrape.failed_trials')
+        print(f"Error processing trial {nct_id}: {e}")
+        return None
+
+def iter_trial_pages(page_limit, page_size=10, max_workers=8, requests_per_second=5.0, base_url=API_BASE_URL, session=None, cache=None):
+    """
+    Yields the parsed trials of each search page, in search order. Detail documents are fetched by a bounded thread
+    pool sharing one pooled session and one rate limiter, and the fetches of later pages start while earlier pages
+    are still in flight. Trials that fail after the retries are reported and skipped, like in the Selenium scraper.
+    With a TrialCache, fresh cached trials are not fetched and unchanged documents are not parsed again.
+    """
+    session = session or create_session(max_workers)
+    rate_limiter = RateLimiter(requests_per_second, burst=max_workers)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for curr_page, nct_ids in enumerate(iter_recruiting_trial_ids(session, page_limit, page_size, base_url, rate_limiter), start=1):
+            pending.append((curr_page, [executor.submit(_fetch_and_parse, session, nct_id, base_url, rate_limiter, cache) for nct_id in nct_ids]))
+            # Hand out finished pages early, in order
+            while pending and all(future.done() for future in pending[0][1]):
+                yield _collect_page(*pending.popleft())
+
+        while pending:
+            yield _collect_page(*pending.popleft())
+
+def _collect_page(curr_page, futures):
+    trials = [trial for trial in (future.result() for future in futures) if trial is not None]
+    increment('scrape.pages')
+    increment('scrape.trials', len(trials))
+    print("Page ", str(curr_page), ": Completed!")
+    return trials
+
+def ingest_clinical_trials(page_limit, page_size=10, max_workers=8, requests_per_second=5.0, base_url=API_BASE_URL, cache_path=None, cache_ttl=DEFAULT_TTL_SECONDS):
+    """
+    Fetches recruiting clinical trials from the ClinicalTrials.gov API concurrently. This is the HTTP counterpart of
+    scrape_clinical_trials and returns the same trial dicts.
+
+    Args:
+        page_limit (int): Limit on how many search pages to read.
+        page_size (int): Trials per search page, 10 like the search website.
+        max_workers (int): Number of concurrent detail requests (and pooled connections).
+        requests_per_second (float): Rate limit shared by all requests.
+        base_url (str): API root, can point to a local stand-in server.
+        cache_path (str): Optional SQLite file of a TrialCache that persists the fetched trials between runs.
+        cache_ttl (float): Seconds a cached trial is used without fetching it again.
+
+    Returns:
+        trial_data(list(dict)): A list of dictionary with trial data
+
+    """
+    trial_data = []
+    cache = TrialCache(cache_path, cache_ttl) if cache_path else None
+    try:
+        with create_session(max_workers) as session:
+            for trials in iter_trial_pages(page_limit, page_size, max_workers, requests_per_second, base_url, session, cache):
+                trial_data.extend(trials)
+    finally:
+        if cache is not None:
+            print(f"Trial cache: {cache.stats}")
+            METRICS.merge_counters(cache.stats, 'trial_cache')
+            cache.close()
+    return trial_data
@@ -0,0 +1,132 @@
+"""
+Tests of LLMExecutor and the packed prompt helpers against the local mock LLM server.
+
+Run from the repository root:
+    python -m pytest -q tests
+"""
+import asyncio
+import contextlib
+
+import pytest
+
+from benchmarks.mock_llm_server import MockLLM, answer_for, start_server
+from patient_matching import llm_executor
+from patient_matching.llm_executor import LLMExecutor, build_packed_prompt, parse_packed_response
+
+PATIENT = "Age 40, Gender Female, Conditions: Asthma"
+TRIALS = [("NCT1", "Ages 18-65, All genders, Asthma"), ("NCT10", "Ages 30-50, Female, Asthma"), ("NCT2", "Ages 0-17, All genders, Asthma")]
+
+
+@contextlib.contextmanager
+def serve(mock):
+    server, api_base = start_server(mock)
+    try:
+        yield api_base
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def complete_all(executor, prompts):
+    async def run():
+        async with executor:
+            return [await executor.complete(prompt) for prompt in prompts]
+    try:
+        return asyncio.run(run())
+    finally:
+        executor.close()
+
+
+def make_executor(api_base, **kwargs):
+    kwargs.setdefault("backoff_seconds", 0.01)
+    return LLMExecutor(requests_per_second=1000, api_base=api_base, api_key="test", **kwargs)
+
+
+def expected_lines(patient_text, trial_texts):
+    return {trial_id: answer_for(patient_text, trial_id) for trial_id, _ in trial_texts}
+
+
+@pytest.mark.parametrize("failure", ["throttle_every", "error_every"])
+def test_retries_throttling_and_server_errors(failure):
+    # Every second request fails, so the second prompt only succeeds on its retry
+    mock = MockLLM(**{failure: 2})
+    prompts = [build_packed_prompt(PATIENT, TRIALS[:1]), build_packed_prompt(PATIENT, TRIALS)]
+    with serve(mock) as api_base:
+        executor = make_executor(api_base)
+        responses = complete_all(executor, prompts)
+
+    assert responses[0] == answer_for(PATIENT, "NCT1")
+    assert parse_packed_response(responses[1], [trial_id for trial_id, _ in TRIALS]) == expected_lines(PATIENT, TRIALS)
+    assert executor.stats == {"calls": 3, "cache_hits": 0, "retries": 1, "failures": 0}
+    assert mock.requests == 3
+
+
+def test_gives_up_after_max_retries_with_exponential_backoff(monkeypatch):
+    delays = []
+    sleep = asyncio.sleep
+
+    async def recording_sleep(delay, *args, **kwargs):
+        if delay > 0:
+            delays.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(llm_executor.asyncio, "sleep", recording_sleep)
+    monkeypatch.setattr(llm_executor.random, "uniform", lambda low, high: high)
+    mock = MockLLM(throttle_every=1)
+    with serve(mock) as api_base:
+        executor = make_executor(api_base, max_retries=3, backoff_seconds=0.5, max_backoff_seconds=1.5)
+        responses = complete_all(executor, [build_packed_prompt(PATIENT, TRIALS)])
+
+    assert responses == [None]
+    assert delays == [0.5, 1.0, 1.5]
+    assert executor.stats == {"calls": 4, "cache_hits": 0, "retries": 3, "failures": 1}
+    assert mock.requests == 4
+
+
+def test_cache_hits_and_misses(tmp_path):
+    cache_path = str(tmp_path / "responses.sqlite")
+    first, second = build_packed_prompt(PATIENT, TRIALS[:2]), build_packed_prompt(PATIENT, TRIALS[2:])
+    mock = MockLLM()
+    with serve(mock) as api_base:
+        executor = make_executor(api_base, cache_path=cache_path)
+        responses = complete_all(executor, [first, first])
+        assert responses[0] == responses[1]
+        assert executor.stats["calls"] == 1 and executor.stats["cache_hits"] == 1
+
+        # The cache persists across executors, only the new prompt reaches the server
+        executor = make_executor(api_base, cache_path=cache_path)
+        assert complete_all(executor, [second, first])[1] == responses[0]
+        assert executor.stats["calls"] == 1 and executor.stats["cache_hits"] == 1
+
+        # A different model never shares cached answers
+        executor = make_executor(api_base, cache_path=cache_path, model="another-model")
+        complete_all(executor, [first])
+        assert executor.stats["calls"] == 1 and executor.stats["cache_hits"] == 0
+    assert mock.requests == 3
+
+
+def test_failed_requests_are_not_cached(tmp_path):
+    cache_path = str(tmp_path / "responses.sqlite")
+    prompt = build_packed_prompt(PATIENT, TRIALS)
+    with serve(MockLLM(throttle_every=1)) as api_base:
+        assert complete_all(make_executor(api_base, cache_path=cache_path, max_retries=0), [prompt]) == [None]
+    with serve(MockLLM()) as api_base:
+        executor = make_executor(api_base, cache_path=cache_path)
+        assert complete_all(executor, [prompt])[0] is not None
+    assert executor.stats["calls"] == 1 and executor.stats["cache_hits"] == 0
+
+
+@pytest.mark.parametrize("response", [None, "", "I am not able to assess eligibility.", "yes\nno\nyes"])
+def test_parse_packed_response_malformed(response):
+    assert parse_packed_response(response, ["NCT1", "NCT10", "NCT2"]) == {}
+
+
+def test_parse_packed_response_partial():
+    response = "Here are my answers:\nNCT10: yes - Age criteria met\n\nNCT1 -"
+    assert parse_packed_response(response, ["NCT1", "NCT10", "NCT2"]) == {"NCT10": "yes - Age criteria met", "NCT1": ""}
+
+
+def test_parse_packed_response_formatting():
+    # Markdown emphasis, '-' separators and repeated lines, the first answer of a trial wins
+    response = "**NCT1**: no\nNCT2 - yes - Gender criteria met\nNCT1: yes"
+    assert parse_packed_response(response, ["NCT1", "NCT10", "NCT2"]) == {"NCT1": "no", "NCT2": "yes - Gender criteria met"}